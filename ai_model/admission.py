@@ -0,0 +1,212 @@
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+import cv2
+
+from frames import FRAME_INTERVAL
+from metrics import admission_total, stage
+
+try:
+    import av
+except ImportError:
+    av = None
+
+# Cost-aware admission control for the pipeline endpoints, shared by every server process on the host.
+#
+# A request's cost is an estimate of the CPU seconds it needs, read from the container header before any
+# decoding: every frame is decoded (cost per megapixel), every FRAME_INTERVAL-th frame may go through CLIP.
+# The header is the client's to write, so the frame readers stop at the frame count that was charged
+# (frames.limit_frames) and a video with more frames fails with 422 instead of being judged on its first ones.
+# A stream without a frame count is charged by its file size, which covers all but very static raw streams.
+# Each client has a token bucket of cost-seconds that refills at a fixed rate; a request is charged its cost
+# up front and refused with 429 when the bucket cannot cover it. A request costing more than the whole bucket
+# (a long video) waits for a full bucket and leaves it in debt, so the client's next requests wait that much
+# longer. A request that will share an analysis already running for the same upload pays COALESCED_COST.
+# Admitted work also counts against a global in-flight budget; requests that do not fit wait in line for up to
+# queue_seconds, then are shed with 503.
+# Buckets and in-flight work live in a SQLite file, so all workers of the server share them.
+
+DECODE_SECONDS_PER_MEGAPIXEL = float(os.environ.get("LOFI_COST_DECODE_PER_MEGAPIXEL", 0.0006))
+CLIP_SECONDS_PER_FRAME = float(os.environ.get("LOFI_COST_CLIP_PER_FRAME", 0.08))
+BASE_COST = 0.05
+# frames charged per byte of a video whose header has no frame count, far more than a typical encode has
+MIN_BYTES_PER_FRAME = 2000
+# frames charged beyond the header's count, which is derived from the duration for some containers (WebM,
+# Matroska) and can be a few frames short, so that such a video is not rejected as longer than charged
+FRAME_COUNT_SLACK = 0.02
+CONTINUE_COST = 0.05  # a decoder forward pass
+# a /decode whose analysis is already running for the same bytes (see singleflight.py) only adds a decoder pass
+COALESCED_COST = CONTINUE_COST
+
+DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), "lofi_admission.sqlite")
+DEFAULT_CLIENT_BURST = 300.0  # cost-seconds a client can spend at once
+DEFAULT_CLIENT_RATE = 1.0  # cost-seconds per second a client gets back
+DEFAULT_INFLIGHT_BUDGET = 60.0 * (os.cpu_count() or 1)
+DEFAULT_QUEUE_SECONDS = 30.0
+POLL_SECONDS = 0.05
+BUSY_RETRY_AFTER = 5.0
+# in-flight rows are dropped once their process is gone, or after this long
+STALE_SECONDS = 3600.0
+
+
+class Rejected(Exception):
+    """A request that is not admitted: the HTTP status, the Retry-After seconds (or None) and a message."""
+
+    def __init__(self, status, retry_after, message):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def probe_video(path):
+    """(frame count, duration in seconds, width, height) from the container header, without decoding."""
+    if av is not None:
+        try:
+            with av.open(path) as container:
+                stream = container.streams.video[0]
+                seconds = float(stream.duration * stream.time_base) if stream.duration else \
+                    container.duration / 1e6 if container.duration else 0.0
+                fps = float(stream.average_rate or 0)
+                frames = stream.frames or int(round(seconds * fps))
+                return frames, seconds, stream.codec_context.width, stream.codec_context.height
+        except (av.FFmpegError, IndexError):
+            pass
+
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            raise IOError(f"Cannot open video file: {path}")
+        frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        return (frames, frames / fps if fps else 0.0,
+                int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    finally:
+        cap.release()
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def estimate_cost(path, frame_interval=FRAME_INTERVAL):
+    """
+    (estimated CPU seconds of running the /decode pipeline on a video, frames charged for). Decode at most that
+    many frames, a video with more is rejected, see frames.limit_frames. Raises IOError for a video without a
+    picture size.
+    """
+    with stage("admission_probe"):
+        frames, _, width, height = probe_video(path)
+    if width <= 0 or height <= 0:
+        raise IOError(f"No picture size in video file: {path}")
+    if frames <= 0:
+        # no or a bogus frame count, e.g. a raw H.264 stream
+        frames = max(1, os.path.getsize(path) // MIN_BYTES_PER_FRAME)
+    frames += max(frame_interval, int(frames * FRAME_COUNT_SLACK))
+    decode = frames * width * height / 1e6 * DECODE_SECONDS_PER_MEGAPIXEL
+    clip = -(-frames // frame_interval) * CLIP_SECONDS_PER_FRAME
+    return max(BASE_COST, BASE_COST + decode + clip), frames
+
+
+class AdmissionController:
+    def __init__(self, db_path=DEFAULT_DB_PATH, client_burst=DEFAULT_CLIENT_BURST, client_rate=DEFAULT_CLIENT_RATE,
+                 inflight_budget=DEFAULT_INFLIGHT_BUDGET, queue_seconds=DEFAULT_QUEUE_SECONDS):
+        self.db_path = db_path
+        self.client_burst = client_burst
+        self.client_rate = client_rate
+        self.inflight_budget = inflight_budget
+        self.queue_seconds = queue_seconds
+        self.enabled = True
+        self._execute("CREATE TABLE IF NOT EXISTS buckets (client TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        self._execute("CREATE TABLE IF NOT EXISTS inflight "
+                      "(id INTEGER PRIMARY KEY AUTOINCREMENT, cost REAL, pid INTEGER, started REAL)")
+
+    def _connect(self):
+        # one short-lived connection per call, so it can be used from any thread; the timeout waits out writers
+        db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def _execute(self, sql, params=()):
+        db = self._connect()
+        try:
+            db.execute(sql, params)
+        finally:
+            db.close()
+
+    @contextmanager
+    def admit(self, client, cost):
+        """
+        Hold cost-seconds of the in-flight budget for the duration of the block, charging the client's bucket.
+        Raises Rejected when the client is over its rate or the server stayed busy for queue_seconds.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        deadline = time.monotonic() + self.queue_seconds
+        queued = False
+        with stage("admission_wait"):
+            while True:
+                decision, value = self._try_admit(client, cost)
+                if decision == "admitted":
+                    break
+                if decision == "client_limited":
+                    admission_total.inc(("shed_client",))
+                    raise Rejected(429, value, "Rate limit exceeded, retry later")
+                if time.monotonic() >= deadline:
+                    admission_total.inc(("shed_busy",))
+                    raise Rejected(503, BUSY_RETRY_AFTER, "Server busy, retry later")
+                queued = True
+                time.sleep(POLL_SECONDS)
+        admission_total.inc(("queued" if queued else "admitted",))
+
+        try:
+            yield
+        finally:
+            self._execute("DELETE FROM inflight WHERE id = ?", (value,))
+
+    def _try_admit(self, client, cost):
+        """('admitted', in-flight row id), ('client_limited', retry after seconds) or ('busy', None)."""
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM inflight WHERE started < ?", (now - STALE_SECONDS,))
+            for pid, in db.execute("SELECT DISTINCT pid FROM inflight").fetchall():
+                if not pid_alive(pid):
+                    db.execute("DELETE FROM inflight WHERE pid = ?", (pid,))
+            row = db.execute("SELECT tokens, updated FROM buckets WHERE client = ?", (client,)).fetchone()
+            tokens = self.client_burst if row is None else \
+                min(self.client_burst, row[0] + (now - row[1]) * self.client_rate)
+            # a request over the burst needs a full bucket, and leaves it negative
+            if tokens < min(cost, self.client_burst):
+                db.execute("ROLLBACK")
+                return "client_limited", (min(cost, self.client_burst) - tokens) / self.client_rate
+
+            inflight, = db.execute("SELECT COALESCE(SUM(cost), 0) FROM inflight").fetchone()
+            # a request bigger than the whole budget still runs, alone
+            if inflight > 0 and inflight + cost > self.inflight_budget:
+                db.execute("ROLLBACK")
+                return "busy", None
+
+            db.execute("INSERT OR REPLACE INTO buckets (client, tokens, updated) VALUES (?, ?, ?)",
+                       (client, tokens - cost, now))
+            row_id = db.execute("INSERT INTO inflight (cost, pid, started) VALUES (?, ?, ?)",
+                                (cost, os.getpid(), now)).lastrowid
+            db.execute("COMMIT")
+            return "admitted", row_id
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
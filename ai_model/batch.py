@@ -0,0 +1,142 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from frames import decode_video_crops, find_videos
+
+# Offline scoring (and optionally generation) over a directory of videos:
+#   python batch.py videos/ --out results.jsonl --workers 8 [--generate]
+# Video decoding fans out over a process pool, the decoded frames of all videos share CLIP batches in this process.
+# At most WINDOW_PER_WORKER videos per worker are decoding or waiting for CLIP at a time, so the decoded frames held
+# here stay bounded when CLIP is slower than decoding, however many videos the directory has.
+# Results are appended to the JSONL file as each video finishes, so an interrupted run resumes where it stopped.
+
+WINDOW_PER_WORKER = 2
+
+
+def load_done(output_path):
+    """Paths already present in an existing results file."""
+    done = set()
+    if os.path.isfile(output_path):
+        with open(output_path) as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["path"])
+                except (json.JSONDecodeError, KeyError):
+                    pass  # partially written last line of an interrupted run
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a directory of videos for lofifiability")
+    parser.add_argument("video_dir")
+    parser.add_argument("--out", default="results.jsonl")
+    parser.add_argument("--parquet", help="also write the results to this Parquet file when done (needs pandas)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--model_dir", default="checkpoints")
+    parser.add_argument("--method", default="mean", choices=["mean", "majority"])
+    parser.add_argument("--generate", action="store_true", help="also decode an Output for lofifiable videos")
+    parser.add_argument("--frame_probs", type=int, metavar="N",
+                        help="also write the per-frame probabilities, downsampled to at most N points")
+    args = parser.parse_args()
+
+    done = load_done(args.out)
+    paths = [path for path in find_videos(args.video_dir) if path not in done]
+    print(f"{len(paths)} videos to process, {len(done)} already in {args.out}", file=sys.stderr)
+    if not paths:
+        return
+
+    # heavy imports only happen in this process, the decode workers only need OpenCV and PyAV
+    # (torchvision is imported there only for the OpenCV frame source's crop)
+    import torch
+    from clip_service import ClipBatcher, dedup_embeddings
+    from svm_frame_predictor import load_svm_model, score_embeddings
+    from model.constants import HIDDEN_SIZE
+
+    svm_model = load_svm_model(args.model_dir)
+    decoder = None
+    if args.generate:
+        from lofi2lofi_generate import generate
+        from model.lofi2lofi_model import Decoder
+        decoder = Decoder("cpu")
+        decoder.load_state_dict(torch.load(os.path.join(args.model_dir, "lofi2lofi_decoder.pth"), map_location="cpu"))
+        decoder.eval()
+
+    batcher = ClipBatcher()
+    decode_seconds = 0.0
+    finished = 0
+    start = time.perf_counter()
+
+    # the spawn context keeps CLIP and torch state out of the decode workers
+    with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("spawn")) as pool, \
+            open(args.out, "a") as out:
+        queued = iter(paths)
+        window = WINDOW_PER_WORKER * args.workers
+        decoding = {}
+        embedding = {}
+
+        def fill_window():
+            while len(decoding) + len(embedding) < window:
+                path = next(queued, None)
+                if path is None:
+                    return
+                decoding[pool.submit(decode_video_crops, path)] = path
+
+        def write(result):
+            nonlocal finished
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            finished += 1
+            if finished % 10 == 0 or finished == len(paths):
+                elapsed = time.perf_counter() - start
+                print(f"{finished}/{len(paths)} videos, {finished / elapsed:.2f} videos/s", file=sys.stderr)
+
+        fill_window()
+        while decoding or embedding:
+            completed, _ = wait(list(decoding) + list(embedding), return_when=FIRST_COMPLETED)
+            for future in completed:
+                if future in decoding:
+                    path = decoding.pop(future)
+                    try:
+                        _, crops, seconds = future.result()
+                    except Exception as e:
+                        write({"path": path, "error": str(e)})
+                        continue
+                    decode_seconds += seconds
+                    embedding[batcher.submit(crops)] = path
+                    continue
+
+                path = embedding.pop(future)
+                try:
+                    embeddings = dedup_embeddings(future.result()) if len(future.result()) else None
+                    if embeddings is None:
+                        write({"path": path, "error": "no meaningful frames"})
+                        continue
+                    result = {"path": path, **score_embeddings(svm_model, embeddings, args.method, args.frame_probs)}
+                    if decoder is not None and result["is_lofifiable"]:
+                        result["output"], result["state"] = generate(decoder, torch.randn(1, HIDDEN_SIZE))
+                except Exception as e:
+                    result = {"path": path, "error": str(e)}
+                write(result)
+            fill_window()
+
+    batcher.close()
+    elapsed = time.perf_counter() - start
+    print(f"Processed {len(paths)} videos in {elapsed:.1f}s ({len(paths) / elapsed:.2f} videos/s)", file=sys.stderr)
+    print(f"Decode utilization: {decode_seconds / (elapsed * args.workers) * 100:.1f}% of {args.workers} workers, "
+          f"CLIP utilization: {batcher.busy_seconds / elapsed * 100:.1f}% "
+          f"({batcher.frames_encoded} frames, {batcher.frames_encoded / max(batcher.busy_seconds, 1e-9):.1f} frames/s)",
+          file=sys.stderr)
+
+    if args.parquet:
+        import pandas as pd
+        pd.read_json(args.out, lines=True).to_parquet(args.parquet)
+        print(f"Wrote {args.parquet}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
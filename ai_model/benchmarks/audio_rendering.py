@@ -0,0 +1,53 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from renderer import SAMPLE_RATE, render, render_batch
+
+# realtime factor (seconds of audio rendered per second of wall time) of the NumPy renderer
+
+
+def random_output(rng, num_measures):
+    return {
+        "key": int(rng.randint(1, 13)),
+        "mode": int(rng.randint(1, 8)),
+        "bpm": int(rng.randint(70, 101)),
+        "chords": rng.randint(0, 8, num_measures).tolist(),
+        "melodies": rng.randint(0, 15, (num_measures, 8)).tolist(),
+        "swing": float(rng.uniform(0.2, 0.95)),
+    }
+
+
+def time_render(fn, repeats):
+    fn()  # warm up, also fills the wavetable cache
+    start = time.perf_counter()
+    for _ in range(repeats):
+        audio = fn()
+    return (time.perf_counter() - start) / repeats, audio
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=32)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    for name, num_measures in [("4-bar loop", 4), ("50-bar song", 50)]:
+        output = random_output(rng, num_measures)
+        seconds, audio = time_render(lambda: render(output), args.repeats)
+        audio_seconds = len(audio) / SAMPLE_RATE
+        print(f"{name}: {audio_seconds:.1f}s of audio in {seconds * 1000:.1f} ms, "
+              f"realtime factor {audio_seconds / seconds:.0f}x")
+
+    outputs = [random_output(rng, 4) for _ in range(args.batch)]
+    seconds, audio = time_render(lambda: render_batch(outputs), args.repeats)
+    audio_seconds = sum(len(track) for track in audio) / SAMPLE_RATE
+    print(f"batch of {args.batch} 4-bar loops: {audio_seconds:.1f}s of audio in {seconds * 1000:.1f} ms, "
+          f"realtime factor {audio_seconds / seconds:.0f}x")
+
@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from generation_bank import build, build_ivf, load_generation_bank
+from model.constants import HIDDEN_SIZE
+from output import Output
+from model.lofi2lofi_model import Decoder
+
+# latency of answering from a generation bank (random draw, nearest latent, nearest features) vs live decoding
+# the bank is built here from a randomly initialised decoder unless an existing one is given
+
+
+def time_call(fn, repeats):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bank", nargs="?")
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--ivf_lists", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    decoder = Decoder("cpu")
+    decoder.eval()
+    path = args.bank
+    if path is None:
+        path = os.path.join(tempfile.gettempdir(), "lofi_benchmark_inputs", f"bank_{args.size}")
+        if load_generation_bank(path) is None:
+            build(path, decoder, args.size)
+            build_ivf(path, args.ivf_lists)
+    bank = load_generation_bank(path)
+
+    rng = np.random.default_rng(0)
+    latent = rng.standard_normal(HIDDEN_SIZE).astype(np.float32)
+    exact = set(bank.nearest_latent(latent, 10))
+    print(f"bank of {bank.size} entries at {path}")
+    print(f"random draw             {time_call(lambda: bank.draw(rng), args.repeats):10.1f} us")
+    print(f"nearest latent, exact   {time_call(lambda: bank.entry(bank.nearest_latent(latent)[0]), args.repeats):10.1f} us")
+    if bank.ivf_centroids is not None:
+        for nprobe in (1, 8, 32):
+            recall = len(exact & set(bank.nearest_latent(latent, 10, nprobe))) / 10
+            micros = time_call(lambda: bank.entry(bank.nearest_latent(latent, nprobe=nprobe)[0]), args.repeats)
+            print(f"nearest latent, nprobe {nprobe:2d} {micros:10.1f} us   recall@10 {recall:.2f}")
+    features = np.array([0.5, 0.3, 0.5], dtype=np.float32)
+    print(f"nearest features        {time_call(lambda: bank.entry(bank.nearest_features(features)[0]), args.repeats):10.1f} us")
+    def live():
+        # what lofi2lofi_generate.generate does
+        with torch.no_grad():
+            title, predictions, state = decoder.decode_with_state(torch.randn(1, HIDDEN_SIZE))
+        return Output(title, *predictions).to_json(), state.to_token()
+
+    print(f"live decoding           {time_call(live, 20):10.1f} us")
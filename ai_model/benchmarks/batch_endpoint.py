@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# throughput of /decode/batch against the same videos posted one by one to /decode, through the Flask test
+# client (no network). Every video is treated as lofifiable, so both paths run the decoder for each of them.
+
+
+def post_sequential(client, paths):
+    for path in paths:
+        with open(path, "rb") as f:
+            response = client.post("/decode", data={"video": (f, os.path.basename(path))})
+        if response.status_code != 201:
+            raise RuntimeError(f"/decode returned {response.status_code}: {response.get_data(as_text=True)}")
+
+
+def post_batch(client, paths):
+    files = [open(path, "rb") for path in paths]
+    try:
+        response = client.post("/decode/batch", data={"videos": [(f, os.path.basename(f.name)) for f in files]})
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    finally:
+        for f in files:
+            f.close()
+    failed = [line for line in lines if line["status"] != 201]
+    if response.status_code != 200 or len(lines) != len(paths) or failed:
+        raise RuntimeError(f"/decode/batch returned {response.status_code}: {failed or lines}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--videos", type=int, default=10)
+    parser.add_argument("--seconds", type=int, default=6, help="length of each synthetic video")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--real-clip", action="store_true", help="load the real CLIP checkpoint")
+    args = parser.parse_args()
+    if not args.real_clip:
+        os.environ["LOFI_CLIP_RANDOM_WEIGHTS"] = "1"
+
+    from synthetic import make_video
+    directory = os.path.join(tempfile.gettempdir(), "lofi_benchmark_inputs", "batch")
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for seed in range(args.videos):
+        path = os.path.join(directory, f"video_{args.seconds}s_{seed}.mp4")
+        if not os.path.exists(path):
+            make_video(path, seconds=args.seconds, seed=seed)
+        paths.append(path)
+
+    import main
+    import lofi2lofi_generate
+    from run import AlwaysLofifiable
+    main.admission.enabled = False
+    # repeats post the same bytes, they must not share the analyses of the previous round
+    lofi2lofi_generate.analysis_flights.result_ttl = -1
+    lofi2lofi_generate.svm_model = AlwaysLofifiable(lofi2lofi_generate.svm_model)
+    client = main.app.test_client()
+    # the request log lines go to stderr
+    sys.stderr = open(os.devnull, "w")
+
+    results = {}
+    for name, run in (("sequential /decode", post_sequential), ("/decode/batch", post_batch)):
+        run(client, paths[:2])  # warm up
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            run(client, paths)
+            timings.append(time.perf_counter() - start)
+        results[name] = min(timings)
+
+    print(f"{args.videos} videos of {args.seconds}s, {os.cpu_count()} CPUs, best of {args.repeats}")
+    print("path\tseconds\tvideos/s\tspeedup")
+    baseline = results["sequential /decode"]
+    for name, seconds in results.items():
+        print(f"{name}\t{seconds:.2f}\t{args.videos / seconds:.2f}\t{baseline / seconds:.2f}x")
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# frames/s and memory of the CLIP image encoder: PyTorch eager against the ONNX Runtime exports (fp32 and int8)
+# from clip_export.py. Each backend runs in its own process, so the memory numbers do not mix; the ONNX backends
+# still load the PyTorch model for text encoding, which is part of their peak RSS.
+
+
+def measure(backend, onnx_path, batch_size, repeats):
+    import torch
+    import metrics
+    before_import = metrics.rss_bytes()
+    from clip_service import encode_images, set_image_backend
+    before_load = metrics.rss_bytes()
+    set_image_backend(backend, onnx_path)
+    # memory of the encoder itself: the PyTorch model loaded on import, or the ONNX Runtime session
+    encoder_bytes = metrics.rss_bytes() - (before_import if backend == "torch" else before_load)
+
+    image_input = torch.randn(batch_size, 3, 224, 224, generator=torch.Generator().manual_seed(0))
+    encode_images(image_input)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        encode_images(image_input)
+    seconds = time.perf_counter() - start
+    return {"frames_per_second": batch_size * repeats / seconds, "encoder_mb": encoder_bytes / 1e6,
+            "peak_mb": metrics.peak_rss_bytes() / 1e6}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--onnx", help="fp32 export from clip_export.py, exported to a temporary file if not given")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--real-clip", action="store_true", help="load the real CLIP checkpoint")
+    parser.add_argument("--worker", nargs=2, metavar=("BACKEND", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not args.real_clip:
+        os.environ["LOFI_CLIP_RANDOM_WEIGHTS"] = "1"
+    if args.worker:
+        print(json.dumps(measure(args.worker[0], args.worker[1], args.batch_size, args.repeats)))
+        sys.exit()
+
+    onnx_path = args.onnx
+    if onnx_path is None:
+        onnx_path = os.path.join(tempfile.gettempdir(), "lofi_benchmark_inputs", "clip_image_encoder.onnx")
+        if not os.path.exists(onnx_path):
+            from clip_export import export
+            export(onnx_path, int8=True)
+    from clip_export import int8_path
+
+    runs = [("torch eager", "torch", ""), ("onnx fp32", "onnx", onnx_path), ("onnx int8", "onnx", int8_path(onnx_path))]
+    print(f"batch size {args.batch_size}")
+    print("backend\tframes/s\tspeedup\tencoder MB\tpeak RSS MB")
+    baseline = None
+    for name, backend, path in runs:
+        if backend == "onnx" and not os.path.exists(path):
+            print(f"{name}\tskipped, {path} not found")
+            continue
+        command = [sys.executable, __file__, "--worker", backend, path, "--batch_size", str(args.batch_size),
+                   "--repeats", str(args.repeats)] + (["--real-clip"] if args.real_clip else [])
+        result = json.loads(subprocess.run(command, capture_output=True, text=True, check=True).stdout.splitlines()[-1])
+        baseline = baseline or result["frames_per_second"]
+        print(f"{name}\t{result['frames_per_second']:.1f}\t{result['frames_per_second'] / baseline:.2f}x\t"
+              f"{result['encoder_mb']:.0f}\t{result['peak_mb']:.0f}")
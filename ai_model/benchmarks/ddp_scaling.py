@@ -0,0 +1,85 @@
+import argparse
+import contextlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model"))
+
+# strong scaling of model/train.py with DDP (gloo, CPU): the same synthetic dataset and global batch size,
+# trained for a fixed number of epochs by 1..N local processes. Each process gets cpu_count / N torch threads.
+# efficiency = samples/s with N processes / (N * samples/s with one process)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def worker(rank, world_size, port, dataset_dir, epochs, threads, results):
+    os.environ.update({"MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port), "RANK": str(rank),
+                       "LOCAL_RANK": str(rank), "WORLD_SIZE": str(world_size)})
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    from lofi2lofi_dataset import Lofi2LofiDataset
+    from lofi2lofi_model import Lofi2LofiModel
+    from train import train
+
+    dataset = Lofi2LofiDataset(dataset_dir, sorted(os.listdir(dataset_dir)))
+    model = Lofi2LofiModel()
+    with tempfile.TemporaryDirectory() as out_dir, open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        train(dataset, model, os.path.join(out_dir, "scaling"), patience=epochs + 1, max_epochs=epochs)
+        seconds = time.perf_counter() - start
+    if rank == 0:
+        results.put(seconds)
+    if torch.distributed.is_initialized():
+        torch.distributed.destroy_process_group()
+
+
+def write_dataset(directory, size, seed):
+    from synthetic import make_hooktheory_samples
+    os.makedirs(directory, exist_ok=True)
+    for i, sample in enumerate(make_hooktheory_samples(size, seed)):
+        with open(os.path.join(directory, f"{i:05d}.json"), "w") as f:
+            json.dump(sample, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--samples", type=int, default=1024)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    dataset_dir = os.path.join(tempfile.gettempdir(), "lofi_benchmark_inputs", f"hooktheory_{args.samples}_{args.seed}")
+    if not os.path.isdir(dataset_dir):
+        write_dataset(dataset_dir, args.samples, args.seed)
+    train_samples = int(0.85 * args.samples) * args.epochs
+    cpus = os.cpu_count() or 1
+
+    context = mp.get_context("spawn")
+    print(f"{args.samples} samples, {args.epochs} epochs, {cpus} CPUs")
+    print("processes\tseconds\tsamples/s\tspeedup\tefficiency")
+    baseline = None
+    for world_size in args.processes:
+        results = context.Queue()
+        mp.start_processes(worker, args=(world_size, free_port(), dataset_dir, args.epochs,
+                                         max(1, cpus // world_size), results),
+                           nprocs=world_size, start_method="spawn")
+        seconds = results.get()
+        throughput = train_samples / seconds
+        if baseline is None:
+            baseline = throughput
+        speedup = throughput / baseline
+        print(f"{world_size}\t{seconds:.2f}\t{throughput:.1f}\t{speedup:.2f}x\t{speedup / world_size * 100:.0f}%")
@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# time to first byte and to each event of a streamed /decode against the buffered response, and the work a client
+# saves by disconnecting after the first interim estimate. Through the Flask test client (no network), every video
+# is treated as lofifiable so the full stream ends with the decoder output. CPU seconds are process-wide, so they
+# include the decode and preprocessing threads.
+
+
+def post_buffered(client, path):
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        response = client.post("/decode", data={"video": (f, os.path.basename(path))})
+    if response.status_code != 201:
+        raise RuntimeError(f"/decode returned {response.status_code}: {response.get_data(as_text=True)}")
+    return time.perf_counter() - start
+
+
+def post_streamed(client, path, cancel_after=None):
+    """
+    Seconds from the request to each event of a streamed /decode, and the CPU seconds it took. With cancel_after,
+    the response is closed as soon as that event arrives, the CPU seconds then include stopping the pipeline.
+    """
+    start, cpu_start = time.perf_counter(), time.process_time()
+    with open(path, "rb") as f:
+        response = client.post("/decode", data={"video": (f, os.path.basename(path)), "stream": "1"},
+                               buffered=False)
+    timings = {}
+    try:
+        for line in response.response:
+            event = json.loads(line)
+            # first occurrence of each event, and the frames analyzed by the last progress event
+            timings.setdefault(event["event"], time.perf_counter() - start)
+            if event["event"] == "progress":
+                timings["frames_analyzed"] = event["frames_analyzed"]
+            if event["event"] == cancel_after:
+                break
+    finally:
+        response.close()
+    timings["total"] = time.perf_counter() - start
+    timings["cpu"] = time.process_time() - cpu_start
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=30, help="length of the synthetic video")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--real-clip", action="store_true", help="load the real CLIP checkpoint")
+    args = parser.parse_args()
+    if not args.real_clip:
+        os.environ["LOFI_CLIP_RANDOM_WEIGHTS"] = "1"
+
+    from synthetic import make_video
+    directory = os.path.join(tempfile.gettempdir(), "lofi_benchmark_inputs", "streaming")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"video_{args.seconds}s.mp4")
+    if not os.path.exists(path):
+        make_video(path, seconds=args.seconds, seed=0)
+
+    import main
+    import lofi2lofi_generate
+    from run import AlwaysLofifiable
+    main.admission.enabled = False
+    lofi2lofi_generate.analysis_flights.result_ttl = -1
+    lofi2lofi_generate.svm_model = AlwaysLofifiable(lofi2lofi_generate.svm_model)
+    client = main.app.test_client()
+    # the request log lines go to stderr
+    sys.stderr = open(os.devnull, "w")
+
+    post_buffered(client, path)  # warm up
+    buffered = min(post_buffered(client, path) for _ in range(args.repeats))
+    streamed = min((post_streamed(client, path) for _ in range(args.repeats)), key=lambda t: t["total"])
+    cancelled = min((post_streamed(client, path, "progress") for _ in range(args.repeats)),
+                    key=lambda t: t["total"])
+
+    print(f"{args.seconds}s video, {os.cpu_count()} CPUs, best of {args.repeats}")
+    print(f"buffered /decode\tfirst byte {buffered * 1000:.0f} ms (the whole response)")
+    print("streamed /decode\t" + "\t".join(f"{name} {streamed[name] * 1000:.0f} ms"
+                                             for name in ("accepted", "progress", "verdict", "output", "total")
+                                             if name in streamed))
+    print(f"\tframes analyzed {streamed['frames_analyzed']}, {streamed['cpu']:.2f} CPU s")
+    print(f"cancelled after the first estimate\tclosed after {cancelled['total'] * 1000:.0f} ms, "
+          f"frames analyzed {cancelled['frames_analyzed']}, {cancelled['cpu']:.2f} CPU s "
+          f"({cancelled['cpu'] / streamed['cpu']:.0%} of the full stream)")
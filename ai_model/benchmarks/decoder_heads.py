@@ -0,0 +1,75 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model"))
+
+from model.constants import *
+from model.lofi2lofi_model import Decoder, Lofi2LofiModel
+
+# compares the autoregressive LSTM melody head with the parallel melody head
+# latency is measured on randomly initialised decoders, accuracy needs trained full models (`{name}.pth`)
+
+
+def time_decoder(decoder, num_chords, batch_size, repeats):
+    z = torch.randn(batch_size, HIDDEN_SIZE)
+    with torch.no_grad():
+        decoder(z, num_chords)  # warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            decoder(z, num_chords)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def accuracy(model, dataset_folder):
+    from torch.utils.data import DataLoader
+    from lofi2lofi_dataset import Lofi2LofiDataset
+
+    dataset = Lofi2LofiDataset(dataset_folder, os.listdir(dataset_folder))
+    tp_chords, tp_melodies = [], []
+    model.eval()
+    for data in DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=False):
+        num_chords = data["num_chords"]
+        max_num_chords = num_chords.max()
+        chords_gt = data["chords"][:, :max_num_chords]
+        notes_gt = data["melody_notes"][:, :max_num_chords * NOTES_PER_CHORD]
+        with torch.no_grad():
+            pred_chords, pred_notes, *_ = model(chords_gt, notes_gt, data["tempo"], data["key"], data["mode"],
+                                                data["valence"], data["energy"], num_chords, max_num_chords)
+        mask_chords = torch.arange(max_num_chords).unsqueeze(0) < num_chords.unsqueeze(1)
+        mask_notes = mask_chords.repeat_interleave(NOTES_PER_CHORD, dim=1)
+        tp_chords.extend(torch.masked_select(pred_chords.argmax(dim=2) == chords_gt, mask_chords).tolist())
+        tp_melodies.extend(torch.masked_select(pred_notes.argmax(dim=2) == notes_gt, mask_notes).tolist())
+    return sum(tp_chords) / len(tp_chords) * 100, sum(tp_melodies) / len(tp_melodies) * 100
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[4, 8, 16, 32, MAX_CHORD_LENGTH])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--lstm_model", help="trained lofi2lofi.pth for the accuracy comparison")
+    parser.add_argument("--parallel_model", help="trained lofi2lofi_parallel.pth for the accuracy comparison")
+    parser.add_argument("--dataset", default=os.path.join("model", "dataset", "processed-spotify-all"))
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    decoders = {head: Decoder("cpu", head).eval() for head in MELODY_HEADS}
+
+    print(f"Latency in ms per forward pass (batch size {args.batch_size}):")
+    print("chords\t" + "\t".join(MELODY_HEADS) + "\tspeedup")
+    for num_chords in args.lengths:
+        times = [time_decoder(decoders[head], num_chords, args.batch_size, args.repeats) for head in MELODY_HEADS]
+        print(f"{num_chords}\t" + "\t".join(f"{t:.2f}" for t in times) + f"\t{times[0] / times[1]:.2f}x")
+
+    for head, path in (("lstm", args.lstm_model), ("parallel", args.parallel_model)):
+        if path is None:
+            continue
+        model = Lofi2LofiModel("cpu", head)
+        model.load_state_dict(torch.load(path, map_location="cpu"))
+        chord_acc, melody_acc = accuracy(model, args.dataset)
+        print(f"{head}: chord accuracy {chord_acc:.3f}, melody accuracy {melody_acc:.3f}")
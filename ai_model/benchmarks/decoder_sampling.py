@@ -0,0 +1,62 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model"))
+
+from model.constants import *
+from model.lofi2lofi_model import Decoder, Sampler
+
+# latency of greedy decoding, sampling and beam search against the beam width, how many distinct chord
+# progressions and melodies the beams of a song come out with, and the log-probability of the best beam
+# random weights unless a checkpoint is given, the distinct counts are only meaningful for trained weights
+
+
+def time_call(fn, repeats):
+    with torch.no_grad():
+        fn()  # warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", help="decoder state dict, e.g. checkpoints/lofi2lofi_decoder.pth")
+    parser.add_argument("--melody_head", default=MELODY_HEAD, choices=MELODY_HEADS)
+    parser.add_argument("--num_chords", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--beam_widths", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--diversity", type=float, default=BEAM_DIVERSITY, help="0 is plain beam search")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    decoder = Decoder("cpu", args.melody_head)
+    if args.checkpoint:
+        decoder.load_state_dict(torch.load(args.checkpoint, map_location="cpu"))
+    decoder.eval()
+    z = torch.randn(args.batch_size, HIDDEN_SIZE)
+    sampler = Sampler(temperature=1.0, top_k=5, top_p=0.9, generator=torch.Generator().manual_seed(0))
+
+    print(f"{args.num_chords} chords, batch size {args.batch_size}, {args.melody_head} melody head, "
+          f"{torch.get_num_threads()} threads, beam diversity {args.diversity}")
+    greedy_ms = time_call(lambda: decoder.run(z, args.num_chords), args.repeats)
+    print(f"greedy\t{greedy_ms:.2f} ms")
+    sampled_ms = time_call(lambda: decoder.run(z, args.num_chords, sampler=sampler), args.repeats)
+    print(f"sampled (t=1, k=5, p=0.9)\t{sampled_ms:.2f} ms\t{sampled_ms / greedy_ms:.2f}x greedy")
+
+    print("beams\tms\tx greedy\tms/beam\tdistinct chords\tdistinct melodies\tbest log-prob")
+    for width in args.beam_widths:
+        ms = time_call(lambda: decoder.beam_search(z, args.num_chords, width, args.diversity), args.repeats)
+        with torch.no_grad():
+            (chords, notes, *_), scores, _ = decoder.beam_search(z, args.num_chords, width, args.diversity)
+        distinct_chords = sum(len({tuple(beam.tolist()) for beam in row}) for row in chords) / args.batch_size
+        distinct_notes = sum(len({tuple(beam.tolist()) for beam in row}) for row in notes) / args.batch_size
+        print(f"{width}\t{ms:.2f}\t{ms / greedy_ms:.2f}\t{ms / width:.2f}\t{distinct_chords:.1f}\t"
+              f"{distinct_notes:.1f}\t{scores[:, 0].mean().item():.2f}")
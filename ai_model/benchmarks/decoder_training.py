@@ -0,0 +1,79 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model"))
+
+from model.constants import *
+from model.lofi2lofi_model import Lofi2LofiModel
+
+# training steps/s of Lofi2LofiModel with the eager decoder (Decoder.run) against the fused one (Decoder.run_fused),
+# on the synthetic HookTheory dataset of ddp_scaling.py. Both start from the same seed and see the same batches,
+# so their forward passes agree to float rounding. With teacher forcing below 1 a rounding difference can still
+# flip a ReLU or an argmax that sits on its edge, and the loss curves drift apart from that step on.
+
+
+def train_steps(fused, batches, sampling_rate):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    model = Lofi2LofiModel("cpu", fused=fused)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=LEARNING_RATE, weight_decay=WEIGHT_DECAY)
+    ce_loss = nn.CrossEntropyLoss()
+    losses, seconds = [], []
+    for data in batches:
+        start = time.perf_counter()
+        max_num_chords = data["num_chords"].max()
+        chords_gt = data["chords"][:, :max_num_chords]
+        notes_gt = data["melody_notes"][:, :max_num_chords * NOTES_PER_CHORD]
+        pred_chords, pred_notes, *_, kl = model(chords_gt, notes_gt, data["tempo"], data["key"], data["mode"],
+                                                data["valence"], data["energy"], data["num_chords"], max_num_chords,
+                                                sampling_rate, sampling_rate)
+        loss = ce_loss(pred_chords.permute(0, 2, 1), chords_gt) + ce_loss(pred_notes.permute(0, 2, 1), notes_gt) + kl
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        seconds.append(time.perf_counter() - start)
+        losses.append(loss.item())
+    return losses, seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--sampling_rate", type=float, default=0.5, help="teacher forcing rate of the steps")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from torch.utils.data import DataLoader
+    from ddp_scaling import write_dataset
+    from lofi2lofi_dataset import Lofi2LofiDataset
+
+    samples = args.steps * BATCH_SIZE
+    dataset_dir = os.path.join(tempfile.gettempdir(), "lofi_benchmark_inputs", f"hooktheory_{samples}_{args.seed}")
+    if not os.path.isdir(dataset_dir):
+        write_dataset(dataset_dir, samples, args.seed)
+    dataset = Lofi2LofiDataset(dataset_dir, sorted(os.listdir(dataset_dir)))
+    batches = list(DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=False))
+
+    results = {name: train_steps(fused, batches, args.sampling_rate)
+               for name, fused in (("eager", False), ("fused", True))}
+
+    print(f"{args.steps} steps of batch size {BATCH_SIZE}, teacher forcing rate {args.sampling_rate}, "
+          f"{torch.get_num_threads()} threads")
+    print("decoder\tms/step\tsteps/s\tspeedup\tfinal loss")
+    # the first step includes allocator warm-up
+    baseline = None
+    for name, (losses, seconds) in results.items():
+        step = float(np.median(seconds[1:] or seconds))
+        baseline = baseline or step
+        print(f"{name}\t{step * 1000:.0f}\t{1 / step:.2f}\t{baseline / step:.2f}x\t{losses[-1]:.4f}")
+    difference = max(abs(a - b) for a, b in zip(results["eager"][0], results["fused"][0]))
+    print(f"largest loss difference over the {args.steps} steps: {difference:.2e}, "
+          f"first step: {abs(results['eager'][0][0] - results['fused'][0][0]):.2e}")
@@ -0,0 +1,56 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# embed_video with and without pipelining, next to its decode-only and CLIP-only parts:
+# pipelined wall time should approach max(decode, encode) instead of their sum
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", nargs="?", help="defaults to a synthetic 1080p video")
+    parser.add_argument("--frame_interval", type=int, default=1, help="1 sends every distinct frame to CLIP")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--real-clip", action="store_true", help="load the real CLIP checkpoint")
+    args = parser.parse_args()
+
+    if not args.real_clip:
+        os.environ["LOFI_CLIP_RANDOM_WEIGHTS"] = "1"
+    from clip_service import embed_video, encode_crops
+    from frames import read_crops
+    from synthetic import make_video
+
+    video = args.video
+    if video is None:
+        video = os.path.join(tempfile.gettempdir(), "lofi_benchmark_inputs", "video_1080p_pipeline.mp4")
+        if not os.path.exists(video):
+            os.makedirs(os.path.dirname(video), exist_ok=True)
+            make_video(video, seconds=5, width=1920, height=1080, scenes=40)
+
+    def best_of(fn):
+        fn()  # warm up
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        return min(times) * 1000
+
+    crops = np.stack([crop for _, crop in read_crops(video, args.frame_interval)])
+    decode = best_of(lambda: list(read_crops(video, args.frame_interval)))
+    encode = best_of(lambda: [encode_crops(crops[i:i + 32]) for i in range(0, len(crops), 32)])
+    sequential = best_of(lambda: embed_video(video, args.frame_interval, pipelined=False))
+    pipelined = best_of(lambda: embed_video(video, args.frame_interval, pipelined=True))
+    same = torch.equal(embed_video(video, args.frame_interval, pipelined=False),
+                       embed_video(video, args.frame_interval, pipelined=True))
+
+    print(f"{len(crops)} frames to CLIP, {os.cpu_count()} CPUs, {torch.get_num_threads()} torch threads")
+    print(f"decode only {decode:8.1f} ms   CLIP only {encode:8.1f} ms")
+    print(f"sequential  {sequential:8.1f} ms   pipelined {pipelined:8.1f} ms   "
+          f"(max(decode, CLIP) {max(decode, encode):.1f} ms, identical embeddings: {same})")
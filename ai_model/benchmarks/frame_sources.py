@@ -0,0 +1,47 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from frames import FRAME_SOURCES, read_crops
+from synthetic import make_video
+
+# decode throughput and CPU time of the frame sources on 1080p and 4K synthetic videos
+# (CPU time is process time, so it includes the codec's worker threads)
+
+RESOLUTIONS = {"1080p": (1920, 1080), "4k": (3840, 2160)}
+
+
+def time_source(path, source, repeats):
+    list(read_crops(path, source=source))  # warm up
+    wall = cpu = 0.0
+    for _ in range(repeats):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        crops = list(read_crops(path, source=source))
+        wall += time.perf_counter() - wall_start
+        cpu += time.process_time() - cpu_start
+    return wall / repeats, cpu / repeats, len(crops)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=5)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--sources", nargs="+", default=FRAME_SOURCES, choices=FRAME_SOURCES)
+    parser.add_argument("--input_dir", default=os.path.join(tempfile.gettempdir(), "lofi_benchmark_inputs"))
+    args = parser.parse_args()
+
+    os.makedirs(args.input_dir, exist_ok=True)
+    for name, (width, height) in RESOLUTIONS.items():
+        path = os.path.join(args.input_dir, f"video_{name}_{args.seconds}s.mp4")
+        if not os.path.exists(path):
+            make_video(path, seconds=args.seconds, fps=args.fps, width=width, height=height)
+        num_frames = args.seconds * args.fps
+        for source in args.sources:
+            wall, cpu, kept = time_source(path, source, args.repeats)
+            print(f"{name:6s} {source:7s} {wall * 1000:9.1f} ms wall  {cpu * 1000:9.1f} ms CPU  "
+                  f"{num_frames / wall:7.1f} frames/s decoded  {kept} crops")
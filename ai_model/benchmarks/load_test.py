@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+AI_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Closed-loop load test of several server processes on one host, with and without the thread budget of
+# resources.py. Each process is `main.py worker --socket`; every client keeps one job in flight against one of
+# them. "default" leaves torch, OpenCV and ffmpeg their own thread pools (--default_threads emulates the pools of a
+# host with that many cores, the default is this host's), "budget" divides the cores between the processes and
+# their running requests.
+
+# runs main.py with torch and OpenCV pools of the given size, like their defaults on a host with that many cores
+# (torch does not take more threads than cores from OMP_NUM_THREADS)
+BOOTSTRAP = """
+import runpy, sys, cv2, torch
+threads = int(sys.argv.pop(1))
+if threads:
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+sys.argv[0] = "main.py"
+runpy.run_path("main.py", run_name="__main__")
+"""
+
+
+def wait_ready(path, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.socket(socket.AF_UNIX) as s:
+                s.connect(path)
+                s.sendall(b'{"cmd": "ping"}\n')
+                s.shutdown(socket.SHUT_WR)
+                if s.makefile().readline():
+                    return
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError(f"worker on {path} did not start")
+
+
+def client(path, videos, count, latencies, errors):
+    with socket.socket(socket.AF_UNIX) as s:
+        s.connect(path)
+        reader = s.makefile()
+        for i in range(count):
+            job = {"id": str(i), "cmd": "decode", "video": videos[i % len(videos)]}
+            start = time.perf_counter()
+            s.sendall((json.dumps(job) + "\n").encode())
+            response = json.loads(reader.readline())
+            latencies.append(time.perf_counter() - start)
+            if not response["ok"] and "lofifiable" not in response["error"]:
+                errors.append(response["error"])
+
+
+def run(mode, args, videos):
+    env = dict(os.environ, LOFI_WORKERS=str(args.processes), LOFI_ADMISSION="0")
+    if args.real_clip:
+        env.pop("LOFI_CLIP_RANDOM_WEIGHTS", None)
+    else:
+        env["LOFI_CLIP_RANDOM_WEIGHTS"] = "1"
+    if mode == "default":
+        env["LOFI_THREAD_BUDGET"] = "0"
+        threads = args.default_threads
+    else:
+        env["LOFI_PIN_CPUS"] = "1" if args.pin else "0"
+        threads = 0
+
+    directory = tempfile.mkdtemp(prefix="lofi_load_")
+    workers, paths = [], []
+    try:
+        for index in range(args.processes):
+            path = os.path.join(directory, f"worker{index}.sock")
+            paths.append(path)
+            workers.append(subprocess.Popen(
+                [sys.executable, "-c", BOOTSTRAP, str(threads), "worker", "--socket", path,
+                 "--concurrency", str(args.concurrency)],
+                cwd=AI_MODEL_DIR, env=dict(env, LOFI_WORKER_INDEX=str(index)),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        for path in paths:
+            wait_ready(path)
+
+        latencies, errors = [], []
+        clients = [threading.Thread(target=client, args=(paths[i % len(paths)], videos, args.requests, latencies,
+                                                          errors))
+                   for i in range(args.processes * args.concurrency)]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        seconds = time.perf_counter() - start
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+    if errors:
+        raise RuntimeError(f"{len(errors)} failed jobs, e.g. {errors[0]}")
+    latencies.sort()
+    return {"p50": statistics.median(latencies), "p99": latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+            "throughput": len(latencies) / seconds}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=2, help="server processes on the host")
+    parser.add_argument("--concurrency", type=int, default=2, help="concurrent requests per process")
+    parser.add_argument("--requests", type=int, default=10, help="requests per client")
+    parser.add_argument("--default_threads", type=int, default=os.cpu_count() or 1,
+                        help="threads per library pool in default mode")
+    parser.add_argument("--pin", action="store_true", help="pin each process to its own cores in budget mode")
+    parser.add_argument("--real-clip", action="store_true", help="load the real CLIP checkpoint")
+    args = parser.parse_args()
+
+    from synthetic import make_video
+    directory = os.path.join(tempfile.gettempdir(), "lofi_benchmark_inputs", "load")
+    os.makedirs(directory, exist_ok=True)
+    videos = []
+    for seed in range(4):
+        path = os.path.join(directory, f"video_{seed}.mp4")
+        if not os.path.exists(path):
+            make_video(path, seconds=4, seed=seed)
+        videos.append(path)
+
+    print(f"{args.processes} processes x {args.concurrency} concurrent requests, {os.cpu_count()} CPUs, "
+          f"default pools of {args.default_threads} threads")
+    print("mode\tp50 s\tp99 s\trequests/s")
+    for mode in ("default", "budget"):
+        result = run(mode, args, videos)
+        print(f"{mode}\t{result['p50']:.2f}\t{result['p99']:.2f}\t{result['throughput']:.2f}")
@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+AI_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, AI_MODEL_DIR)
+sys.path.insert(0, os.path.join(AI_MODEL_DIR, "model"))
+
+# Reproducible benchmark suite for the hot paths of the pipeline, offline and on CPU:
+#   python benchmarks/run.py run --out before.json
+#   python benchmarks/run.py run --out after.json
+#   python benchmarks/run.py compare before.json after.json --threshold 0.1
+# Inputs are synthetic and seeded (see synthetic.py). CLIP runs with random weights unless --real-clip is given,
+# which keeps the timings representative without downloading the checkpoint.
+
+
+class Skip(Exception):
+    pass
+
+
+def bench_read_frames(inputs):
+    from frames import read_frames
+    return lambda: sum(1 for _ in read_frames(inputs["video"]))
+
+
+def bench_frame_embeddings(inputs):
+    from svm_frame_predictor import get_frame_embeddings
+    return lambda: get_frame_embeddings(inputs["video"])
+
+
+def bench_svm_score(inputs):
+    import numpy as np
+    import torch
+    from svm_frame_predictor import score_embeddings
+    embeddings = torch.from_numpy(np.random.RandomState(0).randn(100, 512).astype(np.float32))
+    model = load_svm(inputs)
+    return lambda: score_embeddings(model, embeddings)
+
+
+def bench_decoder_forward(inputs, batch_size=1, num_chords=4):
+    import torch
+    from model.constants import HIDDEN_SIZE
+    decoder = load_decoder()
+    z = torch.randn(batch_size, HIDDEN_SIZE, generator=torch.Generator().manual_seed(0))
+
+    def run():
+        with torch.no_grad():
+            decoder(z, num_chords)
+    return run
+
+
+def bench_decoder_beam_search(inputs, beam_width=4, num_chords=4):
+    import torch
+    from model.constants import HIDDEN_SIZE
+    decoder = load_decoder()
+    z = torch.randn(1, HIDDEN_SIZE, generator=torch.Generator().manual_seed(0))
+
+    def run():
+        with torch.no_grad():
+            decoder.beam_search(z, num_chords, beam_width)
+    return run
+
+
+def bench_process_sample(inputs):
+    from Dataset import process_sample
+    samples = inputs["hooktheory"]
+    return lambda: [process_sample(sample) for sample in samples]
+
+
+def bench_output_to_json(inputs):
+    import torch
+    from model.constants import HIDDEN_SIZE
+    from output import Output
+    decoder = load_decoder()
+    z = torch.randn(1, HIDDEN_SIZE, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        title, outputs = decoder.decode(z)
+
+    def run():
+        random.seed(0)  # Output draws the swing
+        return Output(title, *outputs).to_json()
+    return run
+
+
+def bench_render(inputs):
+    from renderer import render
+    rng = random.Random(0)
+    output = {"key": 1, "mode": 1, "bpm": 80, "swing": 0.5, "chords": [rng.randint(1, 7) for _ in range(4)],
+              "melodies": [[rng.randint(0, 14) for _ in range(8)] for _ in range(4)]}
+    return lambda: render(output)
+
+
+def bench_decode_endpoint(inputs):
+    load_svm(inputs)
+    import lofi2lofi_generate
+    import main
+    main.admission.enabled = False
+    # random CLIP weights give arbitrary verdicts, score with the real SVM but always go on to the decoder
+    lofi2lofi_generate.svm_model = AlwaysLofifiable(lofi2lofi_generate.svm_model)
+    client = main.app.test_client()
+
+    def run():
+        with open(inputs["video"], "rb") as f:
+            response = client.post("/decode", data={"video": (f, "video.mp4")})
+        if response.status_code != 201:
+            raise RuntimeError(f"/decode returned {response.status_code}: {response.get_data(as_text=True)}")
+    return run
+
+
+class AlwaysLofifiable:
+    def __init__(self, model):
+        self.model = model
+
+    def predict_proba(self, x):
+        probs = self.model.predict_proba(x)
+        probs[:, 0], probs[:, 1] = 0, 1
+        return probs
+
+
+BENCHMARKS = {
+    "read_frames": bench_read_frames,
+    "get_frame_embeddings": bench_frame_embeddings,
+    "svm_score_100_frames": bench_svm_score,
+    "decoder_forward_b1": bench_decoder_forward,
+    "decoder_forward_b32": lambda inputs: bench_decoder_forward(inputs, batch_size=32),
+    "decoder_beam_search_w4": bench_decoder_beam_search,
+    "process_sample_200": bench_process_sample,
+    "output_to_json": bench_output_to_json,
+    "render_4_bars": bench_render,
+    "decode_endpoint": bench_decode_endpoint,
+}
+
+
+def load_svm(inputs):
+    from svm_frame_predictor import load_svm_model
+    try:
+        return load_svm_model(os.path.join(AI_MODEL_DIR, "checkpoints"))
+    except FileNotFoundError as e:
+        raise Skip(str(e))
+
+
+def load_decoder():
+    import torch
+    from model.lofi2lofi_model import Decoder
+    torch.manual_seed(0)
+    decoder = Decoder("cpu")
+    decoder.eval()
+    return decoder
+
+
+def time_benchmark(fn, repeats, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        "median_ms": round(statistics.median(times), 4),
+        "mean_ms": round(statistics.mean(times), 4),
+        "min_ms": round(times[0], 4),
+        "p90_ms": round(times[int(0.9 * (len(times) - 1))], 4),
+        "stdev_ms": round(statistics.stdev(times), 4) if len(times) > 1 else 0.0,
+        "repeats": repeats,
+    }
+
+
+def environment():
+    import torch
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=AI_MODEL_DIR, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"python": platform.python_version(), "torch": torch.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(), "torch_threads": torch.get_num_threads(),
+            "commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def run_command(args):
+    args.out, args.input_dir = os.path.abspath(args.out), os.path.abspath(args.input_dir)
+    if not args.real_clip:
+        os.environ["LOFI_CLIP_RANDOM_WEIGHTS"] = "1"
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""  # CPU only, so results are comparable across machines
+    os.chdir(AI_MODEL_DIR)  # checkpoints are loaded relative to ai_model
+
+    import torch
+    from synthetic import make_inputs
+    torch.manual_seed(args.seed)
+    inputs = make_inputs(args.input_dir, args.seed)
+
+    names = args.only or list(BENCHMARKS)
+    results = {}
+    for name in names:
+        try:
+            fn = BENCHMARKS[name](inputs)
+            results[name] = time_benchmark(fn, args.repeats, args.warmup)
+            print(f"{name:24s} median {results[name]['median_ms']:10.3f} ms   "
+                  f"min {results[name]['min_ms']:10.3f} ms", file=sys.stderr)
+        except Skip as e:
+            results[name] = {"skipped": str(e)}
+            print(f"{name:24s} skipped: {e}", file=sys.stderr)
+
+    with open(args.out, "w") as f:
+        json.dump({"environment": environment(), "seed": args.seed, "results": results}, f, indent=2)
+    print(f"Wrote {args.out}", file=sys.stderr)
+
+
+def compare_command(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+
+    regressions = []
+    print(f"{'benchmark':24s} {'baseline ms':>12s} {'current ms':>12s} {'change':>8s}")
+    for name in sorted(set(baseline) & set(current)):
+        if "median_ms" not in baseline[name] or "median_ms" not in current[name]:
+            continue
+        before, after = baseline[name]["median_ms"], current[name]["median_ms"]
+        change = after / before - 1 if before > 0 else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif change < -args.threshold:
+            flag = "  faster"
+        print(f"{name:24s} {before:12.3f} {after:12.3f} {change * 100:+7.1f}%{flag}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold * 100:.0f}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline hot paths on synthetic inputs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks and write the results as JSON")
+    run_parser.add_argument("--out", default="benchmark_results.json")
+    run_parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS))
+    run_parser.add_argument("--repeats", type=int, default=10)
+    run_parser.add_argument("--warmup", type=int, default=1)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--input_dir", default=os.path.join(tempfile.gettempdir(), "lofi_benchmark_inputs"))
+    run_parser.add_argument("--real-clip", action="store_true", help="load the real CLIP checkpoint")
+
+    compare_parser = subparsers.add_parser("compare", help="flag benchmarks that got slower than the baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown to flag, 0.1 = 10%%")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run_command(args)
+    else:
+        compare_command(args)
@@ -0,0 +1,47 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from svm_fast import FAST_MODEL_NAME, load_fast_svm
+
+# compares load time and predict_proba latency of the joblib model with the NumPy export from export_svm.py
+
+
+def time_call(fn, repeats):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", nargs="?", default="checkpoints")
+    parser.add_argument("--frames", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    fast_model = load_fast_svm(os.path.join(args.model_dir, FAST_MODEL_NAME))
+    fast_load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    import joblib
+    model = joblib.load(os.path.join(args.model_dir, "model.pkl"))
+    joblib_load = time.perf_counter() - start
+    print(f"Load time: joblib + sklearn {joblib_load * 1000:.1f} ms, NumPy export {fast_load * 1000:.1f} ms")
+
+    rng = np.random.RandomState(0)
+    print("frames\tjoblib ms\tnumpy ms\tspeedup\tmax abs diff")
+    for num_frames in args.frames:
+        X = rng.randn(num_frames, model.n_features_in_).astype(np.float32)
+        joblib_ms = time_call(lambda: model.predict_proba(X), args.repeats)
+        fast_ms = time_call(lambda: fast_model.predict_proba(X), args.repeats)
+        max_diff = np.abs(model.predict_proba(X) - fast_model.predict_proba(X)).max()
+        print(f"{num_frames}\t{joblib_ms:.3f}\t{fast_ms:.3f}\t{joblib_ms / fast_ms:.2f}x\t{max_diff:.1e}")
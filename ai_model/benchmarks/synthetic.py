@@ -0,0 +1,81 @@
+import os
+import random
+
+import cv2
+import numpy as np
+
+# deterministic synthetic inputs for the benchmarks: the same seed always gives the same bytes
+
+KEYS = ["C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb", "B"]
+
+
+def make_video(path, seconds=10, fps=30, width=640, height=360, scenes=5, seed=0):
+    """
+    Write an mp4 of `scenes` equally long shots. Each shot is a random colour gradient with a square moving
+    across it, so consecutive frames differ slightly (pixel filter drops some) and shots differ a lot.
+    """
+    rng = np.random.RandomState(seed)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    if not writer.isOpened():
+        raise IOError(f"Cannot write video file: {path}")
+
+    num_frames = seconds * fps
+    frames_per_scene = max(1, num_frames // scenes)
+    ramp = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    square = max(8, height // 6)
+    try:
+        for scene_start in range(0, num_frames, frames_per_scene):
+            left, right = rng.randint(0, 256, (2, 3)).astype(np.float32)
+            background = (left * (1 - ramp) + right * ramp).repeat(height, axis=0).astype(np.uint8)
+            color = tuple(int(c) for c in rng.randint(0, 256, 3))
+            y = rng.randint(0, height - square)
+            for i in range(min(frames_per_scene, num_frames - scene_start)):
+                frame = background.copy()
+                x = (i * 4) % (width - square)
+                frame[y:y + square, x:x + square] = color
+                writer.write(frame)
+    finally:
+        writer.release()
+    return path
+
+
+def make_hooktheory_sample(rng, num_measures=8, beats_per_measure=4):
+    """One song section in the format of dataset/processed-spotify-all, see Dataset.process_sample."""
+    chords = []
+    for measure in range(num_measures):
+        on = float(measure * beats_per_measure)
+        chords.append({"sd": str(rng.randint(1, 7)), "isRest": rng.random() < 0.05,
+                       "event_on": on, "event_off": on + beats_per_measure, "event_duration": float(beats_per_measure)})
+
+    notes = []
+    beat = 0.0
+    while beat < num_measures * beats_per_measure:
+        duration = rng.choice([0.25, 0.5, 0.5, 1.0, 2.0])
+        notes.append({"scale_degree": str(rng.randint(1, 7)), "octave": str(rng.randint(-1, 1)),
+                      "isRest": rng.random() < 0.1, "event_on": beat, "event_off": beat + duration,
+                      "event_duration": duration})
+        beat += duration
+    notes[0]["isRest"] = False  # process_sample needs at least one sounding note
+
+    return {
+        "version": "1.2",
+        "metadata": {"title": "synthetic", "beats_in_measure": str(beats_per_measure),
+                     "BPM": str(rng.randint(60, 180)), "key": rng.choice(KEYS),
+                     "mode": rng.choice([None, "1", "2", "3", "4", "5", "6", "7"])},
+        "audio_features": {"energy": round(rng.random(), 3), "valence": round(rng.random(), 3)},
+        "tracks": {"chord": chords, "melody": notes},
+    }
+
+
+def make_hooktheory_samples(count, seed=0):
+    rng = random.Random(seed)
+    return [make_hooktheory_sample(rng, num_measures=rng.randint(2, 12)) for _ in range(count)]
+
+
+def make_inputs(directory, seed=0):
+    """All benchmark inputs, written to (or reused from) directory."""
+    os.makedirs(directory, exist_ok=True)
+    video_path = os.path.join(directory, f"video_{seed}.mp4")
+    if not os.path.exists(video_path):
+        make_video(video_path, seed=seed)
+    return {"video": video_path, "hooktheory": make_hooktheory_samples(200, seed)}
@@ -0,0 +1,328 @@
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from frames import find_videos, read_crops, FRAME_INTERVAL, PIXEL_SIM_THRESHOLD, THUMBNAIL_SIZE
+from metrics import cascade_total, record_stage, stage
+from resources import budget
+
+# A cheap first stage in front of CLIP for the lofifiability verdict.
+#
+# The student is a small CNN on the 64x64 thumbnails of the frames the pixel filter keeps, distilled from the
+# teacher (CLIP + SVM): it learns the SVM's P(lofiable) of every frame. A video is scored by the mean student
+# probability of its frames; when that mean is outside the uncertain band (low, high) the student's verdict is
+# final, otherwise the video escalates to the full CLIP pipeline, which reuses the crops the student scored. The
+# band is calibrated on held-out videos when training, and stored in the checkpoint with the weights. It takes
+# min_held_out_videos(target agreement) held-out videos (98 at 99%) before the student can be trusted at all,
+# training with fewer fails rather than save a student that escalates every video.
+#
+#   python cascade.py train <video dir> [--out checkpoints/lofi_student.pth]   labels come from the local teacher
+#   python cascade.py report checkpoints/lofi_student.pth <video dir>          escalation, agreement, latency
+#   LOFI_CASCADE=checkpoints/lofi_student.pth python main.py                    serve with the cascade
+
+DEFAULT_STUDENT_PATH = os.path.join("checkpoints", "lofi_student.pth")
+DEFAULT_LOW = 0.2
+DEFAULT_HIGH = 0.8
+# agreement with the teacher the calibrated band must keep on the videos the student decides
+TARGET_AGREEMENT = 0.99
+STUDENT_BATCH_SIZE = 64
+# crops of the student's pass held for an escalation, so that CLIP does not decode the video again (256 crops are
+# 38 MB); a video with more distinct frames is decoded a second time
+ESCALATION_CROPS = 256
+THUMBNAIL_MEAN = torch.tensor([0.5, 0.5, 0.5]).view(1, 3, 1, 1)
+THUMBNAIL_STD = torch.tensor([0.25, 0.25, 0.25]).view(1, 3, 1, 1)
+
+
+class StudentNet(nn.Module):
+    """Frame logit of P(lofiable) from a normalized (N, 3, 64, 64) thumbnail batch. About 25k parameters."""
+
+    def __init__(self, width=16):
+        super().__init__()
+        self.features = nn.Sequential(
+            nn.Conv2d(3, width, 3, stride=2, padding=1),
+            nn.BatchNorm2d(width),
+            nn.ReLU(),
+            nn.Conv2d(width, 2 * width, 3, stride=2, padding=1),
+            nn.BatchNorm2d(2 * width),
+            nn.ReLU(),
+            nn.Conv2d(2 * width, 4 * width, 3, stride=2, padding=1),
+            nn.BatchNorm2d(4 * width),
+            nn.ReLU(),
+            nn.AdaptiveAvgPool2d(1),
+        )
+        self.head = nn.Linear(4 * width, 1)
+
+    def forward(self, x):
+        return self.head(self.features(x).flatten(1)).squeeze(1)
+
+
+def thumbnails(crops):
+    """(N, 224, 224, 3) uint8 crops from frames.read_crops as normalized (N, 3, 64, 64) student input."""
+    image_input = torch.from_numpy(np.require(crops, requirements=["C", "W"])).permute(0, 3, 1, 2).float().div_(255)
+    image_input = F.interpolate(image_input, size=(THUMBNAIL_SIZE, THUMBNAIL_SIZE), mode="area")
+    return (image_input - THUMBNAIL_MEAN) / THUMBNAIL_STD
+
+
+class Student:
+    """A trained StudentNet with its uncertain band, as saved by train()."""
+
+    def __init__(self, net, low=DEFAULT_LOW, high=DEFAULT_HIGH):
+        self.net = net.eval()
+        self.low = low
+        self.high = high
+
+    @classmethod
+    def load(cls, path):
+        checkpoint = torch.load(path, map_location="cpu")
+        net = StudentNet(checkpoint.get("width", 16))
+        net.load_state_dict(checkpoint["state_dict"])
+        return cls(net, checkpoint.get("low", DEFAULT_LOW), checkpoint.get("high", DEFAULT_HIGH))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        torch.save({"state_dict": self.net.state_dict(), "width": self.net.head.in_features // 4,
+                    "low": self.low, "high": self.high}, path)
+
+    def frame_probs(self, crops):
+        """Student P(lofiable) of each of (N, 224, 224, 3) uint8 crops, as a numpy array."""
+        with budget.torch_threads("student_score"), torch.no_grad():
+            return torch.sigmoid(self.net(thumbnails(crops))).numpy()
+
+    def uncertain(self, avg_prob):
+        return self.low < avg_prob < self.high
+
+
+def student_result(student, video_path, method='mean', max_frame_probs=None, frame_interval=FRAME_INTERVAL,
+                   pixel_thresh=PIXEL_SIM_THRESHOLD, keep_crops=ESCALATION_CROPS):
+    """
+    (the student's verdict of a video in the format of predict_per_frame_with_final, None if no frame was kept;
+    the crops it scored, or None if there were more than keep_crops). Crops are scored in batches as they are
+    decoded, so memory stays flat up to the keep_crops held for an escalation.
+    """
+    from svm_frame_predictor import FrameScoreAggregator
+    aggregator = FrameScoreAggregator(max_frame_probs)
+    batch = []
+    kept = []
+    student_seconds = 0.0
+    try:
+        for _, crop in read_crops(video_path, frame_interval, pixel_thresh):
+            batch.append(crop)
+            if kept is not None:
+                kept.append(crop)
+                if len(kept) > keep_crops:
+                    kept = None
+            if len(batch) == STUDENT_BATCH_SIZE:
+                start = time.perf_counter()
+                aggregator.update(student.frame_probs(np.stack(batch)))
+                student_seconds += time.perf_counter() - start
+                batch = []
+        if batch:
+            start = time.perf_counter()
+            aggregator.update(student.frame_probs(np.stack(batch)))
+            student_seconds += time.perf_counter() - start
+    finally:
+        record_stage("student_score", student_seconds)
+    return (aggregator.result(method) if aggregator.count else None), kept
+
+
+def cascade_predict(student, svm_model, video_path, method='mean', max_frame_probs=None, batcher=None):
+    """
+    Verdict of a video from the student when it is confident, from the CLIP + SVM pipeline otherwise.
+    The result has the keys of predict_per_frame_with_final plus "stage" ("student" or "clip"); None if the
+    video has no meaningful frame, and raises if it fails to be analyzed (see predict_video). CLIP embeds the
+    crops the student scored, only a video with more than ESCALATION_CROPS of them is decoded a second time.
+    batcher: the ClipBatcher an escalation embeds through, see predict_video.
+    """
+    from svm_frame_predictor import predict_video
+    result, crops = student_result(student, video_path, method, max_frame_probs)
+    if result is not None and not student.uncertain(result["avg_prob"]):
+        cascade_total.inc(("student",))
+        return dict(result, stage="student")
+
+    cascade_total.inc(("escalated",))
+    with stage("cascade_escalation"):
+        result = predict_video(svm_model, video_path, method, max_frame_probs, crops, batcher)
+    return dict(result, stage="clip") if result is not None else None
+
+
+def teacher_labels(svm_model, video_path):
+    """(thumbnails (N, 3, 64, 64), teacher P(lofiable) (N,)) of the frames the pixel filter keeps."""
+    from clip_service import encode_crops, CLIP_BATCH_SIZE
+    from svm_frame_predictor import score_frames
+    inputs, probs = [], []
+    crops = [crop for _, crop in read_crops(video_path)]
+    for i in range(0, len(crops), CLIP_BATCH_SIZE):
+        batch = np.stack(crops[i:i + CLIP_BATCH_SIZE])
+        inputs.append(thumbnails(batch))
+        probs.append(torch.from_numpy(score_frames(svm_model, encode_crops(batch))).float())
+    if not inputs:
+        return None
+    return torch.cat(inputs), torch.cat(probs)
+
+
+def calibrate_band(student_probs, teacher_labels, target_agreement=TARGET_AGREEMENT):
+    """
+    The narrowest band (low, high) around 0.5 in which the videos the student decides, those outside the band,
+    agree with the teacher at least target_agreement of the time, so that as few videos as possible escalate.
+    Agreement is Laplace-smoothed, (agreed + 1) / (decided + 2), so a handful of lucky held-out videos does not
+    make the student trusted: with fewer than min_held_out_videos(target_agreement) videos the band widens to
+    (-inf, inf) and everything escalates.
+    """
+    student_probs = np.asarray(student_probs)
+    teacher_labels = np.asarray(teacher_labels)
+    for margin in np.arange(0.0, 0.5, 0.01):
+        low, high = 0.5 - margin, 0.5 + margin
+        confident = (student_probs <= low) | (student_probs >= high)
+        agreed = ((student_probs[confident] >= 0.5) == teacher_labels[confident]).sum()
+        if (agreed + 1) / (confident.sum() + 2) >= target_agreement:
+            return float(low), float(high)
+    # the student is never trusted, not even at a mean of exactly 0 or 1
+    return -math.inf, math.inf
+
+
+def min_held_out_videos(target_agreement=TARGET_AGREEMENT):
+    """Held-out videos that must all agree with the teacher before calibrate_band trusts the student at all."""
+    # smallest n with (n + 1) / (n + 2) >= target_agreement
+    return math.ceil((2 * target_agreement - 1) / (1 - target_agreement) - 1e-9)
+
+
+def train(video_dir, out_path=DEFAULT_STUDENT_PATH, model_dir="checkpoints", epochs=20, val_fraction=0.2,
+          target_agreement=TARGET_AGREEMENT, seed=0):
+    """
+    Distill the teacher into a StudentNet on the videos of video_dir. Frames are labelled with the teacher's
+    soft P(lofiable); the band is then calibrated on held-out videos. Returns the Student.
+    Raises ValueError when there are too few held-out videos for the band to ever trust the student, or when no
+    band does, instead of saving a student that escalates every video.
+    """
+    from svm_frame_predictor import load_svm_model
+    svm_model = load_svm_model(model_dir)
+    videos = find_videos(video_dir)
+    if len(videos) < 2:
+        raise FileNotFoundError(f"Need at least 2 videos in {video_dir}, found {len(videos)}")
+    random.Random(seed).shuffle(videos)
+    num_val = max(1, int(len(videos) * val_fraction))
+    min_val = min_held_out_videos(target_agreement)
+    if num_val < min_val:
+        raise ValueError(f"{num_val} held-out videos of {len(videos)} in {video_dir}: the band needs at least "
+                         f"{min_val} to trust the student at {target_agreement:.0%} agreement, add videos or "
+                         f"raise --val_fraction")
+    train_videos, val_videos = videos[num_val:], videos[:num_val]
+
+    print(f"Labelling {len(videos)} videos with CLIP + SVM...")
+    labelled = {}
+    for video in videos:
+        labels = teacher_labels(svm_model, video)
+        if labels is not None:
+            labelled[video] = labels
+    train_labelled = [labelled[v] for v in train_videos if v in labelled]
+    if not train_labelled:
+        raise ValueError(f"None of the {len(train_videos)} training videos has a frame the teacher could label")
+    inputs = torch.cat([frames for frames, _ in train_labelled])
+    targets = torch.cat([probs for _, probs in train_labelled])
+
+    torch.manual_seed(seed)
+    net = StudentNet()
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-3)
+    for epoch in range(epochs):
+        net.train()
+        permutation = torch.randperm(len(inputs))
+        total = 0.0
+        for i in range(0, len(inputs), STUDENT_BATCH_SIZE):
+            index = permutation[i:i + STUDENT_BATCH_SIZE]
+            loss = F.binary_cross_entropy_with_logits(net(inputs[index]), targets[index])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(index)
+        print(f"Epoch {epoch + 1}/{epochs}: distillation loss {total / len(inputs):.4f}")
+
+    student = Student(net)
+    val = [v for v in val_videos if v in labelled]
+    with torch.no_grad():
+        student_probs = [torch.sigmoid(net(labelled[v][0])).mean().item() for v in val]
+    teacher_verdicts = [int(labelled[v][1].mean().item() >= 0.5) for v in val]
+    student.low, student.high = calibrate_band(student_probs, teacher_verdicts, target_agreement)
+    if math.isinf(student.low):
+        raise ValueError(f"No band keeps {target_agreement:.0%} agreement with the teacher on the {len(val)} "
+                         f"held-out videos that could be labelled, the student would escalate every video")
+    print(f"Uncertain band ({student.low:.2f}, {student.high:.2f}) from {len(val)} held-out videos")
+    student.save(out_path)
+    print(f"Saved {out_path}")
+    return student
+
+
+def report(student_path, video_dir, model_dir="checkpoints"):
+    """Run the full pipeline and the cascade on every video: escalation rate, agreement and latency."""
+    from svm_frame_predictor import load_svm_model, predict_per_frame_with_final
+    svm_model = load_svm_model(model_dir)
+    student = Student.load(student_path)
+    videos = find_videos(video_dir)
+    if not videos:
+        raise FileNotFoundError(f"No videos in {video_dir}")
+
+    escalated = agreed = compared = 0
+    full_seconds = cascade_seconds = 0.0
+    for video in videos:
+        start = time.perf_counter()
+        full = predict_per_frame_with_final(svm_model, [video]).get(video)
+        seconds = time.perf_counter() - start
+        # a video the full pipeline skips has no verdict to compare with
+        if full is None:
+            continue
+        start = time.perf_counter()
+        result = cascade_predict(student, svm_model, video)
+        full_seconds += seconds
+        cascade_seconds += time.perf_counter() - start
+        if result is None:
+            continue
+        compared += 1
+        escalated += result["stage"] == "clip"
+        agreed += result["is_lofifiable"] == full["is_lofifiable"]
+        print(f"{video}: full {full['is_lofifiable']} ({full['avg_prob']:.3f}), "
+              f"cascade {result['is_lofifiable']} ({result['avg_prob']:.3f}) by {result['stage']}")
+
+    if not compared:
+        print("No video could be analyzed")
+        return None
+    summary = {"videos": compared, "escalation_rate": escalated / compared, "agreement": agreed / compared,
+               "full_seconds": full_seconds / compared, "cascade_seconds": cascade_seconds / compared}
+    summary["saved_seconds"] = summary["full_seconds"] - summary["cascade_seconds"]
+    print(f"{compared} videos, band ({student.low:.2f}, {student.high:.2f}): escalation rate "
+          f"{summary['escalation_rate']:.1%}, agreement with the full pipeline {summary['agreement']:.1%}")
+    print(f"Average latency {summary['full_seconds']:.2f}s full, {summary['cascade_seconds']:.2f}s cascade, "
+          f"{summary['saved_seconds']:.2f}s saved per video")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distilled student cascade in front of CLIP")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train")
+    train_parser.add_argument("video_dir", help="local videos, labelled by the CLIP + SVM teacher")
+    train_parser.add_argument("--out", default=DEFAULT_STUDENT_PATH)
+    train_parser.add_argument("--model_dir", default="checkpoints")
+    train_parser.add_argument("--epochs", type=int, default=20)
+    train_parser.add_argument("--val_fraction", type=float, default=0.2)
+    train_parser.add_argument("--target_agreement", type=float, default=TARGET_AGREEMENT)
+    train_parser.add_argument("--seed", type=int, default=0)
+
+    report_parser = subparsers.add_parser("report")
+    report_parser.add_argument("path")
+    report_parser.add_argument("video_dir")
+    report_parser.add_argument("--model_dir", default="checkpoints")
+
+    args = parser.parse_args()
+    if args.command == "train":
+        train(args.video_dir, args.out, args.model_dir, args.epochs, args.val_fraction, args.target_agreement,
+              args.seed)
+    elif report(args.path, args.video_dir, args.model_dir) is None:
+        sys.exit(1)
@@ -0,0 +1,110 @@
+import argparse
+import copy
+import os
+import sys
+
+import numpy as np
+import torch
+
+from clip_service import clip_model, dedup_embeddings, encode_crops, set_image_backend, DEFAULT_ONNX_PATH
+from frames import find_videos, read_crops, CROP_SIZE
+
+# Export of the CLIP vision tower for CPU serving with ONNX Runtime (LOFI_CLIP_BACKEND=onnx):
+#   python clip_export.py export checkpoints/clip_image_encoder.onnx --int8
+#   python clip_export.py check checkpoints/clip_image_encoder.int8.onnx samples/
+# export writes the fp32 model and, with --int8, a dynamically quantized copy next to it (int8 weights of the
+# MatMul/Gemm layers, activations quantized on the fly). check compares an export with the PyTorch encoder on
+# the frames of a directory of videos: per-frame embedding cosine and the SVM verdict of every video.
+
+MIN_COSINE = 0.99
+
+
+class ImageEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        return self.model.encode_image(image).float()
+
+
+def int8_path(path):
+    root, ext = os.path.splitext(path)
+    return f"{root}.int8{ext}"
+
+
+def export(path, int8=False, opset=17):
+    """Write the image encoder as ONNX with a dynamic batch axis, and its int8 version with int8. Returns the paths."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    encoder = ImageEncoder(copy.deepcopy(clip_model).float().cpu()).eval()
+    # the TorchScript-based exporter handles the CLIP ViT without onnxscript. Not under no_grad: that switches
+    # nn.MultiheadAttention to its fused fast path, which has no ONNX export
+    torch.onnx.export(encoder, torch.randn(2, 3, CROP_SIZE, CROP_SIZE), path, input_names=["image"],
+                      output_names=["embedding"], dynamic_axes={"image": {0: "batch"}, "embedding": {0: "batch"}},
+                      opset_version=opset, dynamo=False)
+    paths = [path]
+    if int8:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(path, int8_path(path), weight_type=QuantType.QInt8)
+        paths.append(int8_path(path))
+    return paths
+
+
+def check(onnx_path, video_dir, model_dir="checkpoints", min_cosine=MIN_COSINE):
+    """
+    Parity of an export with the PyTorch encoder. Both encode the same crops of every video, the SVM then
+    scores each backend's deduplicated embeddings. Returns True if every frame reaches min_cosine and every
+    verdict matches.
+    """
+    from svm_frame_predictor import load_svm_model, score_embeddings
+    svm_model = load_svm_model(model_dir)
+    videos = find_videos(video_dir)
+    if not videos:
+        raise FileNotFoundError(f"No videos in {video_dir}")
+
+    cosines = []
+    mismatches = []
+    for video in videos:
+        crops = np.stack([crop for _, crop in read_crops(video)])
+        set_image_backend("torch")
+        reference = torch.cat([encode_crops(crops[i:i + 32]) for i in range(0, len(crops), 32)])
+        set_image_backend("onnx", onnx_path)
+        exported = torch.cat([encode_crops(crops[i:i + 32]) for i in range(0, len(crops), 32)])
+        cosine = torch.nn.functional.cosine_similarity(reference, exported, dim=1)
+        cosines.append(cosine)
+
+        verdicts = [score_embeddings(svm_model, dedup_embeddings(embeddings))["is_lofifiable"]
+                    for embeddings in (reference, exported)]
+        if verdicts[0] != verdicts[1]:
+            mismatches.append(video)
+        print(f"{video}: {len(crops)} frames, min cosine {cosine.min():.4f}, verdict {verdicts[0]} / {verdicts[1]}")
+    set_image_backend("torch")
+
+    cosines = torch.cat(cosines)
+    passed = cosines.min().item() >= min_cosine and not mismatches
+    print(f"{len(videos)} videos, {len(cosines)} frames: cosine min {cosines.min():.4f} mean {cosines.mean():.4f} "
+          f"(need {min_cosine}), {len(mismatches)} verdict mismatches -> {'PASS' if passed else 'FAIL'}")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the CLIP image encoder to ONNX and check it")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("path", nargs="?", default=DEFAULT_ONNX_PATH.replace(".int8", ""))
+    export_parser.add_argument("--int8", action="store_true", help="also write a dynamically quantized int8 model")
+    export_parser.add_argument("--opset", type=int, default=17)
+
+    check_parser = subparsers.add_parser("check")
+    check_parser.add_argument("path")
+    check_parser.add_argument("video_dir", help="local validation videos")
+    check_parser.add_argument("--model_dir", default="checkpoints")
+    check_parser.add_argument("--min_cosine", type=float, default=MIN_COSINE)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        for path in export(args.path, args.int8, args.opset):
+            print(f"Wrote {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+    elif not check(args.path, args.video_dir, args.model_dir, args.min_cosine):
+        sys.exit(1)
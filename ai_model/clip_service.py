@@ -0,0 +1,393 @@
+import collections
+import contextvars
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import torch
+import clip
+
+from frames import frame_reader, read_crops, FRAME_INTERVAL, PIXEL_SIM_THRESHOLD
+from metrics import count_frames, record_stage, stage
+from resources import budget
+
+# One CLIP backbone shared by the SVM frame predictor, the LofiClassifier and the label features
+device = "cuda" if torch.cuda.is_available() else "cpu"
+CLIP_MODEL_NAME = "ViT-B/32"
+if os.environ.get("LOFI_CLIP_RANDOM_WEIGHTS"):
+    # the ViT-B/32 architecture with seeded random weights, so benchmarks run offline without the checkpoint:
+    # timings are representative, embeddings and verdicts are not
+    from clip.clip import _transform
+    from clip.model import CLIP
+    torch.manual_seed(0)
+    clip_model = CLIP(512, 224, 12, 768, 32, 77, 49408, 512, 8, 12).to(device).eval()
+    preprocess = _transform(224)
+    # nothing computed from these weights may be cached as CLIP's
+    CLIP_WEIGHTS_VERSION = None
+else:
+    clip_model, preprocess = clip.load(CLIP_MODEL_NAME, device=device)
+    # SHA-256 of the checkpoint, clip.load checks the file against it
+    CLIP_WEIGHTS_VERSION = clip.clip._MODELS[CLIP_MODEL_NAME].split("/")[-2]
+
+# image encoder backends: "torch" runs clip_model eagerly, "onnx" runs the vision tower exported by clip_export.py
+# with ONNX Runtime (optionally int8-quantized). LOFI_CLIP_BACKEND / LOFI_CLIP_ONNX pick one at startup.
+CLIP_BACKENDS = ["torch", "onnx"]
+DEFAULT_ONNX_PATH = os.path.join("checkpoints", "clip_image_encoder.int8.onnx")
+image_session = None
+
+EMBED_SIM_THRESHOLD = 0.97
+# kept frames a new frame is compared against for dedup, 2 MB of embeddings however long the video is
+DEDUP_RESERVOIR_SIZE = 1024
+CLIP_BATCH_SIZE = 32
+CLIP_MEAN = torch.tensor([0.48145466, 0.4578275, 0.40821073]).view(1, 3, 1, 1)
+CLIP_STD = torch.tensor([0.26862954, 0.26130258, 0.27577711]).view(1, 3, 1, 1)
+
+# embed_video pipelining: frames decoded ahead of CLIP (bounds memory), and threads cropping/normalizing frames
+PIPELINE_QUEUE_SIZE = 2 * CLIP_BATCH_SIZE
+PREPROCESS_THREADS = 2
+# ClipBatcher.distinct_embeddings: chunks of one video submitted and not yet embedded, bounds its crops in memory
+BATCHER_WINDOW = 2
+preprocess_pool = ThreadPoolExecutor(PREPROCESS_THREADS, thread_name_prefix="clip-preprocess")
+
+
+def normalize_crops(crops):
+    """(N, 224, 224, 3) uint8 crops from frames.read_crops as the normalized (N, 3, 224, 224) CLIP image input."""
+    # crops straight from PIL are read-only, np.require copies those
+    image_input = torch.from_numpy(np.require(crops, requirements=["C", "W"])).permute(0, 3, 1, 2).float().div_(255)
+    return (image_input - CLIP_MEAN) / CLIP_STD
+
+
+def set_image_backend(backend, onnx_path=DEFAULT_ONNX_PATH):
+    """Encode images with the PyTorch model ("torch") or with the ONNX export at onnx_path ("onnx")."""
+    global image_session
+    if backend == "torch":
+        image_session = None
+    elif backend == "onnx":
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        # a session's thread pool is fixed when it is created, it gets the process's whole share
+        options.intra_op_num_threads = budget.threads("clip_encode")
+        image_session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+    else:
+        raise ValueError(f"backend must be one of {CLIP_BACKENDS}")
+
+
+def encode_images(image_input):
+    """Encode normalized CLIP image input into image embeddings, shape (N, 512)."""
+    if image_session is not None:
+        return torch.from_numpy(image_session.run(None, {"image": image_input.contiguous().numpy()})[0])
+    with budget.torch_threads("clip_encode"), torch.no_grad():
+        return clip_model.encode_image(image_input.to(device)).float().cpu()
+
+
+if os.environ.get("LOFI_CLIP_BACKEND", "torch") != "torch":
+    set_image_backend(os.environ["LOFI_CLIP_BACKEND"], os.environ.get("LOFI_CLIP_ONNX", DEFAULT_ONNX_PATH))
+
+
+def encode_crops(crops):
+    """Encode (N, 224, 224, 3) uint8 crops from frames.read_crops into CLIP image embeddings, shape (N, 512)."""
+    return encode_images(normalize_crops(crops))
+
+
+def encode_texts(texts):
+    """Encode a list of strings into CLIP text embeddings, shape (N, 512)."""
+    text_input = clip.tokenize(texts).to(device)
+    with torch.no_grad():
+        return clip_model.encode_text(text_input).float().cpu()
+
+
+class EmbeddingDeduper:
+    """
+    Streaming embedding dedup: the normalized embeddings of the last `capacity` kept frames are held in a ring
+    buffer, and a new frame is dropped when its cosine similarity to any of them is above embed_thresh.
+    Same as comparing against every kept frame while at most capacity frames were kept.
+    """
+
+    def __init__(self, embed_thresh=EMBED_SIM_THRESHOLD, capacity=DEDUP_RESERVOIR_SIZE, dim=512):
+        self.embed_thresh = embed_thresh
+        self.reservoir = torch.empty(capacity, dim)
+        self.size = 0
+        self.next = 0
+
+    def filter(self, embeddings):
+        """The rows of a (N, 512) batch not similar to an earlier kept frame, in order, shape (K, 512)."""
+        normalized = embeddings / embeddings.norm(dim=1, keepdim=True)
+        kept = []
+        for i in range(len(embeddings)):
+            if self.size and (self.reservoir[:self.size] @ normalized[i]).max() > self.embed_thresh:
+                continue
+            kept.append(i)
+            self.reservoir[self.next] = normalized[i]
+            self.next = (self.next + 1) % len(self.reservoir)
+            self.size = min(self.size + 1, len(self.reservoir))
+        return embeddings[kept]
+
+
+def dedup_embeddings(embeddings, embed_thresh=EMBED_SIM_THRESHOLD):
+    """Drop embeddings whose cosine similarity to an earlier kept embedding is above embed_thresh."""
+    kept = EmbeddingDeduper(embed_thresh, max(1, len(embeddings)), embeddings.shape[1]).filter(embeddings)
+    return kept if len(kept) else None
+
+
+def embedding_batches(video_path, frame_interval=FRAME_INTERVAL, pixel_thresh=PIXEL_SIM_THRESHOLD,
+                      batch_size=CLIP_BATCH_SIZE, pipelined=True, crops=None):
+    """
+    CLIP embeddings of the frames of a video kept by the pixel filter, as (N, 512) batches in frame order.
+
+    With pipelined, decoding, preprocessing and CLIP run concurrently (see embed_frames_pipelined),
+    otherwise one after the other. Both give identical embeddings.
+    crops: the crops of those frames (from frames.read_crops) when they were already decoded, they are encoded
+    instead of decoding the video again.
+    """
+    if pipelined and crops is None:
+        yield from embed_frames_pipelined(video_path, frame_interval, pixel_thresh, batch_size)
+        return
+
+    if crops is None:
+        crops = (crop for _, crop in read_crops(video_path, frame_interval, pixel_thresh))
+    batch = []
+    for crop in crops:
+        batch.append(crop)
+        if len(batch) == batch_size:
+            with stage("clip_encode"):
+                embeddings = encode_crops(np.stack(batch))
+            batch = []
+            yield embeddings
+    if batch:
+        with stage("clip_encode"):
+            embeddings = encode_crops(np.stack(batch))
+        yield embeddings
+
+
+def distinct_embeddings(video_path, frame_interval=FRAME_INTERVAL, pixel_thresh=PIXEL_SIM_THRESHOLD,
+                        embed_thresh=EMBED_SIM_THRESHOLD, batch_size=CLIP_BATCH_SIZE, pipelined=True,
+                        reservoir_size=DEDUP_RESERVOIR_SIZE, crops=None):
+    """
+    Stream the CLIP embeddings of the distinct frames of a video, as (K, 512) batches in frame order.
+    Only the frames in flight and the dedup reservoir are held, so memory does not grow with the video length.
+    crops: the video's already decoded crops, see embedding_batches.
+    """
+    deduper = EmbeddingDeduper(embed_thresh, reservoir_size)
+    kept = 0
+    dedup_seconds = 0.0
+    try:
+        for embeddings in embedding_batches(video_path, frame_interval, pixel_thresh, batch_size, pipelined, crops):
+            start = time.perf_counter()
+            embeddings = deduper.filter(embeddings)
+            dedup_seconds += time.perf_counter() - start
+            if len(embeddings):
+                kept += len(embeddings)
+                yield embeddings
+    finally:
+        record_stage("embedding_dedup", dedup_seconds)
+        count_frames("kept_embedding_dedup", kept)
+
+
+def embed_video(video_path, frame_interval=FRAME_INTERVAL, pixel_thresh=PIXEL_SIM_THRESHOLD,
+                embed_thresh=EMBED_SIM_THRESHOLD, batch_size=CLIP_BATCH_SIZE, pipelined=True):
+    """
+    Decode a video once and embed its distinct frames with CLIP, in batches of batch_size frames.
+    Frames whose embedding has cosine similarity above embed_thresh to an already kept frame are dropped.
+    Callers that only aggregate over the frames should stream distinct_embeddings instead.
+
+    Returns: tensor of shape (T, 512), or None if no frame was kept
+    """
+    embeddings = list(distinct_embeddings(video_path, frame_interval, pixel_thresh, embed_thresh, batch_size,
+                                          pipelined))
+    return torch.cat(embeddings) if embeddings else None
+
+
+def prepare_frame(frame, to_crop):
+    start = time.perf_counter()
+    crop = to_crop(frame) if to_crop is not None else frame
+    return normalize_crops(crop[None])[0], time.perf_counter() - start
+
+
+def embed_frames_pipelined(video_path, frame_interval=FRAME_INTERVAL, pixel_thresh=PIXEL_SIM_THRESHOLD,
+                           batch_size=CLIP_BATCH_SIZE):
+    """
+    Yield the CLIP embeddings of the frames of a video kept by the pixel filter, as (batch_size, 512) tensors
+    in frame order.
+
+    A decode thread runs the frame reader (decode and pixel filter) and hands every kept frame to the
+    preprocessing pool (crop and normalize), queueing the futures in frame order. This thread takes them
+    off the queue in that order and runs CLIP on full batches, so while a batch is encoded the next frames are
+    decoded and preprocessed. The bounded queue blocks the decode thread when CLIP falls behind, which bounds
+    the frames in memory to PIPELINE_QUEUE_SIZE plus one batch.
+    """
+    reader, to_crop = frame_reader()
+    frames = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        # gives up when the consumer stopped early (error or abandoned request)
+        while not stopped.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decode():
+        try:
+            for _, frame in reader(video_path, frame_interval, pixel_thresh):
+                future = preprocess_pool.submit(contextvars.copy_context().run, prepare_frame, frame, to_crop)
+                if not put(future):
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+
+    # the decode thread runs in a copy of this context, so its stages land in the current request trace
+    decoder = threading.Thread(target=contextvars.copy_context().run, args=(decode,), daemon=True)
+    decoder.start()
+
+    batch = []
+    preprocess_seconds = 0.0
+    try:
+        while True:
+            item = frames.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is not done:
+                image_input, seconds = item.result()
+                batch.append(image_input)
+                preprocess_seconds += seconds
+            if batch and (len(batch) == batch_size or item is done):
+                with stage("clip_encode"):
+                    embeddings = encode_images(torch.stack(batch))
+                batch = []
+                yield embeddings
+            if item is done:
+                return
+    finally:
+        stopped.set()
+        decoder.join()
+        record_stage("clip_preprocess", preprocess_seconds)
+
+
+class ClipBatcher:
+    """
+    Pools crops submitted by many producers (videos, requests) into shared CLIP forward passes.
+
+    submit() returns a Future resolving to the (N, 512) embeddings of the submitted crops. A background thread
+    runs a batch once batch_size frames are waiting or max_wait seconds passed since the oldest submission.
+    """
+
+    def __init__(self, batch_size=CLIP_BATCH_SIZE, max_wait=0.01):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.busy_seconds = 0.0
+        self.frames_encoded = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, crops):
+        future = Future()
+        if len(crops) == 0:
+            future.set_result(torch.empty(0, 512))
+        else:
+            self.requests.put((crops, future))
+        return future
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def distinct_embeddings(self, video_path, frame_interval=FRAME_INTERVAL, pixel_thresh=PIXEL_SIM_THRESHOLD,
+                            embed_thresh=EMBED_SIM_THRESHOLD, window=BATCHER_WINDOW, crops=None):
+        """
+        distinct_embeddings through the batcher: the crops of the video are submitted in chunks of batch_size
+        as they are decoded, with at most window chunks waiting for CLIP, so a long video holds no more than
+        window * batch_size crops and does not hold up the other producers' frames behind one large request.
+        crops: the video's already decoded crops, see embedding_batches.
+        """
+        deduper = EmbeddingDeduper(embed_thresh)
+        in_flight = collections.deque()
+        kept = 0
+        dedup_seconds = 0.0
+
+        def embedded():
+            nonlocal kept, dedup_seconds
+            embeddings = in_flight.popleft().result()
+            start = time.perf_counter()
+            embeddings = deduper.filter(embeddings)
+            dedup_seconds += time.perf_counter() - start
+            kept += len(embeddings)
+            return embeddings
+
+        try:
+            if crops is None:
+                crops = (crop for _, crop in read_crops(video_path, frame_interval, pixel_thresh))
+            chunk = []
+            for crop in crops:
+                chunk.append(crop)
+                if len(chunk) < self.batch_size:
+                    continue
+                in_flight.append(self.submit(np.stack(chunk)))
+                chunk = []
+                if len(in_flight) == window:
+                    embeddings = embedded()
+                    if len(embeddings):
+                        yield embeddings
+            if chunk:
+                in_flight.append(self.submit(np.stack(chunk)))
+            while in_flight:
+                embeddings = embedded()
+                if len(embeddings):
+                    yield embeddings
+        finally:
+            record_stage("embedding_dedup", dedup_seconds)
+            count_frames("kept_embedding_dedup", kept)
+
+    def _run(self):
+        pending = []
+        num_frames = 0
+        deadline = None
+        while True:
+            timeout = max(0.0, deadline - time.perf_counter()) if pending else None
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                request = False  # the oldest pending request waited max_wait
+
+            if request is None:  # closed
+                if pending:
+                    self._encode(pending)
+                return
+            if request is not False:
+                if not pending:
+                    deadline = time.perf_counter() + self.max_wait
+                pending.append(request)
+                num_frames += len(request[0])
+                if num_frames < self.batch_size:
+                    continue
+
+            self._encode(pending)
+            pending = []
+            num_frames = 0
+
+    def _encode(self, pending):
+        start = time.perf_counter()
+        try:
+            crops = pending[0][0] if len(pending) == 1 else np.concatenate([crops for crops, _ in pending])
+            embeddings = torch.cat([encode_crops(crops[i:i + self.batch_size])
+                                    for i in range(0, len(crops), self.batch_size)])
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        finally:
+            self.busy_seconds += time.perf_counter() - start
+        self.frames_encoded += len(embeddings)
+
+        offset = 0
+        for crops, future in pending:
+            future.set_result(embeddings[offset:offset + len(crops)])
+            offset += len(crops)
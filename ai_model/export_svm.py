@@ -0,0 +1,114 @@
+import argparse
+import os
+
+import joblib
+import numpy as np
+
+from svm_fast import FAST_MODEL_NAME, load_fast_svm
+
+# Exports checkpoints/model.pkl into a NumPy artifact scored by svm_fast.FastSVM.
+# Supported: SVC(probability=True), CalibratedClassifierCV(method="sigmoid") over SVC/LinearSVC/LogisticRegression,
+# LogisticRegression, each optionally behind a StandardScaler in a Pipeline.
+
+MAX_ABS_DIFF = 1e-6
+
+
+def export_decision_function(estimator, prefix):
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.svm import SVC, LinearSVC
+
+    if isinstance(estimator, SVC):
+        if estimator.kernel == "linear":
+            # collapse the support vectors into a single weight vector
+            return {
+                f"{prefix}kernel": np.array("linear"),
+                f"{prefix}coef": (estimator.dual_coef_ @ estimator.support_vectors_)[0].astype(np.float64),
+                f"{prefix}intercept": np.float64(estimator.intercept_[0]),
+            }
+        if estimator.kernel not in ("rbf", "poly", "sigmoid"):
+            raise ValueError(f"Unsupported SVC kernel: {estimator.kernel}")
+        # only keep support vectors that contribute to the decision function
+        dual_coef = estimator.dual_coef_[0]
+        used = dual_coef != 0
+        return {
+            f"{prefix}kernel": np.array(estimator.kernel),
+            f"{prefix}support_vectors": estimator.support_vectors_[used].astype(np.float64),
+            f"{prefix}coef": dual_coef[used].astype(np.float64),
+            f"{prefix}intercept": np.float64(estimator.intercept_[0]),
+            f"{prefix}gamma": np.float64(estimator._gamma),
+            f"{prefix}coef0": np.float64(estimator.coef0),
+            f"{prefix}degree": np.float64(estimator.degree),
+        }
+    if isinstance(estimator, (LinearSVC, LogisticRegression)):
+        return {
+            f"{prefix}kernel": np.array("linear"),
+            f"{prefix}coef": estimator.coef_[0].astype(np.float64),
+            f"{prefix}intercept": np.float64(estimator.intercept_[0]),
+        }
+    raise ValueError(f"Unsupported estimator: {type(estimator).__name__}")
+
+
+def export_model(model):
+    """Convert a fitted binary sklearn model into the arrays of a FastSVM artifact."""
+    from sklearn.calibration import CalibratedClassifierCV
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.svm import SVC
+
+    arrays = {}
+    if isinstance(model, Pipeline):
+        for _, step in model.steps[:-1]:
+            if not isinstance(step, StandardScaler) or "scaler_mean" in arrays:
+                raise ValueError(f"Unsupported pipeline step: {type(step).__name__}")
+            arrays["scaler_mean"] = step.mean_ if step.mean_ is not None else np.zeros(step.n_features_in_)
+            arrays["scaler_scale"] = step.scale_ if step.scale_ is not None else np.ones(step.n_features_in_)
+        model = model.steps[-1][1]
+
+    if len(model.classes_) != 2:
+        raise ValueError("Only binary models are supported")
+
+    if isinstance(model, SVC):
+        if not model.probability:
+            raise ValueError("SVC was fitted without probability=True")
+        arrays.update(export_decision_function(model, "m0_"))
+        arrays.update(kind=np.array("libsvm"), num_members=np.int64(1),
+                      m0_prob_a=np.float64(model.probA_[0]), m0_prob_b=np.float64(model.probB_[0]))
+    elif isinstance(model, CalibratedClassifierCV):
+        if model.method != "sigmoid":
+            raise ValueError("Only sigmoid (Platt) calibration is supported")
+        for i, calibrated in enumerate(model.calibrated_classifiers_):
+            calibrator = calibrated.calibrators[0]
+            arrays.update(export_decision_function(calibrated.estimator, f"m{i}_"))
+            arrays.update({f"m{i}_prob_a": np.float64(calibrator.a_), f"m{i}_prob_b": np.float64(calibrator.b_)})
+        arrays.update(kind=np.array("calibrated"), num_members=np.int64(len(model.calibrated_classifiers_)))
+    elif isinstance(model, LogisticRegression):
+        arrays.update(export_decision_function(model, "m0_"))
+        arrays.update(kind=np.array("logistic"), num_members=np.int64(1))
+    else:
+        raise ValueError(f"Unsupported model: {type(model).__name__}")
+    return arrays
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export model.pkl into a NumPy artifact for svm_fast")
+    parser.add_argument("model_dir", nargs="?", default="checkpoints")
+    parser.add_argument("--embeddings", help=".npy file of (N, 512) CLIP embeddings to verify against")
+    args = parser.parse_args()
+
+    model = joblib.load(os.path.join(args.model_dir, "model.pkl"))
+    output_path = os.path.join(args.model_dir, FAST_MODEL_NAME)
+    np.savez(output_path, **export_model(model))
+
+    # verify against predict_proba before the artifact is used
+    if args.embeddings:
+        X = np.load(args.embeddings)
+    else:
+        X = np.random.RandomState(0).randn(1000, model.n_features_in_)
+    expected = model.predict_proba(X)
+    actual = load_fast_svm(output_path).predict_proba(X)
+    max_diff = np.abs(expected - actual).max()
+    if max_diff > MAX_ABS_DIFF:
+        os.remove(output_path)
+        raise SystemExit(f"❌ Export differs from predict_proba by {max_diff:.2e}, removed {output_path}")
+    print(f"✅ Exported {output_path} (max abs diff to predict_proba: {max_diff:.2e})")
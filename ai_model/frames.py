@@ -0,0 +1,292 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from metrics import count_frames, record_stage, stage
+from resources import budget
+
+try:
+    import av
+except ImportError:
+    av = None
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v")
+FRAME_INTERVAL = 5
+PIXEL_SIM_THRESHOLD = 0.95
+THUMBNAIL_SIZE = 64
+CROP_SIZE = 224
+# "pyav" decodes with ffmpeg's frame threading and scales straight to the analysis size,
+# "opencv" decodes full-resolution frames (the fallback when PyAV is not installed)
+FRAME_SOURCES = ["pyav", "opencv"]
+FRAME_SOURCE = os.environ.get("LOFI_FRAME_SOURCE", "pyav" if av is not None else "opencv")
+
+# frames a request was charged for by admission control (admission.estimate_cost): the readers decode no more
+# than that, whatever the container header claims, and raise FrameLimitExceeded for a video that has more, rather
+# than give a verdict on its first frames only. A context variable, so it follows the request into the decode
+# threads that run in a copy of its context; None for no limit.
+frame_limit = contextvars.ContextVar("lofi_frame_limit", default=None)
+
+# the geometric part of CLIP's preprocess, normalization happens in clip_service.encode_crops; built on first use,
+# so that decode-only processes (batch.py workers on PyAV) never import torch
+clip_crop = None
+
+
+def find_videos(video_dir):
+    """The video files under video_dir, by extension, sorted."""
+    paths = []
+    for root, _, files in os.walk(video_dir):
+        paths.extend(os.path.join(root, file) for file in files if file.lower().endswith(VIDEO_EXTENSIONS))
+    return sorted(paths)
+
+
+class EvenSamples:
+    """
+    num_frames frames spread evenly over a video (every frame count // num_frames-th frame from the first), picked
+    up by a frame reader in the pass that decodes the video for the pixel filter, whether or not the filter keeps
+    them. Readers call start with the frame count, then add each sampled frame; take returns the crops added since
+    the last call.
+    """
+
+    def __init__(self, num_frames):
+        self.num_frames = num_frames
+        self.indices = frozenset()
+        self.to_crop = None
+        self.pending = []
+
+    def start(self, frame_count):
+        interval = max(frame_count // self.num_frames, 1)
+        self.indices = frozenset(range(0, min(frame_count, self.num_frames * interval), interval))
+
+    def add(self, frame):
+        self.pending.append(self.to_crop(frame) if self.to_crop is not None else frame)
+
+    def take(self):
+        crops, self.pending = self.pending, []
+        return crops
+
+
+class FrameLimitExceeded(Exception):
+    """A video with more frames than the frame limit it was charged for, see limit_frames."""
+
+    def __init__(self, limit):
+        super().__init__(f"Video has more than the {limit} frames it was charged for")
+        self.limit = limit
+
+
+@contextmanager
+def limit_frames(limit):
+    """Let the frame readers in this context decode at most limit frames."""
+    token = frame_limit.set(limit)
+    try:
+        yield
+    finally:
+        frame_limit.reset(token)
+
+
+def read_frames(video_path, frame_interval=FRAME_INTERVAL, pixel_thresh=PIXEL_SIM_THRESHOLD, samples=None):
+    """
+    Decode every frame_interval-th frame of a video, skipping frames that are nearly identical
+    (cosine similarity of 64x64 thumbnails above pixel_thresh) to the last kept frame.
+    samples (EvenSamples) also gets its frames, seeked to in the same pass.
+
+    Yields: (frame index, RGB frame as a numpy array)
+    """
+    with stage("video_open"):
+        cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Cannot open video file: {video_path}")
+
+    # the consumer runs between yields, so decode and filter time are accumulated and recorded once at the end
+    decode_seconds = filter_seconds = 0.0
+    frames_seen = frames_kept = 0
+    try:
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_limit.get() is not None and frame_count > frame_limit.get():
+            raise FrameLimitExceeded(frame_limit.get())
+        last_frame_vector = None
+        indices = range(0, frame_count, frame_interval)
+        if samples is not None:
+            samples.start(frame_count)
+            indices = sorted(samples.indices.union(indices))
+
+        for idx in indices:
+            start = time.perf_counter()
+            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            success, frame = cap.read()
+            decoded = time.perf_counter()
+            decode_seconds += decoded - start
+            if not success:
+                continue
+            if samples is not None and idx in samples.indices:
+                samples.add(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            if idx % frame_interval:
+                continue
+            frames_seen += 1
+
+            small = cv2.resize(frame, (THUMBNAIL_SIZE, THUMBNAIL_SIZE)).flatten().astype(np.float32)
+            small = small / np.linalg.norm(small)
+            similar = last_frame_vector is not None and np.dot(small, last_frame_vector) > pixel_thresh
+            filter_seconds += time.perf_counter() - decoded
+            if similar:
+                continue
+
+            last_frame_vector = small
+            frames_kept += 1
+            yield idx, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    finally:
+        cap.release()
+        record_stage("frame_decode", decode_seconds)
+        record_stage("pixel_filter", filter_seconds)
+        count_frames("seen", frames_seen)
+        count_frames("kept_pixel_filter", frames_kept)
+
+
+def crop_frame(frame):
+    """Resize and center-crop an RGB frame to the CLIP input size, as a (224, 224, 3) uint8 array."""
+    global clip_crop
+    if clip_crop is None:
+        from torchvision.transforms import CenterCrop, Compose, InterpolationMode, Resize
+        clip_crop = Compose([Resize(CROP_SIZE, interpolation=InterpolationMode.BICUBIC), CenterCrop(CROP_SIZE)])
+    return np.asarray(clip_crop(Image.fromarray(frame)))
+
+
+def frame_reader(source=None):
+    """
+    (reader, to_crop) of a frame source: reader(video_path, frame_interval, pixel_thresh[, samples]) yields
+    (frame index, frame) for the distinct frames, and to_crop turns such a frame into a CLIP crop
+    (None when the reader already yields crops). Keeping them apart lets a pipeline crop on other threads.
+    """
+    source = source or FRAME_SOURCE
+    if source == "pyav":
+        return read_crops_pyav, None
+    if source == "opencv":
+        return read_frames, crop_frame
+    raise ValueError(f"Unknown frame source: {source}, expected one of {FRAME_SOURCES}")
+
+
+def read_crops(video_path, frame_interval=FRAME_INTERVAL, pixel_thresh=PIXEL_SIM_THRESHOLD, source=None,
+               samples=None):
+    """
+    Like read_frames, but yields each distinct frame as a CLIP-sized crop: (frame index, (224, 224, 3) uint8 array).
+    samples (EvenSamples) gets its frames as crops too.
+    """
+    reader, to_crop = frame_reader(source)
+    if to_crop is None:
+        yield from reader(video_path, frame_interval, pixel_thresh, samples)
+        return
+
+    if samples is not None:
+        samples.to_crop = to_crop
+    crop_seconds = 0.0
+    try:
+        for idx, frame in reader(video_path, frame_interval, pixel_thresh, samples):
+            start = time.perf_counter()
+            crop = to_crop(frame)
+            crop_seconds += time.perf_counter() - start
+            yield idx, crop
+    finally:
+        record_stage("clip_preprocess", crop_seconds)
+
+
+def read_crops_pyav(video_path, frame_interval=FRAME_INTERVAL, pixel_thresh=PIXEL_SIM_THRESHOLD, samples=None):
+    """
+    read_crops on PyAV: frames are decoded sequentially with ffmpeg's frame/slice threading, and every
+    frame_interval-th frame is scaled by swscale straight to the CLIP size (shorter side 224, bicubic) in RGB,
+    so no full-resolution RGB frame is ever built. The 64x64 thumbnail for the pixel filter comes from that
+    scaled frame, and the crop is its center. Frames are turned upright by the stream's display matrix (phone
+    videos are often stored sideways), as OpenCV does. samples (EvenSamples) gets the crops of its frames.
+    """
+    with stage("video_open"):
+        try:
+            container = av.open(video_path)
+        except Exception as e:
+            raise IOError(f"Cannot open video file: {video_path}") from e
+
+    decode_seconds = scale_seconds = filter_seconds = 0.0
+    frames_seen = frames_kept = 0
+    try:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        stream.thread_count = budget.threads("frame_decode")  # 0 lets ffmpeg pick, one thread per core
+
+        # Resize(224) + CenterCrop(224) of the CLIP preprocess, the shorter side is the same once rotated
+        width, height = stream.codec_context.width, stream.codec_context.height
+        scale = CROP_SIZE / min(width, height)
+        scaled_width, scaled_height = max(CROP_SIZE, round(width * scale)), max(CROP_SIZE, round(height * scale))
+
+        if samples is not None:
+            seconds = float(stream.duration * stream.time_base) if stream.duration else 0.0
+            samples.start(stream.frames or int(seconds * float(stream.average_rate or 0)))
+
+        def center(scaled):
+            top = int(round((scaled.shape[0] - CROP_SIZE) / 2))
+            left = int(round((scaled.shape[1] - CROP_SIZE) / 2))
+            return np.ascontiguousarray(scaled[top:top + CROP_SIZE, left:left + CROP_SIZE])
+
+        last_frame_vector = None
+        frames = container.decode(stream)
+        limit = frame_limit.get()
+        idx = -1
+        while limit is None or idx + 1 < limit:
+            start = time.perf_counter()
+            frame = next(frames, None)
+            decoded = time.perf_counter()
+            decode_seconds += decoded - start
+            if frame is None:
+                break
+            idx += 1
+            sampled = samples is not None and idx in samples.indices
+            if idx % frame_interval and not sampled:
+                continue
+
+            scaled = frame.to_ndarray(width=scaled_width, height=scaled_height, format="rgb24",
+                                      interpolation="BICUBIC")
+            if frame.rotation:
+                # counterclockwise quarter turns
+                scaled = np.ascontiguousarray(np.rot90(scaled, round(frame.rotation / 90)))
+            scaled_at = time.perf_counter()
+            scale_seconds += scaled_at - decoded
+            if sampled:
+                samples.add(center(scaled))
+            if idx % frame_interval:
+                continue
+            frames_seen += 1
+
+            small = cv2.resize(scaled, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+            small = small.flatten().astype(np.float32)
+            small = small / np.linalg.norm(small)
+            similar = last_frame_vector is not None and np.dot(small, last_frame_vector) > pixel_thresh
+            filter_seconds += time.perf_counter() - scaled_at
+            if similar:
+                continue
+
+            last_frame_vector = small
+            frames_kept += 1
+            yield idx, center(scaled)
+        if limit is not None and idx + 1 == limit and next(frames, None) is not None:
+            raise FrameLimitExceeded(limit)
+    finally:
+        container.close()
+        record_stage("frame_decode", decode_seconds)
+        record_stage("clip_preprocess", scale_seconds)
+        record_stage("pixel_filter", filter_seconds)
+        count_frames("seen", frames_seen)
+        count_frames("kept_pixel_filter", frames_kept)
+
+
+def decode_video_crops(video_path, frame_interval=FRAME_INTERVAL, pixel_thresh=PIXEL_SIM_THRESHOLD):
+    """
+    Decode a video into CLIP-sized crops of its distinct frames, without needing the CLIP model,
+    so that it can run in a separate process.
+
+    Returns: (video path, (N, 224, 224, 3) uint8 array, seconds spent decoding)
+    """
+    start = time.perf_counter()
+    crops = [crop for _, crop in read_crops(video_path, frame_interval, pixel_thresh)]
+    crops = np.stack(crops) if crops else np.empty((0, CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8)
+    return video_path, crops, time.perf_counter() - start
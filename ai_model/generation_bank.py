@@ -0,0 +1,248 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+from model.constants import HIDDEN_SIZE
+
+# A bank of pre-generated songs, so requests can be answered by a lookup instead of running the decoder.
+#
+# Build offline:   python generation_bank.py build checkpoints/bank --size 200000 [--ivf_lists 512]
+# Serve:           LOFI_GENERATION_BANK=checkpoints/bank python main.py
+#
+# The bank is a directory of columns, memory-mapped when loaded so only the touched pages are read:
+#   meta.json            size, num_chords, checkpoint version, format version, ...
+#   latents.npy          (N, HIDDEN_SIZE) float32 z of every entry (exact, the title and the state token derive from it)
+#   sq_norms.npy         (N,) float32 squared L2 norms of the latents, for brute-force distances
+#   states.npy           (N, 6, HIDDEN_SIZE) float16 decoder states after the last chord, see DecoderState
+#   features.npy         (N, 3) float32 valence, energy and tempo of the song in [0, 1]
+#   offsets.npy          (N + 1,) int64 byte offsets of each entry's Output JSON in outputs.bin
+#   outputs.bin          the Output JSONs, UTF-8, back to back
+#   ivf_centroids.npy    optional IVF index: (L, HIDDEN_SIZE) k-means centroids of the latents,
+#   ivf_order.npy        entry ids sorted by list,
+#   ivf_offsets.npy      (L + 1,) start of each list in ivf_order
+
+BANK_FORMAT_VERSION = 1
+FEATURE_NAMES = ["valence", "energy", "tempo"]
+SEARCH_CHUNK = 65536
+
+
+def checkpoint_version(path):
+    """Short content hash of a checkpoint, changes whenever the weights do."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def music_features_vector(music_features):
+    """Target for nearest_features from videoprocessor.predict_music_features (tempo is slow/medium/fast)."""
+    tempo = {"slow": 0.0, "medium": 0.5, "fast": 1.0}[music_features["tempo"]]
+    return np.array([music_features["valence"], music_features["energy"], tempo], dtype=np.float32)
+
+
+def nearest_rows(vectors, query, k, sq_norms=None, rows=None):
+    """Ids (into rows, or all of vectors) of the k rows of vectors closest to query in L2, closest first."""
+    query = np.asarray(query, dtype=np.float32).reshape(-1)
+    ids = np.arange(len(vectors)) if rows is None else rows
+    best_ids, best_distances = [], []
+    for start in range(0, len(ids), SEARCH_CHUNK):
+        chunk = ids[start:start + SEARCH_CHUNK]
+        block = np.asarray(vectors[chunk] if rows is not None else vectors[start:start + len(chunk)],
+                           dtype=np.float32)
+        norms = sq_norms[chunk] if sq_norms is not None else (block * block).sum(axis=1)
+        distances = norms - 2 * block @ query  # + |query|^2, same for every row
+        top = np.argpartition(distances, min(k, len(chunk)) - 1)[:k]
+        best_ids.append(chunk[top])
+        best_distances.append(distances[top])
+    best_ids, best_distances = np.concatenate(best_ids), np.concatenate(best_distances)
+    order = np.argsort(best_distances, kind="stable")[:k]
+    return best_ids[order]
+
+
+class GenerationBank:
+    """A bank directory opened read-only with memory-mapped columns."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["format_version"] != BANK_FORMAT_VERSION:
+            raise ValueError(f"Unsupported generation bank format {self.meta['format_version']} in {path}")
+        self.size = self.meta["size"]
+        self.num_chords = self.meta["num_chords"]
+
+        def column(name):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        self.latents = column("latents.npy")
+        self.sq_norms = column("sq_norms.npy")
+        self.states = column("states.npy")
+        self.features = column("features.npy")
+        self.offsets = column("offsets.npy")
+        self.outputs = np.memmap(os.path.join(path, "outputs.bin"), dtype=np.uint8, mode="r")
+
+        self.ivf_centroids = None
+        if os.path.exists(os.path.join(path, "ivf_centroids.npy")):
+            self.ivf_centroids = np.load(os.path.join(path, "ivf_centroids.npy"))
+            self.ivf_order = column("ivf_order.npy")
+            self.ivf_offsets = np.load(os.path.join(path, "ivf_offsets.npy"))
+
+    def entry(self, i):
+        """(Output JSON, state token) of entry i, like lofi2lofi_generate.generate returns."""
+        from model.lofi2lofi_model import DecoderState
+        output = self.outputs[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+        token = DecoderState.pack_token(self.latents[i:i + 1], self.states[i][:, None, :],
+                                        self.meta.get("melody_head", "lstm"), self.meta.get("checkpoint_version"))
+        return output, token
+
+    def draw(self, rng=None):
+        rng = rng or np.random.default_rng()
+        return self.entry(int(rng.integers(self.size)))
+
+    def nearest_latent(self, latent, k=1, nprobe=None):
+        """
+        Ids of the k entries whose latent is closest to the given one. Exact brute force by default,
+        with nprobe (and an IVF index in the bank) only the nprobe lists closest to the latent are searched.
+        """
+        if nprobe is None or self.ivf_centroids is None:
+            return nearest_rows(self.latents, latent, k, self.sq_norms)
+        lists = nearest_rows(self.ivf_centroids, latent, nprobe)
+        rows = np.concatenate([self.ivf_order[self.ivf_offsets[l]:self.ivf_offsets[l + 1]] for l in lists])
+        return nearest_rows(self.latents, latent, k, self.sq_norms, rows)
+
+    def nearest_features(self, features, k=1):
+        """Ids of the k entries closest to a (valence, energy, tempo) vector, see music_features_vector."""
+        return nearest_rows(self.features, features, k)
+
+
+def load_generation_bank(path):
+    """The bank at path, or None when path is empty or holds no bank (callers then decode live)."""
+    if not path or not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    return GenerationBank(path)
+
+
+def kmeans(vectors, num_lists, iterations=10, seed=0):
+    """Centroids of num_lists k-means clusters of vectors (Lloyd's algorithm from randomly chosen vectors)."""
+    rng = np.random.default_rng(seed)
+    centroids = np.array(vectors[rng.choice(len(vectors), num_lists, replace=False)], dtype=np.float32)
+    for _ in range(iterations):
+        assignment = assign_lists(vectors, centroids)
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=num_lists)
+        filled = counts > 0
+        starts = (np.cumsum(counts) - counts)[filled]
+        centroids[filled] = np.add.reduceat(vectors[order], starts) / counts[filled, None]
+        # re-seed empty lists
+        centroids[~filled] = vectors[rng.choice(len(vectors), (~filled).sum(), replace=False)]
+    return centroids
+
+
+def assign_lists(vectors, centroids):
+    centroid_norms = (centroids * centroids).sum(axis=1)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), SEARCH_CHUNK):
+        block = np.asarray(vectors[start:start + SEARCH_CHUNK], dtype=np.float32)
+        assignment[start:start + len(block)] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+    return assignment
+
+
+def build_ivf(path, num_lists, sample_size=100000, seed=0):
+    latents = np.load(os.path.join(path, "latents.npy"), mmap_mode="r")
+    sample = np.random.default_rng(seed).choice(len(latents), min(sample_size, len(latents)), replace=False)
+    centroids = kmeans(np.asarray(latents[np.sort(sample)]), num_lists, seed=seed)
+    assignment = assign_lists(latents, centroids)
+    order = np.argsort(assignment, kind="stable").astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=num_lists))))
+    np.save(os.path.join(path, "ivf_centroids.npy"), centroids)
+    np.save(os.path.join(path, "ivf_order.npy"), order)
+    np.save(os.path.join(path, "ivf_offsets.npy"), offsets)
+
+
+def build(path, decoder, size, num_chords=4, batch_size=1024, seed=0, meta=None):
+    """Decode size random latents in batches and write them with their Outputs and states as a bank at path."""
+    import torch
+    from output import Output
+
+    os.makedirs(path, exist_ok=True)
+    generator = torch.Generator().manual_seed(seed)
+    random.seed(seed)  # Output draws the swing
+
+    def column(name, shape, dtype):
+        return np.lib.format.open_memmap(os.path.join(path, name), mode="w+", dtype=dtype, shape=shape)
+
+    latents = column("latents.npy", (size, HIDDEN_SIZE), np.float32)
+    states = column("states.npy", (size, 6, HIDDEN_SIZE), np.float16)
+    features = column("features.npy", (size, len(FEATURE_NAMES)), np.float32)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+
+    start = time.perf_counter()
+    with open(os.path.join(path, "outputs.bin"), "wb") as outputs:
+        for first in range(0, size, batch_size):
+            count = min(batch_size, size - first)
+            z = torch.randn(count, HIDDEN_SIZE, generator=generator)
+            with torch.no_grad():
+                _, predictions, state = decoder.decode_with_state(z, num_chords)
+            batch_states = state.stacked_states().numpy()
+            for i in range(count):
+                output = Output(decoder.hash(z[i:i + 1]), *(prediction[i:i + 1] for prediction in predictions))
+                data = output.to_json().encode("utf-8")
+                outputs.write(data)
+                offsets[first + i + 1] = offsets[first + i] + len(data)
+                features[first + i] = (output.valence, output.energy, (output.bpm - 70) / 30)
+            latents[first:first + count] = z.numpy()
+            states[first:first + count] = batch_states.transpose(1, 0, 2)
+
+            done = first + count
+            elapsed = time.perf_counter() - start
+            print(f"{done}/{size} entries, {done / elapsed:.0f} entries/s", file=sys.stderr)
+
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "sq_norms.npy"), (np.asarray(latents) ** 2).sum(axis=1).astype(np.float32))
+    latents.flush()
+    states.flush()
+    features.flush()
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"format_version": BANK_FORMAT_VERSION, "size": size, "num_chords": num_chords, "seed": seed,
+                   "features": FEATURE_NAMES, **(meta or {})}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-generate a bank of songs for lookup instead of live decoding")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="decode random latents into a new bank")
+    build_parser.add_argument("path")
+    build_parser.add_argument("--size", type=int, default=200000)
+    build_parser.add_argument("--num_chords", type=int, default=4)
+    build_parser.add_argument("--batch_size", type=int, default=1024)
+    build_parser.add_argument("--seed", type=int, default=0)
+    build_parser.add_argument("--melody_head", default="lstm")
+    build_parser.add_argument("--ivf_lists", type=int, default=0, help="also build an IVF index with this many lists")
+
+    index_parser = subparsers.add_parser("index", help="(re)build the IVF index of an existing bank")
+    index_parser.add_argument("path")
+    index_parser.add_argument("--ivf_lists", type=int, required=True)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        import torch
+        from model.lofi2lofi_model import Decoder
+        checkpoint_name = "lofi2lofi_decoder.pth" if args.melody_head == "lstm" \
+            else f"lofi2lofi_decoder_{args.melody_head}.pth"
+        checkpoint_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "checkpoints", checkpoint_name)
+        decoder = Decoder("cpu", melody_head=args.melody_head)
+        decoder.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
+        decoder.eval()
+        build(args.path, decoder, args.size, args.num_chords, args.batch_size, args.seed,
+              {"melody_head": args.melody_head, "checkpoint_version": checkpoint_version(checkpoint_path)})
+    if args.ivf_lists:
+        build_ivf(args.path, args.ivf_lists)
+        print(f"Built IVF index with {args.ivf_lists} lists", file=sys.stderr)
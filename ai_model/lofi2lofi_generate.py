@@ -1,31 +1,245 @@
+import contextvars
+import json
+import os
+import random
+import threading
+import numpy as np
 import torch
 from output import Output
-from typing import Optional
-from model.lofi2lofi_model import Decoder as Lofi2LofiDecoder
+from renderer import render, write_wav
+from metrics import stage
+from resources import budget
+from generation_bank import load_generation_bank
+from cascade import Student, cascade_predict
+from singleflight import SingleFlight, DEFAULT_DIR as SINGLEFLIGHT_DIR
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List, Optional
+from model.lofi2lofi_model import Decoder as Lofi2LofiDecoder, DecoderState, Sampler
 from model.constants import HIDDEN_SIZE
 from svm_frame_predictor import *
+from clip_service import ClipBatcher
+from frames import limit_frames
 
 # Load SVM model globally
 svm_model = load_svm_model("checkpoints")
+# LOFI_GENERATION_BANK points at a bank built by generation_bank.py: lofifiable videos are then answered with a
+# pre-generated song instead of running the decoder, which stays the fallback (no bank, other num_chords)
+generation_bank = load_generation_bank(os.environ.get("LOFI_GENERATION_BANK"))
+# concurrent analyses of the same upload (double submits, a clip posted by many clients) run once,
+# across threads and the server processes sharing LOFI_SINGLEFLIGHT_DIR
+analysis_flights = SingleFlight(os.environ.get("LOFI_SINGLEFLIGHT_DIR", SINGLEFLIGHT_DIR))
+# LOFI_CASCADE points at a student trained by cascade.py: videos it is confident about skip CLIP
+student = Student.load(os.environ["LOFI_CASCADE"]) if os.environ.get("LOFI_CASCADE") else None
+# decode_batch: videos of a batch decoded at once, and the CLIP batcher every batch pools its frames into
+BATCH_DECODE_THREADS = min(4, os.cpu_count() or 1)
+clip_batcher = None
+clip_batcher_lock = threading.Lock()
 
-def decode(decoder: Lofi2LofiDecoder, video_path: str) -> Optional[str]:
-    mu = torch.randn(1, HIDDEN_SIZE)
-    test_videos = [video_path]
+def generate(decoder: Lofi2LofiDecoder, mu: Optional[torch.Tensor] = None, num_chords: int = 4,
+             state: Optional[DecoderState] = None, rng: Optional[random.Random] = None,
+             sampler: Optional[Sampler] = None):
+    """
+    Run the decoder and return the Output JSON together with a state token to continue the track.
+    Chords and notes are the most likely ones, or drawn by sampler.
+    """
+    with budget.working(), stage("decoder_forward"), budget.torch_threads("decoder_forward"), torch.no_grad():
+        hash, (pred_chords, pred_notes, tempo, pred_key, pred_mode, valence, energy), state = \
+            decoder.decode_with_state(mu, num_chords, state, sampler)
+    with stage("output_build"):
+        output = Output(hash, pred_chords, pred_notes, tempo, pred_key, pred_mode, valence, energy, rng)
+        return output.to_json(), state.to_token(decoder.melody_head, decoder.checkpoint_version)
+
+def generate_beams(decoder: Lofi2LofiDecoder, mu: torch.Tensor, num_chords: int = 4, beams: int = 4,
+                   rng: Optional[random.Random] = None):
+    """Beam search from a (1, HIDDEN_SIZE) mu, returns the beams' (JSON, token, log-probability), best first."""
+    with budget.working(), stage("decoder_forward"), budget.torch_threads("decoder_forward"), torch.no_grad():
+        (pred_chords, pred_notes, *parameters), scores, state = decoder.beam_search(mu, num_chords, beams)
+    hash = decoder.hash(mu)
+    results = []
+    with stage("output_build"):
+        for i in range(beams):
+            output = Output(hash, pred_chords[:, i], pred_notes[:, i], *parameters, rng)
+            results.append((output.to_json(), state.row(i).to_token(decoder.melody_head, decoder.checkpoint_version),
+                            scores[0, i].item()))
+    return results
+
+def generate_batch(decoder: Lofi2LofiDecoder, mu: torch.Tensor, num_chords: int = 4,
+                   rngs: Optional[List[random.Random]] = None):
+    """generate for each row of a (B, HIDDEN_SIZE) mu in one decoder forward pass, returns B (JSON, token)."""
+    with stage("decoder_forward"), budget.torch_threads("decoder_forward"), torch.no_grad():
+        outputs, state = decoder.run(mu, num_chords)
+    results = []
+    with stage("output_build"):
+        for i in range(len(mu)):
+            output = Output(decoder.hash(mu[i:i + 1]), *(tensor[i:i + 1] for tensor in outputs),
+                            rng=rngs[i] if rngs else None)
+            results.append((output.to_json(), state.row(i).to_token(decoder.melody_head, decoder.checkpoint_version)))
+    return results
+
+def analyze(video_path: str, content_hash: Optional[str] = None):
+    """
+    SVM verdict of a video, see predict_per_frame_with_final; None if it has no meaningful frame. Raises if the
+    video fails to be analyzed, so that a failure is never taken for a verdict.
+    With the content hash of the video, concurrent analyses of the same bytes are coalesced into one.
+    """
+    def run():
+        # counts against the thread budget while it runs, callers waiting on a shared analysis do not
+        with budget.working():
+            if student is not None:
+                return cascade_predict(student, svm_model, video_path, method='mean')
+            return predict_video(svm_model, video_path, method='mean')
+    if content_hash is None:
+        return run()
+    return analysis_flights.do(content_hash, run)
+
+def decode(decoder: Lofi2LofiDecoder, video_path: str, num_chords: int = 4, seed: Optional[int] = None,
+           content_hash: Optional[str] = None, sampler: Optional[Sampler] = None, beams: int = 1):
+    """
+    Returns (Output JSON, state token) for a lofifiable video, None otherwise. Raises if the video fails to be
+    analyzed (see analyze).
+    With a seed, mu and the swing come from generators seeded with it instead of the global RNGs,
+    so the same video and seed always give the same song.
+    content_hash (SHA-256 of the video bytes) shares the analysis with concurrent decodes of the same video,
+    each of them still generates its own song.
+    A sampler draws the chords and notes (from a generator seeded with seed, if given). With beams > 1 the result
+    is the list of generate_beams instead. Both always run the decoder, the generation bank only has greedy songs.
+    """
+    mu, rng = song_inputs(seed, sampler)
 
     # Use SVM model for prediction
-    lofify_results = predict_per_frame_with_final(svm_model, test_videos, method='mean')
-    lofify = lofify_results.get(video_path, {})
+    lofify = analyze(video_path, content_hash) or {}
 
     try:
         is_lofifiable = lofify.get("is_lofifiable", False)
 
         if is_lofifiable:
-            hash, (pred_chords, pred_notes, tempo, pred_key, pred_mode, valence, energy) = decoder.decode(mu)
-            output = Output(hash, pred_chords, pred_notes, tempo, pred_key, pred_mode, valence, energy)
-            json = output.to_json()
-            return json
+            return song(decoder, mu, num_chords, seed, rng, sampler, beams)
         else:
             return None
     except Exception as e:
         print(f"Error occurred: {e}")
         return 'Lofifiable_tag not found.'
+
+def decode_events(decoder: Lofi2LofiDecoder, video_path: str, num_chords: int = 4, seed: Optional[int] = None,
+                  sampler: Optional[Sampler] = None, beams: int = 1):
+    """
+    decode as a series of events for a progressive response: {"event": "progress", ...} with the analysis of
+    the frames so far after every CLIP batch, then {"event": "verdict", ...} with the final analysis (is_lofifiable
+    0 and frames_analyzed 0 when no frame could be analyzed), and for a lofifiable video
+    {"event": "output", "output", "state"}, or {"event": "output", "candidates"} with beams > 1.
+    A video that fails to be analyzed raises instead of getting a verdict.
+    With the student cascade there is no progress, the verdict comes at once. The analysis is not shared with
+    concurrent decodes of the same video, since each of them streams its own progress.
+    Closing the generator (client gone) stops the analysis where it is and skips the decoder.
+    """
+    mu, rng = song_inputs(seed, sampler)
+
+    lofify = None
+    with budget.working():
+        if student is not None:
+            lofify = cascade_predict(student, svm_model, video_path, method='mean')
+        else:
+            for lofify in stream_scores(svm_model, video_path, method='mean'):
+                yield {"event": "progress", **lofify}
+    yield {"event": "verdict", **(lofify or {"is_lofifiable": 0, "frames_analyzed": 0})}
+
+    if lofify and lofify["is_lofifiable"]:
+        result = song(decoder, mu, num_chords, seed, rng, sampler, beams)
+        if isinstance(result, list):
+            yield {"event": "output", "candidates": [{"output": json, "state": state, "score": score}
+                                                     for json, state, score in result]}
+        else:
+            yield {"event": "output", "output": result[0], "state": result[1]}
+
+def song_inputs(seed: Optional[int], sampler: Optional[Sampler]):
+    """mu and the swing rng of a song, seeded with seed if given; also seeds the sampler's draws."""
+    if seed is None:
+        return torch.randn(1, HIDDEN_SIZE), None
+    if sampler is not None:
+        sampler.generator = torch.Generator().manual_seed(seed)
+    return torch.randn(1, HIDDEN_SIZE, generator=torch.Generator().manual_seed(seed)), random.Random(seed)
+
+def song(decoder: Lofi2LofiDecoder, mu: torch.Tensor, num_chords: int, seed: Optional[int],
+         rng: Optional[random.Random], sampler: Optional[Sampler], beams: int):
+    """The result of decode for a lofifiable video: a bank song, the decoder's song or its beams."""
+    if beams > 1:
+        return generate_beams(decoder, mu, num_chords, beams, rng)
+    if generation_bank is not None and num_chords == generation_bank.num_chords and sampler is None:
+        with stage("bank_lookup"):
+            return generation_bank.draw(np.random.default_rng(seed) if seed is not None else None)
+    return generate(decoder, mu, num_chords, rng=rng, sampler=sampler)
+
+def decode_batch(decoder: Lofi2LofiDecoder, video_paths: List[str], num_chords: int = 4,
+                 frame_limits: Optional[List[int]] = None):
+    """
+    Decode several videos together, yielding (index, result) in the order they finish. result is what decode
+    returns (None for a video that is not lofifiable), or the exception that video raised.
+    frame_limits: the frames each video was charged for, no more are decoded (see frames.limit_frames).
+    Videos are decoded concurrently, their frames share CLIP batches (with other running batches too), and
+    the videos whose verdicts land together share one decoder forward pass. Verdicts are those of decode, with
+    the student cascade too.
+    """
+    global clip_batcher
+    with clip_batcher_lock:
+        # started on first use, so that a server forked after import still gets the thread
+        if clip_batcher is None:
+            clip_batcher = ClipBatcher()
+
+    with budget.working(), \
+            ThreadPoolExecutor(min(BATCH_DECODE_THREADS, len(video_paths)), thread_name_prefix="batch-decode") as pool:
+        # in a copy of this context, so that their stages land in the request trace
+        analyzing = {pool.submit(contextvars.copy_context().run, analyze_limited, path,
+                                 frame_limits[i] if frame_limits else None): i
+                     for i, path in enumerate(video_paths)}
+        try:
+            while analyzing:
+                completed, _ = wait(analyzing, return_when=FIRST_COMPLETED)
+                lofifiable = []
+                for future in completed:
+                    i = analyzing.pop(future)
+                    try:
+                        verdict = future.result()
+                        if verdict is None or not verdict["is_lofifiable"]:
+                            yield i, None
+                        elif generation_bank is not None and num_chords == generation_bank.num_chords:
+                            with stage("bank_lookup"):
+                                yield i, generation_bank.draw()
+                        else:
+                            lofifiable.append(i)
+                    except Exception as e:
+                        yield i, e
+
+                if lofifiable:
+                    try:
+                        results = generate_batch(decoder, torch.randn(len(lofifiable), HIDDEN_SIZE), num_chords)
+                    except Exception as e:
+                        results = [e] * len(lofifiable)
+                    yield from zip(lofifiable, results)
+        finally:
+            # a consumer that stops early (client gone) leaves the queued videos undecoded
+            for future in analyzing:
+                future.cancel()
+
+def analyze_limited(video_path: str, limit: Optional[int]):
+    """
+    analyze at most limit frames of a video, on a pool thread: the crops that go to CLIP (all of them, or those
+    of a video the student escalates) are sent to the shared CLIP batcher in batch-sized chunks.
+    """
+    with limit_frames(limit):
+        if student is not None:
+            return cascade_predict(student, svm_model, video_path, method='mean', batcher=clip_batcher)
+        return predict_video(svm_model, video_path, method='mean', batcher=clip_batcher)
+
+def continue_decode(decoder: Lofi2LofiDecoder, token: str, num_chords: int = 4):
+    """Generate the next num_chords bars of a track from the state token of a previous generation."""
+    state = DecoderState.from_token(token, decoder.device, melody_head=decoder.melody_head,
+                                    checkpoint_version=decoder.checkpoint_version)
+    return generate(decoder, num_chords=num_chords, state=state)
+
+def write_output(output_json: str, path: str):
+    """Write an Output JSON to path, or render it to audio if path ends in .wav."""
+    if path.lower().endswith(".wav"):
+        write_wav(path, render(json.loads(output_json)))
+    else:
+        with open(path, "w") as f:
+            f.write(output_json)
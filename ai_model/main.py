@@ -1,27 +1,189 @@
-from flask import Flask, request, jsonify
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from flask import Flask, request, jsonify, send_file, abort
 from pathlib import Path
+from json import dumps
+import argparse
+import contextlib
+import contextvars
+import hashlib
+import cProfile
+import functools
+import hmac
+import re
 import tempfile
+import time
+import uuid
 import os
+import sys
 import torch
 
-from model.lofi2lofi_model import Decoder as Lofi2LofiDecoder
-from lofi2lofi_generate import decode
+import resources
+# before the models load: this process's share of the cores, LOFI_WORKERS server processes share the host
+resources.configure_from_env()
+
+from model.lofi2lofi_model import Decoder as Lofi2LofiDecoder, DecoderState, Sampler
+from lofi2lofi_generate import decode, decode_batch, decode_events, continue_decode, write_output
+from generation_bank import checkpoint_version
+from admission import AdmissionController, Rejected, estimate_cost, probe_video, COALESCED_COST, CONTINUE_COST, \
+    DEFAULT_DB_PATH, DEFAULT_CLIENT_BURST, DEFAULT_CLIENT_RATE, DEFAULT_INFLIGHT_BUDGET, DEFAULT_QUEUE_SECONDS
+from memo import ResponseMemo, NOT_LOFIFIABLE, hash_upload, memo_key, etag
+import lofi2lofi_generate
+import worker
+import metrics
+from frames import FrameLimitExceeded, limit_frames
+from model.constants import MAX_CHORD_LENGTH
 
 device = "cpu"
 app = Flask(__name__)
-limiter = Limiter(app=app, key_func=get_remote_address, default_limits=["30 per minute"])
+# pipeline work is charged by its estimated CPU cost, against per-client buckets and a global in-flight budget
+# shared by all server processes on the host (see admission.py); LOFI_ADMISSION=0 turns it off
+admission = AdmissionController(os.environ.get("LOFI_ADMISSION_DB", DEFAULT_DB_PATH),
+                                float(os.environ.get("LOFI_CLIENT_BURST", DEFAULT_CLIENT_BURST)),
+                                float(os.environ.get("LOFI_CLIENT_RATE", DEFAULT_CLIENT_RATE)),
+                                float(os.environ.get("LOFI_INFLIGHT_BUDGET", DEFAULT_INFLIGHT_BUDGET)),
+                                float(os.environ.get("LOFI_ADMISSION_QUEUE_SECONDS", DEFAULT_QUEUE_SECONDS)))
+admission.enabled = os.environ.get("LOFI_ADMISSION", "1") != "0"
+# profiling is off unless LOFI_PROFILE_TOKEN is set: requests whose X-Lofi-Profile header carries that token are
+# run under cProfile, and the newest LOFI_PROFILE_KEEP profiles are kept here for /profiles (same header)
+profile_token = os.environ.get("LOFI_PROFILE_TOKEN")
+profile_dir = os.environ.get("LOFI_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "lofi_profiles"))
+PROFILE_KEEP = int(os.environ.get("LOFI_PROFILE_KEEP", 100))
 
 # Load model once
-checkpoint_path = Path(__file__).parent / "checkpoints" / "lofi2lofi_decoder.pth"
+# LOFI_MELODY_HEAD selects the melody decoder head ("lstm" or "parallel"), each head has its own checkpoint
+melody_head = os.environ.get("LOFI_MELODY_HEAD", "lstm")
+checkpoint_name = "lofi2lofi_decoder.pth" if melody_head == "lstm" else f"lofi2lofi_decoder_{melody_head}.pth"
+checkpoint_path = Path(__file__).parent / "checkpoints" / checkpoint_name
 
-print("Loading lofi model...", end=" ")
-model = Lofi2LofiDecoder(device=device)
+# startup logs go to stderr so that stdout stays free for the worker protocol
+print(f"Loading lofi model ({melody_head} melody head)...", end=" ", file=sys.stderr)
+model = Lofi2LofiDecoder(device=device, melody_head=melody_head)
 model.load_state_dict(torch.load(checkpoint_path, map_location=device))
 model.to(device)
 model.eval()
-print(f"Loaded {checkpoint_path}.")
+print(f"Loaded {checkpoint_path}.", file=sys.stderr)
+model_version = checkpoint_version(checkpoint_path)
+model.checkpoint_version = model_version
+
+bank = lofi2lofi_generate.generation_bank
+if bank is not None:
+    if bank.meta.get("checkpoint_version") != model_version:
+        # songs from other weights would not match what /continue generates next
+        print(f"Ignoring generation bank {bank.path}, it was built with another checkpoint.", file=sys.stderr)
+        lofi2lofi_generate.generation_bank = None
+    else:
+        print(f"Answering from generation bank {bank.path} ({bank.size} entries).", file=sys.stderr)
+
+# everything besides the request that decides a seeded result: the weights and the state token format, and the
+# bank songs are drawn from
+result_version = f"{model_version}+state-v{DecoderState.VERSION}"
+if lofi2lofi_generate.generation_bank is not None:
+    bank_meta = dumps(lofi2lofi_generate.generation_bank.meta, sort_keys=True).encode()
+    result_version += "+bank-" + hashlib.sha256(bank_meta).hexdigest()[:16]
+if lofi2lofi_generate.student is not None:
+    # the student decides some verdicts
+    result_version += "+student-" + checkpoint_version(os.environ["LOFI_CASCADE"])
+
+# seeded /decode results, keyed by video content hash, seed, num_chords and result_version
+memo = ResponseMemo(os.environ.get("LOFI_MEMO_DIR", os.path.join(tempfile.gettempdir(), "lofi_memo")),
+                    int(os.environ.get("LOFI_MEMO_ENTRIES", 1024)))
+MAX_SEED = 2 ** 63
+# uploads a single /decode/batch request may carry
+MAX_BATCH_VIDEOS = int(os.environ.get("LOFI_MAX_BATCH_VIDEOS", 16))
+# candidates a /decode beam search may return, below the 9 chord tokens so that the first step fills every beam
+MAX_BEAMS = 8
+
+
+def instrumented(endpoint):
+    """
+    Trace the pipeline stages of a request: the timings go into the Server-Timing header, a JSON log line
+    on stderr and the /metrics histograms. An X-Lofi-Profile request header with the profiling token also saves
+    a cProfile of the request, its id is returned in X-Lofi-Profile-Id and the stats are served at /profiles/<id>.
+    A streamed response body runs in the request's trace and profile, and the request is logged, timed and its
+    profile saved once the body is done (or the client is gone); Server-Timing then only has the stages run
+    before the body, e.g. the upload.
+    """
+    def wrap(view):
+        @functools.wraps(view)
+        def handler(*args, **kwargs):
+            profiler = cProfile.Profile() if profiling_authorized() else None
+            profile_id = uuid.uuid4().hex if profiler else None
+            start = time.perf_counter()
+            with metrics.trace() as request_trace:
+                context = contextvars.copy_context()
+                if profiler:
+                    profiler.enable()
+                try:
+                    response, status = view(*args, **kwargs)
+                finally:
+                    if profiler:
+                        profiler.disable()
+
+            def finish():
+                seconds = time.perf_counter() - start
+                metrics.request_seconds.observe((endpoint, str(status)), seconds)
+                log = {"endpoint": endpoint, "status": status, "seconds": round(seconds, 6),
+                       **request_trace.summary()}
+                if profiler:
+                    save_profile(profiler, profile_id)
+                    log["profile"] = profile_id
+                print(dumps(log), file=sys.stderr)
+
+            response.headers['Server-Timing'] = request_trace.server_timing()
+            response.headers.add('Access-Control-Expose-Headers', 'Server-Timing')
+            if profiler:
+                response.headers['X-Lofi-Profile-Id'] = profile_id
+                response.headers.add('Access-Control-Expose-Headers', 'X-Lofi-Profile-Id')
+            if response.is_streamed:
+                response.response = traced_body(response.response, context, profiler, finish)
+            else:
+                finish()
+            return response, status
+        return handler
+    return wrap
+
+
+def traced_body(body, context, profiler, finish):
+    """Iterate a streamed response body in context, under profiler (if any), then call finish."""
+    iterator = iter(body)
+    done = object()
+    try:
+        while True:
+            if profiler:
+                profiler.enable()
+            try:
+                chunk = context.run(next, iterator, done)
+            finally:
+                if profiler:
+                    profiler.disable()
+            if chunk is done:
+                return
+            yield chunk
+    finally:
+        # closed early when the client disconnects, the body's cleanup still belongs to the request
+        if hasattr(iterator, "close"):
+            context.run(iterator.close)
+        finish()
+
+
+def profiling_authorized():
+    """Whether the request's X-Lofi-Profile header carries the profiling token, never without a token set."""
+    presented = request.headers.get('X-Lofi-Profile')
+    return bool(profile_token) and presented is not None and \
+        hmac.compare_digest(presented.encode(), profile_token.encode())
+
+
+def save_profile(profiler, profile_id):
+    """Write the stats of profiler to profile_dir as profile_id, dropping the oldest beyond PROFILE_KEEP."""
+    os.makedirs(profile_dir, exist_ok=True)
+    profiler.dump_stats(os.path.join(profile_dir, f"{profile_id}.prof"))
+    paths = [os.path.join(profile_dir, name) for name in os.listdir(profile_dir) if name.endswith(".prof")]
+    if len(paths) > PROFILE_KEEP:
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - PROFILE_KEEP]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # removed by another server process
 
 
 @app.route('/')
@@ -29,7 +191,23 @@ def home():
     return 'Server running'
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Stage and request histograms, frame counters and memory gauges in the Prometheus text format."""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/profiles/<profile_id>')
+def profile_endpoint(profile_id):
+    """cProfile stats of a request sent with X-Lofi-Profile, load with pstats or snakeviz. Needs the same header."""
+    path = os.path.join(profile_dir, f"{profile_id}.prof")
+    if not profiling_authorized() or not re.fullmatch(r"[0-9a-f]{32}", profile_id) or not os.path.isfile(path):
+        abort(404)
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True)
+
+
 @app.route('/decode', methods=['POST'])
+@instrumented('decode')
 def decode_endpoint():
     if 'video' not in request.files:
         response = jsonify({'error': 'No video uploaded'})
@@ -42,24 +220,98 @@ def decode_endpoint():
         response.headers.add('Access-Control-Allow-Origin', '*')
         return response, 400
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
+    seed = request.form.get('seed', request.args.get('seed'))
+    if seed is not None:
+        try:
+            seed = int(seed)
+        except ValueError:
+            seed = -1
+        if not 0 <= seed < MAX_SEED:
+            response = jsonify({'error': f'seed must be an integer between 0 and {MAX_SEED - 1}'})
+            response.headers.add('Access-Control-Allow-Origin', '*')
+            return response, 400
+
+    try:
+        sampler, beams = sampling_options()
+    except ValueError as e:
+        response = jsonify({'error': str(e)})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 400
+    # sampled and beam searched results are not memoized, a seed still makes them reproducible
+    memoizable = seed is not None and sampler is None and beams == 1
+
+    with metrics.stage("upload_save"), tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
         video_path = tmp.name
-        video_file.save(video_path)
+        content_hash = hash_upload(video_file.stream, video_path)
+
+    # opt-in progressive response, see decode_stream
+    if request.form.get('stream', request.args.get('stream')) == '1' or \
+            request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+        return decode_stream(video_file.filename, video_path, content_hash, seed, sampler, beams)
 
     try:
-        result = decode(model, video_path)
+        memoized = None
+        if memoizable:
+            # a seeded result is fully determined by the key, so it is computed once and can be revalidated
+            key = memo_key(content_hash, seed, 4, result_version)
+            if request.if_none_match.contains(etag(key)):
+                return not_modified(key)
+            memoized = memo.get(key)
+
+        if memoized is None:
+            try:
+                cost, frames = estimate_cost(video_path)
+            except OSError:
+                response = jsonify({'error': 'Input video is not lofifiable.'})
+                response.headers.add('Access-Control-Allow-Origin', '*')
+                return response, 422
+            if lofi2lofi_generate.analysis_flights.running(content_hash):
+                # it will wait for that analysis instead of running its own
+                cost = COALESCED_COST
+            with admission.admit(request.remote_addr, cost), limit_frames(frames):
+                result = decode(model, video_path, seed=seed, content_hash=content_hash, sampler=sampler,
+                                beams=beams)
+            # only verdicts are memoized, a video that failed to be analyzed raised and gets a 500
+            if memoizable and result is None:
+                memo.put(key, NOT_LOFIFIABLE)
+            elif memoizable and not isinstance(result, str):
+                memo.put(key, result)
+        else:
+            result = None if memoized == NOT_LOFIFIABLE else memoized
+
         if result is None:
             response = jsonify({'error': 'Input video is not lofifiable.'})
             response.headers.add('Access-Control-Allow-Origin', '*')
             return response, 422
-        elif result == "mood_tag not present":
+        elif isinstance(result, str):
             response = jsonify({'error': 'Lofifiable_tag not found.'})
             response.headers.add('Access-Control-Allow-Origin', '*')
             return response, 422
 
-        response = jsonify(result)
+        if isinstance(result, list):
+            # beam search: the candidates best first, the state header continues the best one
+            response = jsonify({'candidates': [{'output': json, 'state': state, 'score': score}
+                                               for json, state, score in result]})
+            add_state_header(response, result[0][1])
+            response.headers.add('Access-Control-Allow-Origin', '*')
+            return response, 201
+
+        json, state = result
+        response = jsonify(json)
+        add_state_header(response, state)
+        if memoizable:
+            add_cache_headers(response, key)
+            response.headers['Content-Location'] = f'/decode/{content_hash}?seed={seed}&num_chords=4'
+            response.headers.add('Access-Control-Expose-Headers', 'Content-Location')
         response.headers.add('Access-Control-Allow-Origin', '*')
         return response, 201
+    except Rejected as e:
+        return rejected_response(e)
+    except FrameLimitExceeded as e:
+        # more frames than the header (or file size) it was charged by, no verdict on part of a video
+        response = jsonify({'error': str(e)})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 422
     except Exception as e:
         response = jsonify({'error': f'Server error: {str(e)}'})
         response.headers.add('Access-Control-Allow-Origin', '*')
@@ -68,5 +320,289 @@ def decode_endpoint():
         os.remove(video_path)
 
 
+def decode_stream(filename, video_path, content_hash, seed, sampler, beams):
+    """
+    /decode as NDJSON events while the pipeline advances. The first line is sent before any frame is decoded:
+    {"event": "accepted", "filename", "content_hash", "frames", "seconds", "width", "height"}. Then come the
+    progress, verdict and output events of decode_events, or {"event": "error", "error"} if the server fails or
+    the video turns out to have more frames than it was charged for.
+    A client may disconnect at any point (e.g. on a negative interim estimate), which stops the pipeline.
+    Streamed results are not memoized. The request is logged and profiled once the stream ends, see instrumented.
+    """
+    # admission is held until the stream is done, so it is released by the stream and not by this view
+    admitted = contextlib.ExitStack()
+    try:
+        frames, seconds, width, height = probe_video(video_path)
+        cost, charged_frames = estimate_cost(video_path)
+        admitted.enter_context(admission.admit(request.remote_addr, cost))
+    except BaseException as e:
+        os.remove(video_path)
+        if isinstance(e, Rejected):
+            return rejected_response(e)
+        if isinstance(e, OSError):
+            response = jsonify({'error': 'Input video is not lofifiable.'})
+            response.headers.add('Access-Control-Allow-Origin', '*')
+            return response, 422
+        raise
+    accepted = {'event': 'accepted', 'filename': filename, 'content_hash': content_hash, 'frames': frames,
+                'seconds': round(seconds, 3), 'width': width, 'height': height}
+
+    def stream():
+        try:
+            yield dumps(accepted) + '\n'
+            with limit_frames(charged_frames):
+                for event in decode_events(model, video_path, seed=seed, sampler=sampler, beams=beams):
+                    yield dumps(event) + '\n'
+        except FrameLimitExceeded as e:
+            yield dumps({'event': 'error', 'error': str(e)}) + '\n'
+        except Exception as e:
+            yield dumps({'event': 'error', 'error': f'Server error: {str(e)}'}) + '\n'
+        finally:
+            # also runs when the client disconnects and the server closes the stream
+            admitted.close()
+            os.remove(video_path)
+
+    response = app.response_class(stream(), mimetype='application/x-ndjson')
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response, 200
+
+
+def sampling_options():
+    """
+    The Sampler and beam width of a /decode request, from its temperature, top_k, top_p and beams fields.
+    No sampler without any of the first three, raises ValueError for invalid values.
+    """
+    fields = {name: request.form.get(name, request.args.get(name)) for name in ('temperature', 'top_k', 'top_p',
+                                                                                 'beams')}
+    try:
+        temperature = float(fields['temperature'] or 1.0)
+        top_k = int(fields['top_k'] or 0)
+        top_p = float(fields['top_p'] or 1.0)
+        beams = int(fields['beams'] or 1)
+    except ValueError:
+        raise ValueError('temperature and top_p must be numbers, top_k and beams integers')
+    if not 0 <= temperature <= 10 or top_k < 0 or not 0 < top_p <= 1:
+        raise ValueError('Expected 0 <= temperature <= 10, top_k >= 0 and 0 < top_p <= 1')
+    if not 1 <= beams <= MAX_BEAMS:
+        raise ValueError(f'beams must be between 1 and {MAX_BEAMS}')
+    sampled = any(fields[name] is not None for name in ('temperature', 'top_k', 'top_p'))
+    if sampled and beams > 1:
+        raise ValueError('beams cannot be combined with temperature, top_k or top_p')
+    return (Sampler(temperature, top_k, top_p) if sampled else None), beams
+
+
+@app.route('/decode/batch', methods=['POST'])
+@instrumented('decode_batch')
+def decode_batch_endpoint():
+    """
+    Decode several uploads (repeated "videos" form field) in one request, sharing CLIP and decoder batches
+    between them. The response is NDJSON, one line per video in the order they finish:
+    {"index": 0, "filename": "a.mp4", "status": 201, "output": "<Output JSON>", "state": "<token>"}, or
+    {"index": 1, "filename": "b.mp4", "status": 422, "error": "..."} for a video that failed on its own.
+    """
+    files = request.files.getlist('videos')
+    # not type=int, which would silently fall back to 4 for a value that is not an integer
+    num_chords = request.form.get('num_chords', '4')
+    if not files or any(file.filename == '' for file in files):
+        response = jsonify({'error': 'No videos uploaded'})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 400
+    if len(files) > MAX_BATCH_VIDEOS:
+        response = jsonify({'error': f'At most {MAX_BATCH_VIDEOS} videos per batch'})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 400
+    if not re.fullmatch(r"[0-9]{1,3}", num_chords) or not 1 <= int(num_chords) <= MAX_CHORD_LENGTH:
+        response = jsonify({'error': f'num_chords must be an integer between 1 and {MAX_CHORD_LENGTH}'})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 400
+    num_chords = int(num_chords)
+
+    video_paths = []
+    # admission is held until the stream is done, so it is released by the stream and not by this view
+    admitted = contextlib.ExitStack()
+    try:
+        with metrics.stage("upload_save"):
+            for video_file in files:
+                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
+                    video_paths.append(tmp.name)
+                    video_file.save(tmp)
+        cost = 0.0
+        frame_limits = []
+        for video_path in video_paths:
+            try:
+                video_cost, frames = estimate_cost(video_path)
+            except OSError:
+                video_cost, frames = 0.0, 0  # reported on its own line
+            cost += video_cost
+            frame_limits.append(frames)
+        admitted.enter_context(admission.admit(request.remote_addr, cost))
+    except BaseException as e:
+        for video_path in video_paths:
+            os.remove(video_path)
+        if isinstance(e, Rejected):
+            return rejected_response(e)
+        raise
+
+    def stream():
+        try:
+            for i, result in decode_batch(model, video_paths, num_chords, frame_limits):
+                line = {'index': i, 'filename': files[i].filename}
+                if isinstance(result, tuple):
+                    line.update(status=201, output=result[0], state=result[1])
+                elif result is None or isinstance(result, OSError):
+                    line.update(status=422, error='Input video is not lofifiable.')
+                elif isinstance(result, FrameLimitExceeded):
+                    line.update(status=422, error=str(result))
+                else:
+                    line.update(status=500, error=f'Server error: {str(result)}')
+                yield dumps(line) + '\n'
+        finally:
+            # also runs when the client disconnects and the server closes the stream
+            admitted.close()
+            for video_path in video_paths:
+                os.remove(video_path)
+
+    response = app.response_class(stream(), mimetype='application/x-ndjson')
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response, 200
+
+
+@app.route('/decode/<content_hash>', methods=['GET'])
+@instrumented('decode_memo')
+def decode_memo_endpoint(content_hash):
+    """
+    Seeded /decode result of an already uploaded video, by the SHA-256 of its bytes (the Content-Location
+    of the POST). Cacheable by browsers and CDNs; 404 once the result is no longer memoized.
+    """
+    seed = request.args.get('seed', type=int)
+    num_chords = request.args.get('num_chords', 4, type=int)
+    if not re.fullmatch(r"[0-9a-f]{64}", content_hash) or seed is None:
+        response = jsonify({'error': 'Expected /decode/<sha256 of the video>?seed=<seed>'})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 400
+
+    key = memo_key(content_hash, seed, num_chords, result_version)
+    if request.if_none_match.contains(etag(key)):
+        return not_modified(key)
+    result = memo.get(key)
+    if result is None:
+        response = jsonify({'error': 'Unknown video or seed, POST the video to /decode'})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 404
+    if result == NOT_LOFIFIABLE:
+        response = jsonify({'error': 'Input video is not lofifiable.'})
+        add_cache_headers(response, key)
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 422
+
+    json, state = result
+    response = jsonify(json)
+    add_state_header(response, state)
+    add_cache_headers(response, key)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response, 200
+
+
+def rejected_response(rejected):
+    response = jsonify({'error': str(rejected)})
+    if rejected.retry_after is not None:
+        response.headers['Retry-After'] = str(max(1, round(rejected.retry_after)))
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response, rejected.status
+
+
+def not_modified(key):
+    response = app.response_class(status=304)
+    add_cache_headers(response, key)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response, 304
+
+
+def add_cache_headers(response, key):
+    # the result never changes for a key, it only stops being served when result_version changes
+    response.set_etag(etag(key))
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers.add('Access-Control-Expose-Headers', 'ETag')
+
+
+@app.route('/continue', methods=['POST'])
+@instrumented('continue')
+def continue_endpoint():
+    """Generate the next bars of a track from the X-Lofi-State token returned by /decode or /continue."""
+    body = request.get_json(silent=True) or {}
+    state = body.get('state') or request.headers.get('X-Lofi-State')
+    num_chords = body.get('num_chords', 4)
+    if not state:
+        response = jsonify({'error': 'No state given'})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 400
+    if not isinstance(num_chords, int) or not 1 <= num_chords <= MAX_CHORD_LENGTH:
+        response = jsonify({'error': f'num_chords must be between 1 and {MAX_CHORD_LENGTH}'})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 400
+
+    try:
+        with admission.admit(request.remote_addr, CONTINUE_COST * num_chords / 4):
+            json, state = continue_decode(model, state, num_chords)
+    except Rejected as e:
+        return rejected_response(e)
+    except ValueError as e:
+        response = jsonify({'error': str(e)})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 400
+
+    response = jsonify(json)
+    add_state_header(response, state)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response, 201
+
+
+def add_state_header(response, state):
+    # opaque decoder state token, passed back to /continue to extend the track
+    response.headers['X-Lofi-State'] = state
+    response.headers.add('Access-Control-Expose-Headers', 'X-Lofi-State')
+
+
+def process_command(args):
+    """
+    One-shot compatibility CLI: decode a single video and write the Output JSON to the output path,
+    or the rendered audio if the output path ends in .wav.
+    """
+    result = decode(model, args.input, args.num_chords, args.seed)
+    if result is None or isinstance(result, str):
+        print(f"Input video is not lofifiable: {args.input}", file=sys.stderr)
+        sys.exit(2)
+    json, _ = result
+    write_output(json, args.output)
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True)
+    parser = argparse.ArgumentParser(description="Lofi server")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("serve", help="run the Flask server (default)")
+
+    process_parser = subparsers.add_parser("process", help="decode one video and exit")
+    process_parser.add_argument("input")
+    process_parser.add_argument("output")
+    process_parser.add_argument("--num_chords", type=int, default=4)
+    process_parser.add_argument("--seed", type=int, help="same video and seed give the same song")
+    # accepted for compatibility with server/audioProcessor.ts, not used by the decoder
+    process_parser.add_argument("--chill_level", type=float)
+    process_parser.add_argument("--beat_intensity", type=float)
+    process_parser.add_argument("--vintage_effect", type=float)
+    process_parser.add_argument("--mood")
+
+    worker_parser = subparsers.add_parser("worker", help="keep models loaded and serve line-delimited JSON jobs")
+    worker_parser.add_argument("--socket", help="listen on this Unix socket instead of stdin/stdout")
+    worker_parser.add_argument("--concurrency", type=int, default=worker.DEFAULT_CONCURRENCY)
+
+    args = parser.parse_args()
+    if args.command == "process":
+        process_command(args)
+    elif args.command == "worker":
+        if args.socket:
+            worker.serve_socket(model, args.socket, args.concurrency)
+        else:
+            worker.serve_stdio(model, args.concurrency)
+    else:
+        app.run(host="0.0.0.0", port=8080, debug=True)
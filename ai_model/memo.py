@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# Memoized /decode results of seeded requests. A result only depends on the video bytes, the seed, num_chords
+# and the model (checkpoint and generation bank), so it is keyed by exactly those.
+# The most recent entries stay in memory; entries evicted from there are spilled to disk as small JSON files
+# and promoted back on their next hit. The disk keeps about max_disk_entries files, oldest are pruned.
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_DISK_ENTRIES = 100000
+# the spill directory is pruned every this many spilled entries, so it can briefly hold that many extra files
+PRUNE_EVERY = 1000
+NOT_LOFIFIABLE = "not_lofifiable"
+
+
+def hash_upload(stream, path, chunk_size=1 << 20):
+    """Copy an upload stream to path and return the SHA-256 hex digest of its bytes, in one pass."""
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        for chunk in iter(lambda: stream.read(chunk_size), b""):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def memo_key(content_hash, seed, num_chords, model_version):
+    return hashlib.sha256(f"{content_hash}:{seed}:{num_chords}:{model_version}".encode()).hexdigest()
+
+
+def etag(key):
+    """Strong entity tag (unquoted) of the response stored under key: the result is fully determined by the key."""
+    return key[:32]
+
+
+class ResponseMemo:
+    """
+    Thread-safe LRU of key -> result with an on-disk spill.
+    A result is the (Output JSON, state token) tuple of decode, or NOT_LOFIFIABLE.
+    """
+
+    def __init__(self, spill_dir=None, max_entries=DEFAULT_MAX_ENTRIES, max_disk_entries=DEFAULT_MAX_DISK_ENTRIES):
+        self.spill_dir = spill_dir
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = 0
+        self.spilled = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        result = self._read_spill(key)
+        with self.lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put(key, result)
+        return result
+
+    def put(self, key, result):
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            evicted = []
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False))
+        for evicted_key, evicted_result in evicted:
+            self._write_spill(evicted_key, evicted_result)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f"{key}.json")
+
+    def _read_spill(self, key):
+        if not self.spill_dir:
+            return None
+        try:
+            with open(self._spill_path(key)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get(NOT_LOFIFIABLE):
+            return NOT_LOFIFIABLE
+        return (data["output"], data["state"]) if "output" in data and "state" in data else None
+
+    def _write_spill(self, key, result):
+        if not self.spill_dir:
+            return
+        data = {NOT_LOFIFIABLE: True} if result == NOT_LOFIFIABLE else {"output": result[0], "state": result[1]}
+        # write then rename, so a reader never sees a partial file
+        path = self._spill_path(key)
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+        with self.lock:
+            self.spilled += 1
+            prune = self.spilled % PRUNE_EVERY == 0
+        if prune:
+            self._prune_spill()
+
+    def _prune_spill(self):
+        names = [name for name in os.listdir(self.spill_dir) if name.endswith(".json")]
+        if len(names) <= self.max_disk_entries:
+            return
+        paths = sorted((os.path.join(self.spill_dir, name) for name in names), key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,213 @@
+import contextvars
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-request stage timings and process-wide histograms for the /decode pipeline.
+#
+# Pipeline code wraps its stages in `with stage("clip_encode"):` (or calls record_stage for time accumulated
+# across a generator). Every stage is observed into the lofi_stage_seconds histogram and, when a request trace
+# is active in the current context (see trace()), into that request's Trace as well.
+# render() returns all metrics in the Prometheus text exposition format for the /metrics endpoint.
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+REQUEST_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def header(self, kind):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {kind}"]
+
+
+class Counter(Metric):
+    def inc(self, labels=(), value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        with self.lock:
+            return self.header("counter") + [f"{self.name}{format_labels(self.label_names, labels)} {value}"
+                                             for labels, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    def set(self, labels=(), value=0):
+        with self.lock:
+            self.values[labels] = value
+
+    def render(self):
+        with self.lock:
+            return self.header("gauge") + [f"{self.name}{format_labels(self.label_names, labels)} {value}"
+                                           for labels, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    def __init__(self, name, help, label_names=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels=(), value=0.0):
+        with self.lock:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1  # +Inf
+            self.values[labels] = (counts, total + value)
+
+    def render(self):
+        lines = self.header("histogram")
+        names = self.label_names + ("le",)
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {counts[-1]}")
+        return lines
+
+
+registry = []
+stage_seconds = Histogram("lofi_stage_seconds", "Time spent in each pipeline stage.", ["stage"])
+request_seconds = Histogram("lofi_request_seconds", "Request latency by endpoint and status.",
+                            ["endpoint", "status"], REQUEST_BUCKETS)
+frames_total = Counter("lofi_frames_total", "Video frames by pipeline step (seen, kept after the pixel filter, "
+                                            "kept after embedding dedup).", ["kind"])
+admission_total = Counter("lofi_admission_total", "Admission decisions (admitted, queued then admitted, shed_client "
+                                                  "over its rate, shed_busy after waiting).", ["decision"])
+singleflight_total = Counter("lofi_singleflight_total", "Coalesced work by role (leader ran it, thread or process "
+                                                        "shared a result computed elsewhere).", ["role"])
+cascade_total = Counter("lofi_cascade_total", "Lofifiability verdicts by cascade stage (decided by the student, "
+                                              "escalated to CLIP).", ["stage"])
+stage_rss_bytes = Gauge("lofi_stage_rss_bytes", "Resident set size at the end of the last run of each stage.",
+                        ["stage"])
+stage_peak_rss_bytes = Gauge("lofi_stage_peak_rss_bytes", "Process peak resident set size after each stage.",
+                             ["stage"])
+stage_cuda_peak_bytes = Gauge("lofi_stage_cuda_peak_bytes", "Peak CUDA tensor memory during the last run of "
+                                                            "each stage.", ["stage"])
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # bytes on macOS, kilobytes on Linux
+
+
+def cuda_ready():
+    # never import torch (or initialize CUDA) just for metrics
+    torch = sys.modules.get("torch")
+    return torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized()
+
+
+class Trace:
+    """Stage timings, memory and frame counts of one request."""
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        # pipelined stages of one request record from several threads
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, seconds, memory):
+        with self.lock:
+            entry = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            entry["seconds"] += seconds
+            entry["calls"] += 1
+            for key, value in memory.items():
+                entry[key] = max(entry.get(key, 0), value)
+
+    def add_count(self, kind, value):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + value
+
+    def server_timing(self):
+        """Stage timings as a Server-Timing header value, shown by browser dev tools."""
+        return ", ".join(f"{name};dur={entry['seconds'] * 1000:.1f}" for name, entry in self.stages.items())
+
+    def summary(self):
+        return {"stages": {name: {**entry, "seconds": round(entry["seconds"], 6)}
+                           for name, entry in self.stages.items()},
+                "counts": self.counts}
+
+
+current_trace = contextvars.ContextVar("lofi_trace", default=None)
+
+
+@contextmanager
+def trace():
+    """
+    Collect the stages run in this context into a new Trace. Threads started for the request see it
+    when they run in a copy of the context (contextvars.copy_context().run).
+    """
+    request_trace = Trace()
+    token = current_trace.set(request_trace)
+    try:
+        yield request_trace
+    finally:
+        current_trace.reset(token)
+
+
+def record_stage(name, seconds):
+    memory = {"rss_bytes": rss_bytes(), "peak_rss_bytes": peak_rss_bytes()}
+    if cuda_ready():
+        import torch
+        memory["cuda_peak_bytes"] = torch.cuda.max_memory_allocated()
+        stage_cuda_peak_bytes.set((name,), memory["cuda_peak_bytes"])
+
+    stage_seconds.observe((name,), seconds)
+    stage_rss_bytes.set((name,), memory["rss_bytes"])
+    stage_peak_rss_bytes.set((name,), memory["peak_rss_bytes"])
+    request_trace = current_trace.get()
+    if request_trace is not None:
+        request_trace.add_stage(name, seconds, memory)
+
+
+@contextmanager
+def stage(name):
+    if cuda_ready():
+        import torch
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def count_frames(kind, value):
+    frames_total.inc((kind,), value)
+    request_trace = current_trace.get()
+    if request_trace is not None:
+        request_trace.add_count(kind, value)
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -49,6 +49,16 @@ NUMBER_OF_MELODY_OCTAVES = 2
 MELODY_PREDICTION_LENGTH = 1 + NUMBER_OF_MELODY_OCTAVES * 7
 MELODY_REST_TOKEN = 0
 
+# melody decoder head: "lstm" predicts the notes of a measure one after another,
+# "parallel" predicts all NOTES_PER_CHORD notes of a measure at once from the chord state
+MELODY_HEADS = ["lstm", "parallel"]
+MELODY_HEAD = "lstm"
+# kernel size of the 1D convolutions over note positions in the parallel melody head
+MELODY_CONV_KERNEL_SIZE = 3
+# log-probability a beam search candidate gives up for every beam already kept with the same chord progression,
+# so that the beams of a song differ in their chords and not only in their notes (0 is plain beam search)
+BEAM_DIVERSITY = 2.0
+
 NUMBER_OF_KEYS = 12
 KEY_TO_NUM = {
     "C": 0,
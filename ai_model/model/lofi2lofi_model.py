@@ -1,19 +1,23 @@
+import base64
+import math
+import struct
 from hashlib import md5
 
 import numpy as np
 import torch
 from torch import nn
+from torch.nn import functional as F
 from torch.nn.utils.rnn import pack_padded_sequence
 
 from model.constants import *
 
 
 class Lofi2LofiModel(nn.Module):
-    def __init__(self, device="cuda" if torch.cuda.is_available() else "cpu"):
+    def __init__(self, device="cuda" if torch.cuda.is_available() else "cpu", melody_head=MELODY_HEAD, fused=False):
         super(Lofi2LofiModel, self).__init__()
         self.device = device
         self.encoder = Encoder(device)
-        self.decoder = Decoder(device)
+        self.decoder = Decoder(device, melody_head, fused)
         self.mean_linear = nn.Linear(in_features=HIDDEN_SIZE, out_features=HIDDEN_SIZE)
         self.variance_linear = nn.Linear(in_features=HIDDEN_SIZE, out_features=HIDDEN_SIZE)
 
@@ -91,10 +95,40 @@ class Encoder(nn.Module):
             dim=1))
 
 
+class ParallelMelodyHead(nn.Module):
+    """Predicts all NOTES_PER_CHORD notes of a measure at once from the chord state."""
+
+    def __init__(self):
+        super(ParallelMelodyHead, self).__init__()
+        self.state_downsample = nn.Linear(in_features=2 * HIDDEN_SIZE, out_features=HIDDEN_SIZE)
+        self.note_positions = nn.Parameter(torch.randn(NOTES_PER_CHORD, HIDDEN_SIZE) * 0.02)
+        self.note_convolutions = nn.Sequential(
+            nn.Conv1d(HIDDEN_SIZE, HIDDEN_SIZE, MELODY_CONV_KERNEL_SIZE, padding=MELODY_CONV_KERNEL_SIZE // 2),
+            nn.ReLU(),
+            nn.Conv1d(HIDDEN_SIZE, HIDDEN_SIZE, MELODY_CONV_KERNEL_SIZE, padding=MELODY_CONV_KERNEL_SIZE // 2),
+        )
+
+    def forward(self, chord_embeddings, hx_chords):
+        # (batch, hidden) chord state broadcast to every note position: (batch, notes, hidden)
+        h = self.state_downsample(torch.cat((chord_embeddings, hx_chords), dim=1))
+        h = h.unsqueeze(1) + self.note_positions
+        # convolve over note positions so that neighbouring notes can influence each other
+        h = h + self.note_convolutions(h.transpose(1, 2)).transpose(1, 2)
+        return torch.relu(h)
+
+
 class Decoder(nn.Module):
-    def __init__(self, device):
+    def __init__(self, device, melody_head=MELODY_HEAD, fused=False):
         super(Decoder, self).__init__()
+        if melody_head not in MELODY_HEADS:
+            raise ValueError(f"melody_head must be one of {MELODY_HEADS}")
         self.device = device
+        self.melody_head = melody_head
+        # generate with run_fused when there is no state to resume from, see there
+        self.fused = fused
+        # short hash of the loaded weights (generation_bank.checkpoint_version), set by whoever loads them; state
+        # tokens carry it and the melody head, so that a token only continues on the decoder that made it
+        self.checkpoint_version = None
 
         self.chords_lstm = nn.LSTMCell(input_size=HIDDEN_SIZE * 1, hidden_size=HIDDEN_SIZE * 1)
         self.chord_embeddings = nn.Embedding(num_embeddings=CHORD_PREDICTION_LENGTH, embedding_dim=HIDDEN_SIZE)
@@ -105,14 +139,18 @@ class Decoder(nn.Module):
         )
         self.chord_embedding_downsample = nn.Linear(in_features=2 * HIDDEN_SIZE, out_features=HIDDEN_SIZE)
 
-        self.melody_embeddings = nn.Embedding(num_embeddings=MELODY_PREDICTION_LENGTH, embedding_dim=HIDDEN_SIZE)
-        self.melody_lstm = nn.LSTMCell(input_size=HIDDEN_SIZE * 1, hidden_size=HIDDEN_SIZE * 1)
+        if melody_head == "parallel":
+            self.parallel_melody = ParallelMelodyHead()
+        else:
+            self.melody_embeddings = nn.Embedding(num_embeddings=MELODY_PREDICTION_LENGTH,
+                                                  embedding_dim=HIDDEN_SIZE)
+            self.melody_lstm = nn.LSTMCell(input_size=HIDDEN_SIZE * 1, hidden_size=HIDDEN_SIZE * 1)
+            self.melody_embedding_downsample = nn.Linear(in_features=3 * HIDDEN_SIZE, out_features=HIDDEN_SIZE)
         self.melody_prediction = nn.Sequential(
             nn.Linear(in_features=HIDDEN_SIZE, out_features=HIDDEN_SIZE),
             nn.ReLU(),
             nn.Linear(in_features=HIDDEN_SIZE, out_features=MELODY_PREDICTION_LENGTH)
         )
-        self.melody_embedding_downsample = nn.Linear(in_features=3 * HIDDEN_SIZE, out_features=HIDDEN_SIZE)
 
         self.key_linear = nn.Sequential(
             nn.Linear(in_features=HIDDEN_SIZE, out_features=HIDDEN_SIZE2),
@@ -140,7 +178,22 @@ class Decoder(nn.Module):
             nn.Linear(in_features=HIDDEN_SIZE2, out_features=1),
         )
 
-    def decode(self, mu):
+    def decode(self, mu, num_chords=4):
+        return self.hash(mu), self(mu, num_chords)
+
+    def decode_with_state(self, mu=None, num_chords=4, state=None, sampler=None):
+        """Like decode, but also returns the DecoderState needed to continue the track.
+
+        When a state is given, generation resumes where that state left off and mu is taken from it.
+        With a sampler, the chords and notes are drawn by it, see run.
+        """
+        if state is not None:
+            mu = state.z
+        outputs, state = self.run(mu, num_chords, state=state, sampler=sampler)
+        return self.hash(mu), outputs, state
+
+    @staticmethod
+    def hash(mu):
         # create a hash for vector mu
         hash = ""
         # first 20 characters are each sampled from 5 entries
@@ -148,11 +201,24 @@ class Decoder(nn.Module):
             hash += str((mu[0][i:i + 1].abs().sum() * 587).int().item())[-1]
         # last 4 characters are the beginning of the MD5 hash of the whole vector
         hash2 = int(md5(mu.numpy()).hexdigest(), 16)
-        hash = f"#{hash}{hash2}"[:25]
-        return hash, self(mu, 4)
+        return f"#{hash}{hash2}"[:25]
 
     def forward(self, z, num_chords=MAX_CHORD_LENGTH, sampling_rate_chords=0, sampling_rate_melodies=0, gt_chords=None,
                 gt_melody=None):
+        outputs, _ = self.run(z, num_chords, sampling_rate_chords, sampling_rate_melodies, gt_chords, gt_melody)
+        return outputs
+
+    def run(self, z, num_chords=MAX_CHORD_LENGTH, sampling_rate_chords=0, sampling_rate_melodies=0, gt_chords=None,
+            gt_melody=None, state=None, sampler=None):
+        """
+        Generate num_chords chords and their melody from z, or from state, and return the outputs with the
+        DecoderState to continue from. Chords and notes are fed back greedily (argmax), or drawn by sampler.
+        With a sampler, the chord and melody outputs are the (batch, steps) tokens it drew instead of logits.
+        """
+        if self.fused and state is None:
+            return self.run_fused(z, num_chords, sampling_rate_chords, sampling_rate_melodies, gt_chords, gt_melody,
+                                  sampler)
+        pick = sampler or greedy
         tempo_output = self.tempo_linear(z)
         key_output = self.key_linear(z)
         mode_output = self.mode_linear(z)
@@ -160,36 +226,51 @@ class Decoder(nn.Module):
         energy_output = self.energy_linear(z)
 
         batch_size = z.shape[0]
-        # initialize hidden states and cell states
-        hx_chords = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
-        cx_chords = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
-        hx_melody = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
-        cx_melody = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
+        if state is None:
+            # initialize hidden states and cell states
+            hx_chords = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
+            cx_chords = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
+            hx_melody = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
+            cx_melody = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
+
+            # the chord LSTM input at first only consists of z
+            # after the first iteration, we use the chord embeddings
+            chord_embeddings = z
+            melody_embeddings = None  # these will be set in the very first iteration
+        else:
+            # resume from a previous generation
+            hx_chords, cx_chords = state.hx_chords, state.cx_chords
+            hx_melody, cx_melody = state.hx_melody, state.cx_melody
+            chord_embeddings, melody_embeddings = state.chord_embeddings, state.melody_embeddings
 
         chord_outputs = []
         melody_outputs = []
 
-        # the chord LSTM input at first only consists of z
-        # after the first iteration, we use the chord embeddings
-        chord_embeddings = z
-        melody_embeddings = None  # these will be set in the very first iteration
-
         for i in range(num_chords):
             hx_chords, cx_chords = self.chords_lstm(chord_embeddings, (hx_chords, cx_chords))
             chord_prediction = self.chord_prediction(hx_chords)
-            chord_outputs.append(chord_prediction)
 
             # perform teacher forcing during training
             perform_teacher_forcing_chords = bool(
                 np.random.choice(2, 1, p=[1 - sampling_rate_chords, sampling_rate_chords])[0])
             if gt_chords is not None and perform_teacher_forcing_chords:
-                chord_embeddings = self.chord_embeddings(gt_chords[:, i])
+                chords = gt_chords[:, i]
             else:
-                chord_embeddings = self.chord_embeddings(chord_prediction.argmax(dim=1))
+                chords = pick(chord_prediction)
+            chord_outputs.append(chord_prediction if sampler is None else chords)
+            chord_embeddings = self.chord_embeddings(chords)
 
             # let z influence the chord embedding
             chord_embeddings = self.chord_embedding_downsample(torch.cat((chord_embeddings, z), dim=1))
 
+            if self.melody_head == "parallel":
+                # one prediction per note position, independent of the previously predicted notes
+                melody_prediction = self.melody_prediction(self.parallel_melody(chord_embeddings, hx_chords))
+                if sampler is not None:
+                    melody_prediction = sampler(melody_prediction.flatten(0, 1)).view(batch_size, NOTES_PER_CHORD)
+                melody_outputs.extend(melody_prediction.unbind(dim=1))
+                continue
+
             # the melody LSTM input at first only includes the chord embeddings
             # after the first iteration, the input also includes the melody embeddings of the notes up to that point
             if melody_embeddings is None:
@@ -197,18 +278,392 @@ class Decoder(nn.Module):
             for j in range(NOTES_PER_CHORD):
                 hx_melody, cx_melody = self.melody_lstm(melody_embeddings, (hx_melody, cx_melody))
                 melody_prediction = self.melody_prediction(hx_melody)
-                melody_outputs.append(melody_prediction)
                 # perform teacher forcing during training
                 perform_teacher_forcing = bool(
                     np.random.choice(2, 1, p=[1 - sampling_rate_melodies, sampling_rate_melodies])[0])
                 if gt_melody is not None and perform_teacher_forcing:
-                    melody_embeddings = self.melody_embeddings(gt_melody[:, i * NOTES_PER_CHORD + j])
+                    melodies = gt_melody[:, i * NOTES_PER_CHORD + j]
                 else:
-                    melody_embeddings = self.melody_embeddings(melody_prediction.argmax(dim=1))
+                    melodies = pick(melody_prediction)
+                melody_outputs.append(melody_prediction if sampler is None else melodies)
+                melody_embeddings = self.melody_embeddings(melodies)
                 melody_embeddings = self.melody_embedding_downsample(
                     torch.cat((melody_embeddings, chord_embeddings, z), dim=1))
 
         chord_outputs = torch.stack(chord_outputs, dim=1)
         melody_outputs = torch.stack(melody_outputs, dim=1)
 
-        return chord_outputs, melody_outputs, tempo_output, key_output, mode_output, valence_output, energy_output
+        if melody_embeddings is None:
+            # the parallel melody head keeps no state of its own
+            melody_embeddings = torch.zeros_like(chord_embeddings)
+        state = DecoderState(z, hx_chords, cx_chords, hx_melody, cx_melody, chord_embeddings, melody_embeddings)
+        return (chord_outputs, melody_outputs, tempo_output, key_output, mode_output, valence_output, energy_output), \
+            state
+
+    def run_fused(self, z, num_chords=MAX_CHORD_LENGTH, sampling_rate_chords=0, sampling_rate_melodies=0,
+                  gt_chords=None, gt_melody=None, sampler=None):
+        """run() from the start of a song, restructured for speed with the same weights and the same math.
+
+        Every LSTM input after the first is a downsample layer over cat(embedding lookup, context), and the LSTMs
+        only use it through their input weights. Both are linear, so they are folded into per-token gate tables
+        (vocabulary x 4 * HIDDEN_SIZE) plus context terms: the z part once per forward pass, the chord's part of
+        the melody input once per chord. A step is then a table lookup and the recurrent matmul, instead of an
+        embedding, a concat, a downsample and an input matmul. Results match run() up to float rounding.
+        """
+        pick = sampler or greedy
+        tempo_output = self.tempo_linear(z)
+        key_output = self.key_linear(z)
+        mode_output = self.mode_linear(z)
+        valence_output = self.valence_linear(z)
+        energy_output = self.energy_linear(z)
+
+        batch_size = z.shape[0]
+        hx_chords = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
+        cx_chords = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
+        hx_melody = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
+        cx_melody = torch.zeros(batch_size, HIDDEN_SIZE, device=self.device)
+
+        # chord_embedding_downsample(cat(chord_embeddings(c), z)) = chord_table[c] + chord_z
+        chord_weight = self.chord_embedding_downsample.weight
+        chord_table = self.chord_embeddings.weight @ chord_weight[:, :HIDDEN_SIZE].t()
+        chord_z = F.linear(z, chord_weight[:, HIDDEN_SIZE:], self.chord_embedding_downsample.bias)
+        # input gates of the chord LSTM for such an input, with its recurrent bias folded in
+        chords_lstm = self.chords_lstm
+        chord_gate_table = chord_table @ chords_lstm.weight_ih.t()
+        chord_gate_z = F.linear(chord_z, chords_lstm.weight_ih, chords_lstm.bias_ih + chords_lstm.bias_hh)
+        # the first input is z itself
+        chord_gates = F.linear(z, chords_lstm.weight_ih, chords_lstm.bias_ih + chords_lstm.bias_hh)
+
+        if self.melody_head == "lstm":
+            # melody_embedding_downsample(cat(melody_embeddings(m), chord, z)) = melody_table[m] + melody_context,
+            # with melody_context = chord @ melody_chord_weight.T + melody_z
+            melody_weight = self.melody_embedding_downsample.weight
+            melody_table = self.melody_embeddings.weight @ melody_weight[:, :HIDDEN_SIZE].t()
+            melody_chord_weight = melody_weight[:, HIDDEN_SIZE:2 * HIDDEN_SIZE]
+            melody_z = F.linear(z, melody_weight[:, 2 * HIDDEN_SIZE:], self.melody_embedding_downsample.bias)
+            melody_lstm = self.melody_lstm
+            melody_gate_table = melody_table @ melody_lstm.weight_ih.t()
+            # gates of melody_context for chord c: context_gate_table[c] + context_gate_z
+            context_gate_table = chord_table @ melody_chord_weight.t() @ melody_lstm.weight_ih.t()
+            context_gate_z = F.linear(F.linear(chord_z, melody_chord_weight) + melody_z, melody_lstm.weight_ih,
+                                      melody_lstm.bias_ih + melody_lstm.bias_hh)
+
+        chord_outputs = []
+        melody_outputs = []
+        melody_gates = None
+        chords = melodies = None
+
+        for i in range(num_chords):
+            hx_chords, cx_chords = lstm_cell(chord_gates, hx_chords, cx_chords, chords_lstm.weight_hh)
+            chord_prediction = self.chord_prediction(hx_chords)
+
+            if teacher_force(sampling_rate_chords) and gt_chords is not None:
+                chords = gt_chords[:, i]
+            else:
+                chords = pick(chord_prediction)
+            chord_outputs.append(chord_prediction if sampler is None else chords)
+            chord_gates = chord_gate_table[chords] + chord_gate_z
+
+            if self.melody_head == "parallel":
+                chord_embeddings = chord_table[chords] + chord_z
+                melody_prediction = self.melody_prediction(self.parallel_melody(chord_embeddings, hx_chords))
+                if sampler is not None:
+                    melody_prediction = sampler(melody_prediction.flatten(0, 1)).view(batch_size, NOTES_PER_CHORD)
+                melody_outputs.extend(melody_prediction.unbind(dim=1))
+                continue
+
+            if melody_gates is None:
+                # the first melody input is the chord embedding
+                melody_gates = F.linear(chord_table[chords] + chord_z, melody_lstm.weight_ih,
+                                        melody_lstm.bias_ih + melody_lstm.bias_hh)
+            context_gates = context_gate_table[chords] + context_gate_z
+            for j in range(NOTES_PER_CHORD):
+                hx_melody, cx_melody = lstm_cell(melody_gates, hx_melody, cx_melody, melody_lstm.weight_hh)
+                melody_prediction = self.melody_prediction(hx_melody)
+                if teacher_force(sampling_rate_melodies) and gt_melody is not None:
+                    melodies = gt_melody[:, i * NOTES_PER_CHORD + j]
+                else:
+                    melodies = pick(melody_prediction)
+                melody_outputs.append(melody_prediction if sampler is None else melodies)
+                melody_gates = melody_gate_table[melodies] + context_gates
+
+        chord_outputs = torch.stack(chord_outputs, dim=1)
+        melody_outputs = torch.stack(melody_outputs, dim=1)
+
+        # the LSTM inputs for the next step, as run() returns them
+        chord_embeddings = z if chords is None else chord_table[chords] + chord_z
+        if melodies is not None:
+            melody_context = F.linear(chord_embeddings, melody_chord_weight) + melody_z
+            melody_embeddings = melody_table[melodies] + melody_context
+        else:
+            melody_embeddings = torch.zeros_like(chord_embeddings)
+        state = DecoderState(z, hx_chords, cx_chords, hx_melody, cx_melody, chord_embeddings, melody_embeddings)
+        return (chord_outputs, melody_outputs, tempo_output, key_output, mode_output, valence_output, energy_output), \
+            state
+
+    def beam_search(self, z, num_chords=4, beam_width=4, diversity=BEAM_DIVERSITY):
+        """
+        The beam_width most likely songs of each row of z, best first.
+
+        The beams of a row run side by side in the batch dimension, so each step advances all beams of all rows
+        at once, and the states are then reordered by the index of each surviving beam's parent. Every chord and
+        every note is a step. The parallel melody head has no note-by-note choice: its notes are the most likely
+        ones for the chord, and they count towards the beam's score.
+        Plain beam search spends the beams on melodies of one chord progression. With diversity, a candidate is
+        ranked diversity lower for every better candidate with the chord progression it makes (see beam_step),
+        the scores stay the beams' log-probabilities.
+
+        Returns the (batch, beam_width, steps) chord and note tokens and the song parameter outputs, the beams'
+        summed log-probabilities (batch, beam_width), and the DecoderState of the batch * beam_width beams, with
+        beam k of row i at i * beam_width + k.
+        """
+        tempo_output = self.tempo_linear(z)
+        key_output = self.key_linear(z)
+        mode_output = self.mode_linear(z)
+        valence_output = self.valence_linear(z)
+        energy_output = self.energy_linear(z)
+
+        batch_size = z.shape[0]
+        z = z.repeat_interleave(beam_width, dim=0)
+        hx_chords = torch.zeros(batch_size * beam_width, HIDDEN_SIZE, device=self.device)
+        cx_chords = torch.zeros(batch_size * beam_width, HIDDEN_SIZE, device=self.device)
+        hx_melody = torch.zeros(batch_size * beam_width, HIDDEN_SIZE, device=self.device)
+        cx_melody = torch.zeros(batch_size * beam_width, HIDDEN_SIZE, device=self.device)
+        chord_tokens = torch.zeros(batch_size * beam_width, 0, dtype=torch.long, device=self.device)
+        melody_tokens = torch.zeros(batch_size * beam_width, 0, dtype=torch.long, device=self.device)
+        # the beams of a row start out the same, only the first one is extended at the first step
+        scores = torch.full((batch_size, beam_width), -math.inf, device=self.device)
+        scores[:, 0] = 0
+
+        chord_embeddings = z
+        # the melody LSTM input at first only includes the chord embeddings, as in run
+        melody_embeddings = None
+
+        for i in range(num_chords):
+            hx_chords, cx_chords = self.chords_lstm(chord_embeddings, (hx_chords, cx_chords))
+            groups = progression_groups(chord_tokens, beam_width, CHORD_PREDICTION_LENGTH, True) if diversity else None
+            scores, beams, chords = beam_step(scores, self.chord_prediction(hx_chords).log_softmax(dim=1), groups,
+                                              diversity)
+            hx_chords, cx_chords, hx_melody, cx_melody, melody_tokens = \
+                reorder(beams, hx_chords, cx_chords, hx_melody, cx_melody, melody_tokens)
+            if melody_embeddings is not None:
+                melody_embeddings = melody_embeddings[beams]
+            chord_tokens = torch.cat((chord_tokens[beams], chords.unsqueeze(1)), dim=1)
+            chord_embeddings = self.chord_embedding_downsample(torch.cat((self.chord_embeddings(chords), z), dim=1))
+
+            if self.melody_head == "parallel":
+                melody_prediction = self.melody_prediction(self.parallel_melody(chord_embeddings, hx_chords))
+                log_probs, melodies = melody_prediction.log_softmax(dim=2).max(dim=2)
+                scores = scores + log_probs.sum(dim=1).view(batch_size, beam_width)
+                melody_tokens = torch.cat((melody_tokens, melodies), dim=1)
+                continue
+
+            if melody_embeddings is None:
+                melody_embeddings = chord_embeddings
+            for j in range(NOTES_PER_CHORD):
+                hx_melody, cx_melody = self.melody_lstm(melody_embeddings, (hx_melody, cx_melody))
+                groups = progression_groups(chord_tokens, beam_width, MELODY_PREDICTION_LENGTH, False) \
+                    if diversity else None
+                scores, beams, melodies = beam_step(scores, self.melody_prediction(hx_melody).log_softmax(dim=1),
+                                                    groups, diversity)
+                hx_chords, cx_chords, hx_melody, cx_melody, chord_embeddings, chord_tokens = \
+                    reorder(beams, hx_chords, cx_chords, hx_melody, cx_melody, chord_embeddings, chord_tokens)
+                melody_tokens = torch.cat((melody_tokens[beams], melodies.unsqueeze(1)), dim=1)
+                melody_embeddings = self.melody_embedding_downsample(
+                    torch.cat((self.melody_embeddings(melodies), chord_embeddings, z), dim=1))
+
+        # best first, the parallel head's note scores are added after the beams were chosen
+        scores, order = scores.sort(dim=1, descending=True)
+        beams = (order + torch.arange(batch_size, device=self.device).unsqueeze(1) * beam_width).view(-1)
+        hx_chords, cx_chords, hx_melody, cx_melody, chord_embeddings, chord_tokens, melody_tokens = \
+            reorder(beams, hx_chords, cx_chords, hx_melody, cx_melody, chord_embeddings, chord_tokens, melody_tokens)
+        if melody_embeddings is None:
+            melody_embeddings = torch.zeros_like(chord_embeddings)
+        else:
+            melody_embeddings = melody_embeddings[beams]
+
+        state = DecoderState(z, hx_chords, cx_chords, hx_melody, cx_melody, chord_embeddings, melody_embeddings)
+        return (chord_tokens.view(batch_size, beam_width, -1), melody_tokens.view(batch_size, beam_width, -1),
+                tempo_output, key_output, mode_output, valence_output, energy_output), scores, state
+
+
+def greedy(logits):
+    """The most likely token of each row of a (batch, vocabulary) logits tensor."""
+    return logits.argmax(dim=1)
+
+
+class Sampler:
+    """
+    Draws a token from each row of a (batch, vocabulary) logits tensor, to feed back into the decoder.
+
+    Logits are divided by temperature (0 is greedy), and only the top_k most likely tokens (0 for all of them)
+    that are also among the most likely ones whose probabilities add up to top_p stay candidates.
+    A torch.Generator makes the draws reproducible.
+    """
+
+    def __init__(self, temperature=1.0, top_k=0, top_p=1.0, generator=None):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.generator = generator
+
+    def __call__(self, logits):
+        if self.temperature == 0:
+            return greedy(logits)
+        logits = logits / self.temperature
+        if self.top_k:
+            kth = logits.topk(min(self.top_k, logits.shape[1]), dim=1).values[:, -1:]
+            logits = logits.masked_fill(logits < kth, -math.inf)
+        if self.top_p < 1:
+            sorted_logits, order = logits.sort(dim=1, descending=True)
+            probs = sorted_logits.softmax(dim=1)
+            # a token is dropped once the more likely ones already add up to top_p, the most likely always stays
+            drop = probs.cumsum(dim=1) - probs >= self.top_p
+            logits = logits.masked_fill(drop.scatter(1, order, drop), -math.inf)
+        return torch.multinomial(logits.softmax(dim=1), 1, generator=self.generator).squeeze(1)
+
+
+def beam_step(scores, log_probs, groups=None, diversity=0.0):
+    """
+    Extend every beam by every token and keep the best beam_width of each row.
+
+    scores are the (batch, beam_width) beam log-probabilities, log_probs the (batch * beam_width, vocabulary)
+    log-probabilities of the next token. Returns the new scores, and for each kept beam the index of the beam
+    it extends in the batch * beam_width dimension and the token it adds.
+    With groups, the (batch, beam_width * vocabulary) group of each candidate, and a diversity > 0, a candidate
+    ranks diversity lower for every better candidate of its group. This keeps the same beams as taking them one
+    at a time and ranking the candidates diversity lower for every beam already kept from their group, since
+    the better candidates of a group are always kept first.
+    """
+    batch_size, beam_width = scores.shape
+    vocabulary = log_probs.shape[1]
+    candidates = (scores.unsqueeze(2) + log_probs.view(batch_size, beam_width, vocabulary)).view(batch_size, -1)
+    if groups is None or not diversity:
+        scores, indices = candidates.topk(beam_width, dim=1)
+    else:
+        # the candidates ordered by group and best first within a group, a candidate's rank in its group is its
+        # position in that order minus the number of candidates in the groups before it
+        candidate_count = groups.shape[1]
+        positions = torch.arange(candidate_count, device=groups.device).expand_as(groups)
+        place = torch.empty_like(groups).scatter_(1, candidates.argsort(dim=1, descending=True), positions)
+        keys, order = (groups * candidate_count + place).sort(dim=1)
+        counts = torch.zeros_like(groups).scatter_add_(1, groups, torch.ones_like(groups))
+        starts = counts.cumsum(dim=1) - counts
+        ranks = torch.empty_like(groups).scatter_(1, order, positions - starts.gather(1, keys // candidate_count))
+        _, indices = (candidates - diversity * ranks).topk(beam_width, dim=1)
+        scores = candidates.gather(1, indices)
+    offsets = torch.arange(batch_size, device=scores.device).unsqueeze(1) * beam_width
+    beams = torch.div(indices, vocabulary, rounding_mode="floor") + offsets
+    return scores, beams.view(-1), (indices % vocabulary).view(-1)
+
+
+def progression_groups(chord_tokens, beam_width, vocabulary, chord_step):
+    """
+    The group of each (beam, token) candidate of a beam_step, for (batch * beam_width, steps) chord tokens: the
+    chord progression it makes, that is its beam's chords, followed by the token at a chord step. A progression is
+    numbered by the first beam of the row with the same chords.
+    """
+    rows = chord_tokens.view(chord_tokens.shape[0] // beam_width, beam_width, chord_tokens.shape[1])
+    first = (rows.unsqueeze(2) == rows.unsqueeze(1)).all(dim=3).int().argmax(dim=2)
+    groups = first.unsqueeze(2) * vocabulary
+    if chord_step:
+        groups = groups + torch.arange(vocabulary, device=chord_tokens.device)
+    return groups.expand(-1, -1, vocabulary).reshape(first.shape[0], -1)
+
+
+def reorder(beams, *tensors):
+    """The rows of each tensor in the order of beams."""
+    return tuple(tensor.index_select(0, beams) for tensor in tensors)
+
+
+def lstm_cell(gates, hx, cx, weight_hh):
+    """nn.LSTMCell given its input gates, with both biases already added."""
+    gates = gates + hx @ weight_hh.t()
+    input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, dim=1)
+    cx = torch.sigmoid(forget_gate) * cx + torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+    hx = torch.sigmoid(output_gate) * torch.tanh(cx)
+    return hx, cx
+
+
+def teacher_force(sampling_rate):
+    """
+    Whether to feed the ground truth at this step, with probability sampling_rate. Drawn at the same steps as in
+    run(), even for a rate of 0, so that both leave numpy's random state the same.
+    """
+    return bool(np.random.choice(2, 1, p=[1 - sampling_rate, sampling_rate])[0])
+
+
+class DecoderState:
+    """Decoder states after generating a number of chords, used to continue generation from there.
+
+    The state serializes to a compact URL-safe token: z is kept in float32 so that the song parameters and title
+    derived from it stay exact, the LSTM states and embeddings are stored in float16. The header also has the
+    melody head and checkpoint version of the decoder that made it, which must match the one continuing it.
+    """
+    VERSION = 2
+    # version, number of states, batch size, index of the melody head in MELODY_HEADS, checkpoint version
+    HEADER = struct.Struct("<BBHB8s")
+
+    def __init__(self, z, hx_chords, cx_chords, hx_melody, cx_melody, chord_embeddings, melody_embeddings):
+        self.z = z
+        self.hx_chords = hx_chords
+        self.cx_chords = cx_chords
+        self.hx_melody = hx_melody
+        self.cx_melody = cx_melody
+        self.chord_embeddings = chord_embeddings
+        self.melody_embeddings = melody_embeddings
+
+    def row(self, i):
+        """The state of the i-th sequence of a batch, as a batch of one."""
+        return DecoderState(*(tensor[i:i + 1] for tensor in (
+            self.z, self.hx_chords, self.cx_chords, self.hx_melody, self.cx_melody, self.chord_embeddings,
+            self.melody_embeddings)))
+
+    def to_token(self, melody_head=MELODY_HEAD, checkpoint_version=None):
+        return self.pack_token(self.z.detach().cpu().numpy(), self.stacked_states().numpy(), melody_head,
+                               checkpoint_version)
+
+    def stacked_states(self):
+        """The six state tensors stacked into one (6, batch, HIDDEN_SIZE) CPU tensor."""
+        return torch.stack((self.hx_chords, self.cx_chords, self.hx_melody, self.cx_melody, self.chord_embeddings,
+                            self.melody_embeddings)).detach().cpu()
+
+    @staticmethod
+    def checkpoint_bytes(checkpoint_version):
+        """The 8 header bytes of a hex checkpoint version, zeros for weights that have none."""
+        return bytes.fromhex(checkpoint_version)[:8] if checkpoint_version else bytes(8)
+
+    @classmethod
+    def pack_token(cls, z, states, melody_head=MELODY_HEAD, checkpoint_version=None):
+        """Token from a (batch, HIDDEN_SIZE) z and (6, batch, HIDDEN_SIZE) states as NumPy arrays, without torch."""
+        data = cls.HEADER.pack(cls.VERSION, len(states), z.shape[0], MELODY_HEADS.index(melody_head),
+                               cls.checkpoint_bytes(checkpoint_version)) + \
+            z.astype("<f4").tobytes() + states.astype("<f2").tobytes()
+        return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+    @classmethod
+    def from_token(cls, token, device="cpu", max_batch_size=1, melody_head=MELODY_HEAD, checkpoint_version=None):
+        """
+        The state of a token, which is untrusted: anything but a well-formed token of 1 to max_batch_size
+        sequences of finite values, made by a decoder with this melody head and checkpoint version, raises
+        ValueError.
+        """
+        try:
+            data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+            version, num_states, batch_size, head, checkpoint = cls.HEADER.unpack_from(data)
+        except (ValueError, struct.error):
+            raise ValueError("Invalid decoder state token")
+        z_size = batch_size * HIDDEN_SIZE * 4
+        if version != cls.VERSION or num_states != 6 or not 1 <= batch_size <= max_batch_size or \
+                len(data) != cls.HEADER.size + z_size + num_states * batch_size * HIDDEN_SIZE * 2:
+            raise ValueError("Invalid decoder state token")
+        if head != MELODY_HEADS.index(melody_head) or checkpoint != cls.checkpoint_bytes(checkpoint_version):
+            raise ValueError("Decoder state token is from another model, start a new track with /decode")
+
+        z = np.frombuffer(data, dtype="<f4", count=batch_size * HIDDEN_SIZE, offset=cls.HEADER.size)
+        states = np.frombuffer(data, dtype="<f2", offset=cls.HEADER.size + z_size)
+        if not (np.isfinite(z).all() and np.isfinite(states).all()):
+            raise ValueError("Invalid decoder state token")
+        z = torch.from_numpy(z.astype(np.float32)).view(batch_size, HIDDEN_SIZE).to(device)
+        states = torch.from_numpy(states.astype(np.float32)).view(num_states, batch_size, HIDDEN_SIZE).to(device)
+        return cls(z, *states.unbind(0))
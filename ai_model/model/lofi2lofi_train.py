@@ -1,4 +1,7 @@
 import os
+import sys
+
+import torch.distributed as dist
 
 from lofi2lofi_dataset import Lofi2LofiDataset
 from lofi2lofi_model import Lofi2LofiModel
@@ -8,7 +11,14 @@ if __name__ == '__main__':
     dataset_folder = "dataset/processed-spotify-all"
     dataset_files = os.listdir(dataset_folder)
 
+    # optional melody head, e.g. `python lofi2lofi_train.py parallel`
+    melody_head = sys.argv[1] if len(sys.argv) > 1 else "lstm"
+
     dataset = Lofi2LofiDataset(dataset_folder, dataset_files)
-    model = Lofi2LofiModel()
+    # LOFI_FUSED_DECODER=1 trains with Decoder.run_fused, same numerics and checkpoints as the eager decoder
+    model = Lofi2LofiModel(melody_head=melody_head, fused=os.environ.get("LOFI_FUSED_DECODER") == "1")
 
-    train(dataset, model, "lofi2lofi")
+    # also runs data-parallel across processes and nodes: `torchrun --nproc_per_node 4 lofi2lofi_train.py`
+    train(dataset, model, "lofi2lofi" if melody_head == "lstm" else f"lofi2lofi_{melody_head}")
+    if dist.is_initialized():
+        dist.destroy_process_group()
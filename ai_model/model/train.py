@@ -2,22 +2,68 @@ import matplotlib.pyplot as plot
 import os
 import pickle
 import torch
+import torch.distributed as dist
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel
 from torch.nn.utils.rnn import pack_padded_sequence
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
 
 from constants import *
 
-
-def train(dataset, model, name, resume=False, patience=15):
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Using {device} device")
+# the train/validation split and the shuffling are seeded, so every process of a distributed run sees the same split
+SPLIT_SEED = 0
+
+
+def init_distributed():
+    """
+    Join the process group described by the torchrun environment (RANK, WORLD_SIZE, MASTER_ADDR, ...).
+    Returns (rank, world size), (0, 1) when not launched as a distributed job.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1
+    if not dist.is_initialized():
+        # gloo runs on CPU-only machines, LOFI_DDP_BACKEND=nccl for multi-GPU nodes
+        dist.init_process_group(os.environ.get("LOFI_DDP_BACKEND", "gloo"))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def global_mean(values, world_size):
+    """Mean of values (floats or scalar tensors) over all processes."""
+    total = sum(value.item() if torch.is_tensor(value) else float(value) for value in values)
+    totals = torch.tensor([total, float(len(values))], dtype=torch.float64)
+    if world_size > 1:
+        dist.all_reduce(totals)
+    return (totals[0] / totals[1]).item()
+
+
+def train(dataset, model, name, resume=False, patience=15, max_epochs=None):
+    """
+    Train until no validation loss or accuracy improved for patience epochs (or for max_epochs).
+
+    Launched with torchrun, every process trains a DistributedDataParallel replica on its shard of the
+    training set with a batch size of BATCH_SIZE / world size, so the global batch stays BATCH_SIZE.
+    Gradients are all-reduced every step and the epoch metrics over all shards, so every process takes
+    the same early stopping decision. Only rank 0 logs, plots and saves the checkpoints and resume state.
+    """
+    rank, world_size = init_distributed()
+    is_main = rank == 0
+    if torch.cuda.is_available():
+        device = f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}"
+    else:
+        device = "cpu"
+    if is_main:
+        print(f"Using {device} device" + (f", {world_size} processes" if world_size > 1 else ""))
 
     train_size = int(TRAIN_VALIDATION_SPLIT * len(dataset))
-    val_size = len(dataset) - train_size
-    train_dataset, val_dataset = torch.utils.data.random_split(dataset, [train_size, val_size])
-    train_dataloader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
-    val_dataloader = DataLoader(val_dataset, batch_size=BATCH_SIZE, shuffle=False)
+    indices = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(SPLIT_SEED)).tolist()
+    train_dataset, val_dataset = Subset(dataset, indices[:train_size]), Subset(dataset, indices[train_size:])
+    train_sampler = DistributedSampler(train_dataset, world_size, rank, shuffle=True, seed=SPLIT_SEED)
+    val_sampler = DistributedSampler(val_dataset, world_size, rank, shuffle=False)
+    batch_size = max(1, BATCH_SIZE // world_size)
+    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, sampler=train_sampler)
+    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, sampler=val_sampler)
 
     ce_loss = nn.CrossEntropyLoss(reduction='none')
     l1_loss = nn.L1Loss(reduction='mean')
@@ -39,10 +85,12 @@ def train(dataset, model, name, resume=False, patience=15):
     model_path = f"{name}.pth"
     decoder_path = f"{name}-decoder.pth"
     if resume and os.path.isfile(state_path):
-        print(f"Resuming training from {state_path}")
+        if is_main:
+            print(f"Resuming training from {state_path}")
         with open(state_path, 'rb') as f:
             state = pickle.load(f)
-        epochs = state['epochs']
+        # states written before the histories were saved with their epoch have one epoch too many
+        epochs = state['epochs'][:len(state['train_losses_chords'])]
         train_losses_chords = state['train_losses_chords']
         train_losses_melodies = state['train_losses_melodies']
         train_losses_kl = state['train_losses_kl']
@@ -54,9 +102,20 @@ def train(dataset, model, name, resume=False, patience=15):
         val_accs_chords = state['val_accs_chords']
         val_accs_melodies = state['val_accs_melodies']
         epoch = state['epoch']
-        model.load_state_dict(torch.load(model_path))
-        model.decoder.load_state_dict(torch.load(decoder_path))
-        optimizer.load_state_dict(torch.load(optimizer_path))
+        model.load_state_dict(torch.load(model_path, map_location=device))
+        model.decoder.load_state_dict(torch.load(decoder_path, map_location=device))
+        optimizer.load_state_dict(torch.load(optimizer_path, map_location=device))
+
+    # checkpoints are always saved from the unwrapped model, so they load the same with or without DDP
+    module = model
+
+    def wrap(module):
+        # the melody head gets no gradient while its loss is delayed (MELODY_EPOCH_DELAY), DDP then has to search
+        # the graph for unused parameters after every backward; the model is wrapped again once the delay is over
+        return DistributedDataParallel(module, find_unused_parameters=epoch < MELODY_EPOCH_DELAY)
+
+    if world_size > 1:
+        model = wrap(module)
 
     # losses for one batch of data
     def compute_loss(data):
@@ -118,11 +177,17 @@ def train(dataset, model, name, resume=False, patience=15):
 
         return loss_total, loss_chords, loss_kl, loss_melody, loss_tempo, loss_key, loss_mode, loss_valence, loss_energy, tp_chords, tp_melodies
 
-    print(f"Starting training: {name}")
-    while True:
+    if is_main:
+        print(f"Starting training: {name}")
+    # early stopping ends the loop here, after the epoch that ran out of patience has been saved
+    while (max_epochs is None or epoch < max_epochs) and epochs_no_improve < patience:
+        if world_size > 1 and 0 < epoch == MELODY_EPOCH_DELAY:
+            model = wrap(module)
         epochs.append(epoch)
+        train_sampler.set_epoch(epoch)
 
-        print(f"== Epoch {epoch} ==")
+        if is_main:
+            print(f"== Epoch {epoch} ==")
         ep_train_losses_chords, ep_train_losses_melodies, ep_train_losses_kl, ep_train_tp_chords, ep_train_tp_melodies = [], [], [], [], []
         ep_val_losses_chords, ep_val_losses_melodies, ep_val_losses_kl, ep_val_tp_chords, ep_val_tp_melodies = [], [], [], [], []
 
@@ -133,7 +198,8 @@ def train(dataset, model, name, resume=False, patience=15):
             sampling_rate_chords = sampling_rate_at_epoch(epoch)
             sampling_rate_melodies = sampling_rate_at_epoch(epoch - MELODY_EPOCH_DELAY)
 
-        print(f"Scheduled sampling rate: C {sampling_rate_chords}, M {sampling_rate_melodies}")
+        if is_main:
+            print(f"Scheduled sampling rate: C {sampling_rate_chords}, M {sampling_rate_melodies}")
 
         # TRAINING
         model.train()
@@ -153,9 +219,10 @@ def train(dataset, model, name, resume=False, patience=15):
 
             optimizer.step()
             loss = loss.item()
-            print(f"\tBatch {batch}:\tLoss {loss:.3f} (C: {loss_chords:.3f} + KL: {kl_loss:.3f} + "
-                  f"M: {loss_melody:.3f} + T: {loss_tempo:.3f} + K: {loss_key:.3f} + Mo: {loss_mode:.3f} + "
-                  f"V: {loss_valence:.3f} + E: {loss_energy:.3f})")
+            if is_main:
+                print(f"\tBatch {batch}:\tLoss {loss:.3f} (C: {loss_chords:.3f} + KL: {kl_loss:.3f} + "
+                      f"M: {loss_melody:.3f} + T: {loss_tempo:.3f} + K: {loss_key:.3f} + Mo: {loss_mode:.3f} + "
+                      f"V: {loss_valence:.3f} + E: {loss_energy:.3f})")
 
         # VALIDATION
         model.eval()
@@ -171,46 +238,32 @@ def train(dataset, model, name, resume=False, patience=15):
                 ep_val_tp_chords.extend(batch_tp_chords)
                 ep_val_tp_melodies.extend(batch_tp_melodies)
 
-                print(f"\tValidation Batch {batch}:\tLoss {loss:.3f} (C: {loss_chords:.3f} + KL: {kl_loss:.3f} + "
-                      f"M: {loss_melody:.3f} + T: {loss_tempo:.3f} + K: {loss_key:.3f} + Mo: {loss_mode:.3f} + "
-                      f"V: {loss_valence:.3f} + E: {loss_energy:.3f})")
-
-        # copy old model
-        save_name = f"{name}.pth"
-        decoder_save_name = f"{name}-decoder.pth"
-        torch.save(model.state_dict(), save_name)
-        torch.save(model.decoder.state_dict(), decoder_save_name)
-        torch.save(optimizer.state_dict(), optimizer_path)
-        # Save histories and epoch
-        state = {
-            'epochs': epochs,
-            'train_losses_chords': train_losses_chords,
-            'train_losses_melodies': train_losses_melodies,
-            'train_losses_kl': train_losses_kl,
-            'train_accs_chords': train_accs_chords,
-            'train_accs_melodies': train_accs_melodies,
-            'val_losses_chords': val_losses_chords,
-            'val_losses_melodies': val_losses_melodies,
-            'val_losses_kl': val_losses_kl,
-            'val_accs_chords': val_accs_chords,
-            'val_accs_melodies': val_accs_melodies,
-            'epoch': epoch + 1
-        }
-        with open(state_path, 'wb') as f:
-            pickle.dump(state, f)
+                if is_main:
+                    print(f"\tValidation Batch {batch}:\tLoss {loss:.3f} (C: {loss_chords:.3f} + KL: {kl_loss:.3f} + "
+                          f"M: {loss_melody:.3f} + T: {loss_tempo:.3f} + K: {loss_key:.3f} + Mo: {loss_mode:.3f} + "
+                          f"V: {loss_valence:.3f} + E: {loss_energy:.3f})")
+
+        if is_main:
+            # copy old model
+            save_name = f"{name}.pth"
+            decoder_save_name = f"{name}-decoder.pth"
+            torch.save(module.state_dict(), save_name)
+            torch.save(module.decoder.state_dict(), decoder_save_name)
+            torch.save(optimizer.state_dict(), optimizer_path)
         epoch += 1
 
-        ep_train_loss_chord = sum(ep_train_losses_chords) / len(ep_train_losses_chords)
-        ep_train_loss_melody = sum(ep_train_losses_melodies) / len(ep_train_losses_melodies)
-        ep_train_loss_kl = sum(ep_train_losses_kl) / len(ep_train_losses_kl)
-        ep_train_chord_acc = (sum(ep_train_tp_chords) / len(ep_train_tp_chords)) * 100
-        ep_train_melody_acc = (sum(ep_train_tp_melodies) / len(ep_train_tp_melodies)) * 100
+        # metrics over the shards of all processes, so every process takes the same early stopping decision
+        ep_train_loss_chord = global_mean(ep_train_losses_chords, world_size)
+        ep_train_loss_melody = global_mean(ep_train_losses_melodies, world_size)
+        ep_train_loss_kl = global_mean(ep_train_losses_kl, world_size)
+        ep_train_chord_acc = global_mean(ep_train_tp_chords, world_size) * 100
+        ep_train_melody_acc = global_mean(ep_train_tp_melodies, world_size) * 100
 
-        ep_val_loss_chord = sum(ep_val_losses_chords) / len(ep_val_losses_chords)
-        ep_val_loss_melody = sum(ep_val_losses_melodies) / len(ep_val_losses_melodies)
-        ep_val_loss_kl = sum(ep_val_losses_kl) / len(ep_val_losses_kl)
-        ep_val_chord_acc = (sum(ep_val_tp_chords) / len(ep_val_tp_chords)) * 100
-        ep_val_melody_acc = (sum(ep_val_tp_melodies) / len(ep_val_tp_melodies)) * 100
+        ep_val_loss_chord = global_mean(ep_val_losses_chords, world_size)
+        ep_val_loss_melody = global_mean(ep_val_losses_melodies, world_size)
+        ep_val_loss_kl = global_mean(ep_val_losses_kl, world_size)
+        ep_val_chord_acc = global_mean(ep_val_tp_chords, world_size) * 100
+        ep_val_melody_acc = global_mean(ep_val_tp_melodies, world_size) * 100
 
         # Early stopping logic (monitoring all four validation metrics)
         improved_loss_chord = ep_val_loss_chord < best_val_loss_chord if 'best_val_loss_chord' in locals() else True
@@ -229,10 +282,14 @@ def train(dataset, model, name, resume=False, patience=15):
             epochs_no_improve = 0
         else:
             epochs_no_improve += 1
-            print(f"No improvement in any validation loss or accuracy for {epochs_no_improve} epoch(s).")
+            if is_main:
+                print(f"No improvement in any validation loss or accuracy for {epochs_no_improve} epoch(s).")
             if epochs_no_improve >= patience:
-                print(f"Early stopping triggered after {patience} epochs without improvement in any validation loss or accuracy.")
-                break
+                if is_main:
+                    print(f"Early stopping triggered after {patience} epochs without improvement in any validation loss or accuracy.")
+
+        if not is_main:
+            continue
 
         print(
             f"Epoch chord loss: {ep_train_loss_chord:.3f}, melody loss: {ep_train_loss_melody:.3f}, KL: {ep_train_loss_kl:.3f}, "
@@ -253,6 +310,24 @@ def train(dataset, model, name, resume=False, patience=15):
         val_accs_chords.append(float(ep_val_chord_acc))
         val_accs_melodies.append(float(ep_val_melody_acc))
 
+        # Save histories and epoch, once the histories include this epoch so that they line up with epochs on resume
+        state = {
+            'epochs': epochs,
+            'train_losses_chords': train_losses_chords,
+            'train_losses_melodies': train_losses_melodies,
+            'train_losses_kl': train_losses_kl,
+            'train_accs_chords': train_accs_chords,
+            'train_accs_melodies': train_accs_melodies,
+            'val_losses_chords': val_losses_chords,
+            'val_losses_melodies': val_losses_melodies,
+            'val_losses_kl': val_losses_kl,
+            'val_accs_chords': val_accs_chords,
+            'val_accs_melodies': val_accs_melodies,
+            'epoch': epoch
+        }
+        with open(state_path, 'wb') as f:
+            pickle.dump(state, f)
+
         fig, axs = plot.subplots(2, 2, figsize=(8, 4.5), dpi=200)
         # Chords loss
         axs[0, 0].set_title('Chords loss')
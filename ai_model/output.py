@@ -5,9 +5,13 @@ from model.constants import *
 
 
 class Output:
-    def __init__(self, title, pred_chords, pred_notes, pred_tempo, pred_key, pred_mode, pred_valence, pred_energy):
-        chords = pred_chords.argmax(dim=2)[0].tolist()
-        notes = pred_notes.argmax(dim=2)[0].cpu().numpy()
+    def __init__(self, title, pred_chords, pred_notes, pred_tempo, pred_key, pred_mode, pred_valence, pred_energy,
+                 rng=None):
+        # logits, or the tokens a sampler or beam search already chose
+        if pred_chords.is_floating_point():
+            pred_chords, pred_notes = pred_chords.argmax(dim=2), pred_notes.argmax(dim=2)
+        chords = pred_chords[0].tolist()
+        notes = pred_notes[0].cpu().numpy()
 
         chords.append(CHORD_END_TOKEN)
         cut_off_point = chords.index(CHORD_END_TOKEN)
@@ -27,7 +31,8 @@ class Output:
         self.valence = round(valence, 3)
         self.chords = chords
         self.melodies = [x.tolist() for x in [*melodies]]
-        self.swing = round(random.uniform(0.2, 0.95), 3)
+        # rng: a random.Random to draw the swing from, the global random module if None
+        self.swing = round((rng or random).uniform(0.2, 0.95), 3)
 
     def to_json(self):
         json = jsonpickle.encode(self, unpicklable=False)
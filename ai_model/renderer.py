@@ -0,0 +1,180 @@
+import wave
+from functools import lru_cache
+
+import numpy as np
+
+# Vectorized NumPy synthesis of Output parameters (chords, melodies, bpm, key, mode, swing) into PCM audio.
+# Every note becomes one event (start, length, pitch, voice); all events are expanded into sample indices at once,
+# read from a single-cycle wavetable through fixed-point phase steps and mixed with np.bincount,
+# so there is no Python loop over samples or notes.
+
+SAMPLE_RATE = 22050
+BEATS_PER_MEASURE = 4
+EIGHTHS_PER_MEASURE = 8
+MIN_BPM = 70
+# longest possible note: a whole-measure chord at the slowest tempo, plus the release
+MAX_NOTE_SECONDS = BEATS_PER_MEASURE * 60 / MIN_BPM + 0.1
+# intervals of the ionian scale, the other six modes are its rotations
+IONIAN = np.array([0, 2, 4, 5, 7, 9, 11])
+HARMONICS = np.array([1.0, 0.5, 0.25, 0.125])
+TABLE_SIZE = 4096
+PHASE_BITS = 16
+
+# pitch rows cover four octaves of the scale starting at this MIDI note (C2), seven rows per octave
+LOWEST_OCTAVE = 36
+NUM_OCTAVES = 4
+# first pitch row of each voice: bass in the lowest octave, chords one octave up, melody (two octaves) above
+BASS_ROW = 0
+CHORD_ROW = 7
+MELODY_ROW = 14
+BASS, CHORD, MELODY = range(3)
+# gain and decay seconds per voice
+VOICE_GAINS = [0.3, 0.12, 0.22]
+VOICE_DECAYS = [1.2, 1.6, 0.5]
+ATTACK_SECONDS = 0.005
+RELEASE_SECONDS = 0.03
+# at swing 1 the off-beat eighths are delayed by a third of an eighth (triplet feel)
+MAX_SWING_DELAY = 1 / 3
+# events are mixed in chunks of at most this many samples to bound memory on long songs and large batches
+CHUNK_SAMPLES = 1 << 22
+
+
+def scale_pitches(key, mode):
+    """MIDI pitch offsets of the seven scale degrees of a key (1-12, from C) and mode (1-7, from ionian)."""
+    rotated = np.roll(IONIAN, -(mode - 1))
+    return (rotated - rotated[0]) % 12 + (key - 1)
+
+
+@lru_cache(maxsize=1)
+def wavetable():
+    """One cycle of the note waveform (a few decaying harmonics), TABLE_SIZE samples."""
+    phase = np.arange(TABLE_SIZE) / TABLE_SIZE
+    cycle = sum(amplitude * np.sin(2 * np.pi * harmonic * phase)
+                for harmonic, amplitude in enumerate(HARMONICS, start=1))
+    return (cycle / HARMONICS.sum()).astype(np.float32)
+
+
+@lru_cache(maxsize=None)
+def phase_steps(key, mode, sample_rate=SAMPLE_RATE):
+    """
+    Wavetable steps per output sample, in fixed point with PHASE_BITS fractional bits,
+    for every pitch row (octave * 7 + 0-based scale degree above LOWEST_OCTAVE) of a key/mode.
+    """
+    pitches = (LOWEST_OCTAVE + np.arange(NUM_OCTAVES)[:, None] * 12 + scale_pitches(key, mode)[None, :]).reshape(-1)
+    frequencies = 440.0 * 2 ** ((pitches - 69) / 12)
+    return np.round(frequencies / sample_rate * TABLE_SIZE * (1 << PHASE_BITS)).astype(np.int64)
+
+
+@lru_cache(maxsize=4)
+def envelopes(sample_rate=SAMPLE_RATE):
+    """Gain, attack and exponential decay of each voice over the longest possible note, shape (3, samples)."""
+    t = np.arange(int(MAX_NOTE_SECONDS * sample_rate)) / sample_rate
+    attack = np.minimum(1, t / ATTACK_SECONDS)
+    return np.stack([gain * attack * np.exp(-t / decay)
+                     for gain, decay in zip(VOICE_GAINS, VOICE_DECAYS)]).astype(np.float32)
+
+
+def output_params(output):
+    return output if isinstance(output, dict) else vars(output)
+
+
+def note_events(output, sample_rate=SAMPLE_RATE):
+    """
+    All notes of one Output as arrays (start sample, length in samples, pitch row, voice),
+    and the total length of the track in samples.
+    """
+    params = output_params(output)
+    chords = np.asarray(params["chords"], dtype=np.int64)
+    melodies = np.asarray(params["melodies"], dtype=np.int64).reshape(-1, EIGHTHS_PER_MEASURE)
+    num_measures = len(chords)
+    measure = BEATS_PER_MEASURE * 60 / params["bpm"] * sample_rate
+    eighth = measure / EIGHTHS_PER_MEASURE
+    swing_delay = params.get("swing", 0) * MAX_SWING_DELAY * eighth
+
+    # bass and chords: one whole-measure note per voice for every non-rest chord (0 = rest)
+    chord_measures = np.nonzero(chords)[0]
+    degrees = chords[chord_measures] - 1
+    bass_rows = BASS_ROW + degrees
+    chord_rows = CHORD_ROW + degrees[:, None] + np.array([0, 2, 4])[None, :]
+    chord_starts = np.round(chord_measures * measure).astype(np.int64)
+    chord_length = int(round(measure))
+
+    # melody: runs of the same note within a measure are one note, as in the client's producer (0 = rest)
+    notes = melodies[:num_measures]
+    run_start = np.ones(notes.shape, dtype=bool)
+    run_start[:, 1:] = notes[:, 1:] != notes[:, :-1]
+    # row-major order, so each run ends where the next one in the same measure starts, or at the measure end
+    run_measure, run_position = np.nonzero(run_start)
+    same_measure = np.append(run_measure[1:] == run_measure[:-1], False)
+    run_end = np.where(same_measure, np.append(run_position[1:], 0), EIGHTHS_PER_MEASURE)
+    played = notes[run_measure, run_position] > 0
+    measure_idx, position, end = run_measure[played], run_position[played], run_end[played]
+
+    melody_rows = MELODY_ROW + notes[measure_idx, position] - 1
+    # swing delays the off-beat eighths
+    on_times = measure_idx * measure + position * eighth + (position % 2) * swing_delay
+    off_times = measure_idx * measure + end * eighth + (end % 2) * swing_delay
+    melody_starts = np.round(on_times).astype(np.int64)
+    melody_lengths = np.round(off_times - on_times).astype(np.int64)
+
+    starts = np.concatenate((chord_starts, np.repeat(chord_starts, 3), melody_starts))
+    lengths = np.concatenate((np.full(len(chord_starts) * 4, chord_length), melody_lengths))
+    rows = np.concatenate((bass_rows, chord_rows.reshape(-1), melody_rows))
+    voices = np.concatenate((np.full(len(chord_starts), BASS), np.full(len(chord_starts) * 3, CHORD),
+                             np.full(len(melody_starts), MELODY)))
+    total_length = int(round(num_measures * measure + RELEASE_SECONDS * sample_rate))
+    return starts, lengths, rows, voices, total_length
+
+
+def render_batch(outputs, sample_rate=SAMPLE_RATE):
+    """Render many Outputs (objects or dicts) at once; returns one float32 mono array in [-1, 1] per Output."""
+    outputs = [output_params(output) for output in outputs]
+    cycle = wavetable()
+    envelope = envelopes(sample_rate)
+    envelope_length = envelope.shape[1]
+
+    events = [note_events(output, sample_rate) for output in outputs]
+    track_lengths = np.array([event[4] for event in events])
+    track_offsets = np.concatenate(([0], np.cumsum(track_lengths)[:-1]))
+    starts = np.concatenate([event[0] + offset for event, offset in zip(events, track_offsets)])
+    lengths = np.minimum(np.concatenate([event[1] for event in events]), envelope_length)
+    steps = np.concatenate([phase_steps(output["key"], output["mode"], sample_rate)[event[2]]
+                            for output, event in zip(outputs, events)])
+    voices = np.concatenate([event[3] for event in events])
+
+    mix = np.zeros(track_lengths.sum(), dtype=np.float64)
+    release_scale = np.float32(1 / (RELEASE_SECONDS * sample_rate))
+
+    # mix in chunks of events so the expanded sample arrays stay bounded
+    chunk_ids = np.cumsum(lengths) // CHUNK_SAMPLES
+    for chunk in np.unique(chunk_ids):
+        selected = chunk_ids == chunk
+        chunk_lengths = lengths[selected]
+        event_idx = np.repeat(np.arange(len(chunk_lengths)), chunk_lengths)
+        # position of every sample inside its note
+        offset = np.arange(chunk_lengths.sum()) - np.repeat(np.cumsum(chunk_lengths) - chunk_lengths, chunk_lengths)
+        phase = (offset * steps[selected][event_idx] >> PHASE_BITS) & (TABLE_SIZE - 1)
+        samples = cycle[phase] * envelope.ravel()[voices[selected][event_idx] * envelope_length + offset]
+        # linear release over the last RELEASE_SECONDS of each note
+        samples *= np.minimum(1, (chunk_lengths[event_idx] - offset).astype(np.float32) * release_scale)
+        mix += np.bincount(starts[selected][event_idx] + offset, weights=samples, minlength=len(mix))
+
+    mix = np.tanh(mix).astype(np.float32)  # soft clipping
+    return np.split(mix, np.cumsum(track_lengths)[:-1])
+
+
+def render(output, sample_rate=SAMPLE_RATE):
+    """Render one Output (object or dict) into a float32 mono array in [-1, 1]."""
+    return render_batch([output], sample_rate)[0]
+
+
+def to_pcm16(audio):
+    return (np.clip(audio, -1, 1) * 32767).astype("<i2")
+
+
+def write_wav(path, audio, sample_rate=SAMPLE_RATE):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(to_pcm16(audio).tobytes())
@@ -0,0 +1,98 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import cv2
+
+# CPU thread budget of a server process, so that concurrent requests and server processes do not oversubscribe
+# the cores: by default torch, OpenCV and ffmpeg each start a thread per core in every process.
+#
+# configure_process divides the cores available to the host's server processes (LOFI_WORKERS of them) into equal
+# shares, optionally pinning each process to its own cores (LOFI_PIN_CPUS=1, LOFI_WORKER_INDEX picks the set).
+# Within a process, the share is split among the requests running at the same time: a stage asks
+# budget.threads(stage) for its intra-op parallelism, and budget.torch_threads(stage) applies it to torch for the
+# calling thread only (intra-op threads are per thread with the OpenMP backend). LOFI_THREAD_BUDGET=0 leaves the
+# library defaults alone.
+
+# fraction of a request's share each stage uses: CLIP's matmuls are the only ones big enough to scale, frame
+# decoding overlaps CLIP in the pipeline, the decoder's (1, HIDDEN_SIZE) LSTM steps are too small to split
+STAGE_SHARES = {"clip_encode": 1.0, "student_score": 0.5, "frame_decode": 0.5, "decoder_forward": 0.0}
+
+
+def available_cpus():
+    """Cores this process may run on, respecting affinity masks and cgroup cpusets."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ThreadBudget:
+    def __init__(self, cpus=None, enabled=True):
+        self.cpus = cpus or len(available_cpus())
+        self.enabled = enabled
+        self.active = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def working(self):
+        """Count the block as a running request, the others' shares shrink while it runs."""
+        with self.lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def threads(self, stage):
+        """Intra-op threads for a stage, given the requests running right now. 0 when the budget is off."""
+        if not self.enabled:
+            return 0
+        share = self.cpus / max(1, self.active)
+        return max(1, int(share * STAGE_SHARES.get(stage, 1.0)))
+
+    @contextmanager
+    def torch_threads(self, stage):
+        """Run the block with torch limited to the stage's threads, in the calling thread."""
+        threads = self.threads(stage)
+        if not threads:
+            yield
+            return
+        import torch
+        previous = torch.get_num_threads()
+        torch.set_num_threads(threads)
+        try:
+            yield
+        finally:
+            torch.set_num_threads(previous)
+
+
+budget = ThreadBudget()
+
+
+def configure_process(workers=1, worker_index=0, pin=False, enabled=True):
+    """
+    Give this process its share of the cores: 1/workers of them, pinned to their own set with pin.
+    OpenCV gets a single thread, its per-frame resizes are too small to split and run on many request threads.
+    """
+    budget.enabled = enabled
+    if not enabled:
+        return
+    cpus = available_cpus()
+    share = max(1, len(cpus) // max(1, workers))
+    if pin and hasattr(os, "sched_setaffinity"):
+        start = (worker_index * share) % len(cpus)
+        os.sched_setaffinity(0, cpus[start:start + share] or cpus[-share:])
+    budget.cpus = share
+    import torch
+    torch.set_num_threads(share)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # only settable before the first inter-op work, the default is kept then
+    cv2.setNumThreads(1)
+
+
+def configure_from_env():
+    configure_process(int(os.environ.get("LOFI_WORKERS", 1)), int(os.environ.get("LOFI_WORKER_INDEX", 0)),
+                      os.environ.get("LOFI_PIN_CPUS") == "1", os.environ.get("LOFI_THREAD_BUDGET", "1") != "0")
@@ -0,0 +1,137 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import singleflight_total, stage
+
+# Coalescing of identical work that is in flight at the same time, keyed by e.g. the content hash of an upload.
+#
+# Within a process, the first caller of a key runs the function and concurrent callers wait on its Future.
+# Across processes, the leader holds an exclusive flock on <directory>/<key>.lock while it runs and then
+# writes the JSON result next to it; a process that finds the lock taken blocks on it and reads that result.
+# Results are kept on disk for result_ttl seconds so that requests racing the leader's finish still share it,
+# this is not a cache. Exceptions are shared within a process only: another process runs the function itself.
+
+DEFAULT_DIR = os.path.join(tempfile.gettempdir(), "lofi_singleflight")
+DEFAULT_RESULT_TTL = 30.0
+# result and idle lock files older than result_ttl are swept every SWEEP_EVERY leader runs
+SWEEP_EVERY = 100
+
+
+class SingleFlight:
+    def __init__(self, directory=DEFAULT_DIR, result_ttl=DEFAULT_RESULT_TTL):
+        self.directory = directory
+        self.result_ttl = result_ttl
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.runs = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def do(self, key, fn):
+        """Return fn(), or the result of an fn() already running for key in this or another process."""
+        with self.lock:
+            future = self.flights.get(key)
+            leader = future is None
+            if leader:
+                future = self.flights[key] = Future()
+
+        if not leader:
+            singleflight_total.inc(("thread",))
+            with stage("singleflight_wait"):
+                return future.result()
+
+        try:
+            result = self._do_locked(key, fn)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.flights[key]
+
+    def running(self, key):
+        """
+        Whether do(key, ...) would now wait on another caller or read its fresh result instead of running fn.
+        Only a hint: the leader may finish, or fail, right after.
+        """
+        with self.lock:
+            if key in self.flights:
+                return True
+        lock_path = os.path.join(self.directory, f"{key}.lock")
+        if self._read_result(os.path.join(self.directory, f"{key}.json"))[0]:
+            return True
+        try:
+            with open(lock_path) as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True  # another process holds it
+        except OSError:
+            pass
+        return False
+
+    def _do_locked(self, key, fn):
+        lock_path = os.path.join(self.directory, f"{key}.lock")
+        result_path = os.path.join(self.directory, f"{key}.json")
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another process is running it, wait for it to finish
+                with stage("singleflight_wait"):
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                os.utime(lock_path)  # marks the lock as recently used for _sweep
+                found, result = self._read_result(result_path)
+                if found:
+                    singleflight_total.inc(("process",))
+                    return result
+                singleflight_total.inc(("leader",))
+                result = fn()
+                self._write_result(result_path, result)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_result(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > self.result_ttl:
+                return False, None
+            with open(path) as f:
+                return True, json.load(f)["result"]
+        except (OSError, ValueError, KeyError):
+            return False, None
+
+    def _write_result(self, path, result):
+        # write then rename, so a reader never sees a partial file
+        with open(path + ".tmp", "w") as f:
+            json.dump({"result": result}, f)
+        os.replace(path + ".tmp", path)
+        with self.lock:
+            self.runs += 1
+            sweep = self.runs % SWEEP_EVERY == 0
+        if sweep:
+            self._sweep()
+
+    def _sweep(self):
+        cutoff = time.time() - self.result_ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                if name.endswith(".json"):
+                    os.remove(path)
+                elif name.endswith(".lock"):
+                    # only unlink a lock nobody holds; losing a race here costs a duplicate run, not a wrong result
+                    with open(path, "a") as lock_file:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,105 @@
+import numpy as np
+
+# Pure NumPy scorer for the lofifiability SVM, exported from checkpoints/model.pkl by export_svm.py.
+# Loading it needs neither joblib nor scikit-learn.
+
+FAST_MODEL_NAME = "svm_fast.npz"
+
+# libsvm's pairwise coupling for predict_proba, see multiclass_probability in libsvm's svm.cpp
+LIBSVM_MIN_PROB = 1e-7
+LIBSVM_MAX_ITER = 100
+
+
+def sigmoid(x):
+    return 0.5 * (1 + np.tanh(0.5 * x))
+
+
+class FastSVM:
+    """Drop-in replacement for the sklearn model's predict_proba on the exported parameters."""
+
+    def __init__(self, arrays):
+        self.kind = str(arrays["kind"])
+        self.scaler_mean = arrays.get("scaler_mean")
+        self.scaler_scale = arrays.get("scaler_scale")
+        self.members = []
+        for i in range(int(arrays["num_members"])):
+            member = {key[len(f"m{i}_"):]: value for key, value in arrays.items() if key.startswith(f"m{i}_")}
+            member["kernel"] = str(member["kernel"])
+            self.members.append(member)
+
+    def decision_function(self, member, X):
+        kernel = member["kernel"]
+        if kernel == "linear":
+            return X @ member["coef"] + member["intercept"]
+
+        sv = member["support_vectors"]
+        if kernel == "rbf":
+            sq_dists = (X ** 2).sum(axis=1)[:, None] + (sv ** 2).sum(axis=1)[None, :] - 2 * X @ sv.T
+            K = np.exp(-member["gamma"] * np.maximum(sq_dists, 0))
+        elif kernel == "poly":
+            K = (member["gamma"] * X @ sv.T + member["coef0"]) ** member["degree"]
+        elif kernel == "sigmoid":
+            K = np.tanh(member["gamma"] * X @ sv.T + member["coef0"])
+        else:
+            raise ValueError(f"Unsupported kernel: {kernel}")
+        return K @ member["coef"] + member["intercept"]
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if self.scaler_mean is not None:
+            X = X - self.scaler_mean
+        if self.scaler_scale is not None:
+            X = X / self.scaler_scale
+
+        if self.kind == "libsvm":
+            member = self.members[0]
+            # libsvm's decision values have the opposite sign of sklearn's decision_function in the binary case
+            dec = -self.decision_function(member, X)
+            r01 = np.clip(1 / (1 + np.exp(dec * member["prob_a"] + member["prob_b"])),
+                          LIBSVM_MIN_PROB, 1 - LIBSVM_MIN_PROB)
+            p_neg = libsvm_coupling(r01)
+        elif self.kind == "calibrated":
+            p_pos = np.mean([sigmoid(-(member["prob_a"] * self.decision_function(member, X) + member["prob_b"]))
+                             for member in self.members], axis=0)
+            p_neg = 1 - p_pos
+        elif self.kind == "logistic":
+            p_pos = sigmoid(self.decision_function(self.members[0], X))
+            p_neg = 1 - p_pos
+        else:
+            raise ValueError(f"Unsupported model kind: {self.kind}")
+
+        return np.stack((p_neg, 1 - p_neg), axis=1)
+
+
+def libsvm_coupling(r01):
+    """Vectorized libsvm multiclass_probability for two classes; returns P(class 0) for every sample."""
+    n = len(r01)
+    r10 = 1 - r01
+    # Q[t][t] = sum of squared pairwise probabilities against t, Q[t][j] = -r_jt * r_tj
+    Q = np.empty((n, 2, 2))
+    Q[:, 0, 0] = r10 * r10
+    Q[:, 1, 1] = r01 * r01
+    Q[:, 0, 1] = Q[:, 1, 0] = -r10 * r01
+    p = np.full((n, 2), 0.5)
+    Qp = np.einsum("ntj,nj->nt", Q, p)
+    pQp = (p * Qp).sum(axis=1)
+    eps = 0.005 / 2
+
+    active = np.ones(n, dtype=bool)
+    for _ in range(LIBSVM_MAX_ITER):
+        max_error = np.abs(Qp - pQp[:, None]).max(axis=1)
+        active &= max_error >= eps
+        if not active.any():
+            break
+        for t in range(2):
+            diff = np.where(active, (-Qp[:, t] + pQp) / Q[:, t, t], 0)
+            p[:, t] += diff
+            pQp = (pQp + diff * (diff * Q[:, t, t] + 2 * Qp[:, t])) / (1 + diff) / (1 + diff)
+            Qp = (Qp + diff[:, None] * Q[:, t, :]) / (1 + diff[:, None])
+            p = p / (1 + diff[:, None])
+    return p[:, 0]
+
+
+def load_fast_svm(path):
+    with np.load(path, allow_pickle=False) as data:
+        return FastSVM({key: data[key] for key in data.files})
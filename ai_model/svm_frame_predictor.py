@@ -1,110 +1,187 @@
-import cv2, os, joblib
-import torch
+import os
+
 import numpy as np
-from PIL import Image
-from sklearn.metrics.pairwise import cosine_similarity
-import clip
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-clip_model, preprocess = clip.load("ViT-B/32", device=device)
+from svm_fast import FAST_MODEL_NAME, load_fast_svm
+from metrics import stage
+from clip_service import distinct_embeddings, embed_video, set_image_backend, DEFAULT_ONNX_PATH, FRAME_INTERVAL, \
+    PIXEL_SIM_THRESHOLD, EMBED_SIM_THRESHOLD
 
+# histogram bins of the probability quantile sketch, quantiles are exact to 1 / PROB_BINS
+PROB_BINS = 1000
+QUANTILES = (0.1, 0.5, 0.9)
 
-FRAME_INTERVAL = 5
-PIXEL_SIM_THRESHOLD = 0.95
-EMBED_SIM_THRESHOLD = 0.97
 
 def get_frame_embeddings(video_path, frame_interval=FRAME_INTERVAL, pixel_thresh=PIXEL_SIM_THRESHOLD, embed_thresh=EMBED_SIM_THRESHOLD):
     try:
-        cap = cv2.VideoCapture(video_path)
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        embeddings = []
-        last_frame_vector = None
-
-        for idx in range(0, frame_count, frame_interval):
-            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
-            success, frame = cap.read()
-            if not success:
-                continue
-
-            small = cv2.resize(frame, (64, 64)).flatten().astype(np.float32)
-            small = small / np.linalg.norm(small)
-
-            if last_frame_vector is not None:
-                sim = cosine_similarity([small], [last_frame_vector])[0][0]
-                if sim > pixel_thresh:
-                    continue
-
-            last_frame_vector = small
-
-            image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            image_input = preprocess(image).unsqueeze(0).to(device)
-
-            with torch.no_grad():
-                emb = clip_model.encode_image(image_input).float().squeeze(0).cpu()
-
-            if embeddings:
-                sims = cosine_similarity([emb.numpy()], [e.numpy() for e in embeddings])
-                if sims.max() > embed_thresh:
-                    continue
-
-            embeddings.append(emb)
-
-        cap.release()
-        return torch.stack(embeddings) if embeddings else None
-
+        return embed_video(video_path, frame_interval, pixel_thresh, embed_thresh)
     except Exception as e:
         print(f"❌ Error processing {video_path}: {e}")
         return None
 
+def select_clip_backend(backend, onnx_path=DEFAULT_ONNX_PATH):
+    """
+    Embed frames with PyTorch ("torch", the default) or ONNX Runtime ("onnx", the vision tower exported by
+    clip_export.py). Check an export with `python clip_export.py check` before serving it.
+    """
+    set_image_backend(backend, onnx_path)
+
 def load_svm_model(model_dir):
-    """Load a trained SVM model from a directory."""
+    """Load a trained SVM model from a directory.
+
+    Prefers the NumPy export written by export_svm.py, which skips joblib and scikit-learn entirely.
+    """
+    fast_model_path = os.path.join(model_dir, FAST_MODEL_NAME)
+    if os.path.exists(fast_model_path):
+        return load_fast_svm(fast_model_path)
+
     model_path = os.path.join(model_dir, "model.pkl")
     if not os.path.exists(model_path):
         raise FileNotFoundError(f"No model found at {model_path}")
-    
+
+    import joblib
     model = joblib.load(model_path)
     return model
 
-def predict_per_frame_with_final(model, video_paths, method='mean'):
+class FrameScoreAggregator:
+    """
+    Folds per-frame P(lofiable) into running aggregates: mean, vote count and a fixed-bin histogram for
+    quantiles. With max_frame_probs, the probabilities are also kept as a series of at most that many points,
+    each the mean of `stride` consecutive frames (the stride doubles whenever the series fills up).
+    Memory does not depend on the number of frames.
+    """
+
+    def __init__(self, max_frame_probs=None):
+        self.count = 0
+        self.prob_sum = 0.0
+        self.votes = 0
+        self.histogram = np.zeros(PROB_BINS, dtype=np.int64)
+        self.max_frame_probs = max_frame_probs
+        self.series = []
+        self.stride = 1
+        self.bucket_sum = 0.0
+        self.bucket_len = 0
+
+    def update(self, probs):
+        probs = np.asarray(probs, dtype=np.float64)
+        self.count += len(probs)
+        self.prob_sum += probs.sum()
+        self.votes += int((probs >= 0.5).sum())
+        bins = np.minimum((probs * PROB_BINS).astype(np.int64), PROB_BINS - 1)
+        self.histogram += np.bincount(bins, minlength=PROB_BINS)
+        if self.max_frame_probs:
+            for prob in probs.tolist():
+                self._append(prob)
+
+    def _append(self, prob):
+        self.bucket_sum += prob
+        self.bucket_len += 1
+        if self.bucket_len < self.stride:
+            return
+        self.series.append(self.bucket_sum / self.stride)
+        self.bucket_sum, self.bucket_len = 0.0, 0
+        if len(self.series) >= self.max_frame_probs:
+            # halve the resolution, an odd last point becomes the partial bucket of the doubled stride
+            pairs = len(self.series) // 2
+            merged = [(self.series[2 * i] + self.series[2 * i + 1]) / 2 for i in range(pairs)]
+            if len(self.series) % 2:
+                self.bucket_sum, self.bucket_len = self.series[-1] * self.stride, self.stride
+            self.series = merged
+            self.stride *= 2
+
+    def quantile(self, q):
+        """Approximate q-quantile of the frame probabilities, the center of the histogram bin it falls in."""
+        index = int(np.searchsorted(np.cumsum(self.histogram), q * self.count))
+        return (min(index, PROB_BINS - 1) + 0.5) / PROB_BINS
+
+    def result(self, method='mean'):
+        final_prob = self.prob_sum / self.count
+        if method == 'mean':
+            final_label = int(final_prob >= 0.5)
+            confidence = abs(final_prob - 0.5) * 2  # [0,1] how far from decision boundary
+        elif method == 'majority':
+            final_label = int(self.votes >= self.count / 2)
+            confidence = abs(self.votes / self.count - 0.5) * 2  # [0,1]
+        else:
+            raise ValueError("method must be 'mean' or 'majority'")
+
+        result = {
+            "is_lofifiable": final_label,
+            "confidence": round(float(confidence), 4),
+            "avg_prob": round(float(final_prob), 4),
+            "frames_analyzed": self.count,
+            "quantiles": {f"p{round(q * 100)}": round(self.quantile(q), 4) for q in QUANTILES},
+        }
+        if self.max_frame_probs:
+            series = self.series + ([self.bucket_sum / self.bucket_len] if self.bucket_len else [])
+            result["frame_probs"] = [round(prob, 4) for prob in series]
+            result["frame_probs_stride"] = self.stride
+        return result
+
+
+def predict_per_frame_with_final(model, video_paths, method='mean', max_frame_probs=None):
     """
     Predict per-frame and give final video-level prediction + confidence.
-    
+    Frames are scored as they are embedded, so memory stays flat however long the videos are.
+
     method: 'mean' or 'majority'
-    Returns: dict { video_path: {frame_probs, final_label, confidence} }
+    max_frame_probs: also return the per-frame probabilities, downsampled to at most this many points
+    Returns: dict { video_path: {is_lofifiable, confidence, avg_prob, frames_analyzed, quantiles[, frame_probs]} }
     """
+    if method not in ('mean', 'majority'):
+        raise ValueError("method must be 'mean' or 'majority'")
     results = {}
 
     for path in video_paths:
         print(f"🎞️ Processing: {path}")
-        embeddings = get_frame_embeddings(path)
+        try:
+            result = predict_video(model, path, method, max_frame_probs)
+        except Exception as e:
+            print(f"❌ Error processing {path}: {e}")
+            result = None
 
-        if embeddings is None:
+        if result is None:
             print(f"⚠️ Skipped: {path} (no meaningful frames)")
             continue
 
-        emb_np = embeddings.numpy()  # shape: (T, 512)
-        probs = model.predict_proba(emb_np)[:, 1]  # P(lofiable) for each frame
+        results[path] = result
 
-        if method == 'mean':
-            final_prob = probs.mean()
-            final_label = int(final_prob >= 0.5)
-            confidence = abs(final_prob - 0.5) * 2  # [0,1] how far from decision boundary
-        elif method == 'majority':
-            votes = (probs >= 0.5).astype(int)
-            final_label = int(votes.sum() >= (len(votes) / 2))
-            confidence = abs(votes.mean() - 0.5) * 2  # [0,1]
-            final_prob = probs.mean()
-        else:
-            raise ValueError("method must be 'mean' or 'majority'")
+    return results
 
-        results[path] = {
-            "frame_probs": probs.tolist(),
-            "is_lofifiable": final_label,
-            "confidence": round(confidence, 4),
-            "avg_prob": round(final_prob, 4)
-        }
+def predict_video(model, video_path, method='mean', max_frame_probs=None, crops=None, batcher=None):
+    """
+    The result of predict_per_frame_with_final for one video, None if it has no meaningful frame.
+    A video that fails to be analyzed (decode, CLIP or scoring error) raises instead of being skipped, so that
+    callers can tell a verdict from a failure. crops: the video's already decoded crops, see embedding_batches.
+    With a ClipBatcher, its frames share CLIP batches with the batcher's other producers.
+    """
+    aggregator = FrameScoreAggregator(max_frame_probs)
+    embed = batcher.distinct_embeddings if batcher is not None else distinct_embeddings
+    for embeddings in embed(video_path, crops=crops):
+        aggregator.update(score_frames(model, embeddings))
+    return aggregator.result(method) if aggregator.count else None
 
-    return results
+def stream_scores(model, video_path, method='mean'):
+    """
+    Score a video as its frames are embedded: yields the result of predict_per_frame_with_final for the frames
+    analyzed so far after every CLIP batch, the last one is the final result. Yields nothing without a
+    meaningful frame. Closing the generator stops decoding the video.
+    """
+    aggregator = FrameScoreAggregator()
+    for embeddings in distinct_embeddings(video_path):
+        aggregator.update(score_frames(model, embeddings))
+        yield aggregator.result(method)
+
+def score_frames(model, embeddings):
+    """P(lofiable) of each row of (N, 512) CLIP frame embeddings."""
+    with stage("svm_score"):
+        return model.predict_proba(embeddings.numpy())[:, 1]
+
+def score_embeddings(model, embeddings, method='mean', max_frame_probs=None):
+    """Score the (T, 512) CLIP frame embeddings of one video, see predict_per_frame_with_final."""
+    aggregator = FrameScoreAggregator(max_frame_probs)
+    aggregator.update(score_frames(model, embeddings))
+    return aggregator.result(method)
 
 if __name__ == "__main__":
     model = load_svm_model("models_1/svm")
@@ -117,4 +194,4 @@ if __name__ == "__main__":
         print(f"→ Final Prediction: {'Lofiable' if info['is_lofifiable'] else 'Not Lofiable'}")
         print(f"→ Confidence: {info['confidence']:.2f}")
         print(f"→ Average Probability: {info['avg_prob']:.4f}")
-        print(f"→ Frames Analyzed: {len(info['frame_probs'])}")
+        print(f"→ Frames Analyzed: {info['frames_analyzed']}")
@@ -2,16 +2,15 @@ from pathlib import Path
 import cv2
 import torch
 import numpy as np
-from transformers import CLIPProcessor, CLIPModel
-from sklearn.metrics.pairwise import cosine_similarity
-from model.Lofifiable_model import LofiClassifier
-import model
 import os
+import pickle
+from model.Lofifiable_model import LofiClassifier
+from clip_service import device, CLIP_WEIGHTS_VERSION, CLIP_BATCH_SIZE, EmbeddingDeduper, encode_crops, encode_texts
+from frames import EvenSamples, crop_frame, read_crops
+from metrics import stage
+from svm_frame_predictor import FrameScoreAggregator, score_frames
 
-# Load CLIP
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device)
-processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+# CLIP itself is loaded once by clip_service and shared with the SVM frame predictor
 classifier = LofiClassifier(input_dim=512).to(device)  # CLIP image embeddings are 512-dim
 checkpoint_path = Path(__file__).parent / "checkpoints" / "lofi_nn_classifier.pth"
 checkpoint = torch.load(checkpoint_path, map_location=device)  # Update path
@@ -23,9 +22,19 @@ valence_labels = ["sad", "neutral", "happy"]
 tempo_labels = ["slow tempo", "medium tempo", "fast tempo"]
 energy_labels = ["low energy", "moderate energy", "high energy"]
 swing_labels = ["mechanical rhythm", "slightly swung rhythm", "very swung rhythm"]
+label_sets = {
+    "valence": valence_labels,
+    "tempo": tempo_labels,
+    "energy": energy_labels,
+    "swing": swing_labels,
+}
+
+# The classifier was trained on the mean CLIP embedding of frames sampled evenly across a video, not on the
+# deduplicated frames the SVM scores, so it gets the same sampling (picked up by analyze_video's decoding pass)
+NUM_CLASSIFIER_FRAMES = 10
 
 # Frame extraction with checks and logging
-def extract_frames(video_path, num_frames=10):
+def extract_frames(video_path, num_frames=NUM_CLASSIFIER_FRAMES):
     if not os.path.isfile(video_path):
         print(f"[ERROR] File not found: {video_path}")
         return []
@@ -56,26 +65,67 @@ def extract_frames(video_path, num_frames=10):
     print(f"[INFO] Extracted {len(frames)} frames from '{video_path}'")
     return frames
 
-# Helper: compute similarities between image embedding and text prompts
-def rank_labels(image_embedding, text_labels):
-    inputs = processor(text=text_labels, return_tensors="pt", padding=True).to(device)
+# Text embeddings of the labels only depend on the CLIP weights, so they are computed once and cached on disk,
+# keyed by the hash of the checkpoint (never with LOFI_CLIP_RANDOM_WEIGHTS)
+label_embeddings_path = Path(__file__).parent / "checkpoints" / "clip_label_embeddings.pt"
+
+
+def load_label_embeddings(labels):
+    """Return L2-normalized text embeddings for labels, encoding only those missing from the on-disk cache."""
+    cache = {}
+    if CLIP_WEIGHTS_VERSION is not None and label_embeddings_path.is_file():
+        try:
+            cached = torch.load(label_embeddings_path, map_location="cpu")
+        except (OSError, RuntimeError, EOFError, pickle.UnpicklingError) as e:
+            print(f"[WARNING] Ignoring unreadable {label_embeddings_path}: {e}")
+            cached = {}
+        if cached.get("weights") == CLIP_WEIGHTS_VERSION:
+            cache = cached["labels"]
+
+    missing = [label for label in labels if label not in cache]
+    if missing:
+        print(f"[INFO] Precomputing text embeddings for {len(missing)} labels")
+        text_features = encode_texts(missing)
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+        cache.update(zip(missing, text_features))
+        if CLIP_WEIGHTS_VERSION is not None:
+            # renamed over the cache once complete, so a crash mid-write never leaves a truncated one behind
+            tmp_path = label_embeddings_path.with_name(f"{label_embeddings_path.name}.{os.getpid()}.tmp")
+            torch.save({"weights": CLIP_WEIGHTS_VERSION, "labels": cache}, tmp_path)
+            os.replace(tmp_path, label_embeddings_path)
+
+    return torch.stack([cache[label] for label in labels])
+
+
+# All label sets stacked into one matrix so an image is scored against every label in a single matmul
+label_matrix = load_label_embeddings([label for labels in label_sets.values() for label in labels]).to(device)
+label_slices = {}
+offset = 0
+for name, labels in label_sets.items():
+    label_slices[name] = slice(offset, offset + len(labels))
+    offset += len(labels)
+
+# Helper: cosine similarities of one image embedding to every label set, as {set name: similarities}
+def score_label_sets(image_embedding):
+    image_embedding = image_embedding.float()
+    image_embedding = image_embedding / image_embedding.norm(dim=-1, keepdim=True)
     with torch.no_grad():
-        text_features = model.get_text_features(**inputs)
-    similarities = cosine_similarity(image_embedding.cpu(), text_features.cpu())[0]
-    return similarities
+        similarities = (image_embedding @ label_matrix.T)[0].cpu().numpy()
+    return {name: similarities[label_slice] for name, label_slice in label_slices.items()}
 
-# Main predictor with safety checks
 # Main predictor with safety checks
 def predict_music_features(video_path):
     frames = extract_frames(video_path)
     if len(frames) == 0:
         raise ValueError("❌ No frames extracted from video. Please check the file path and format.")
 
-    inputs = processor(images=frames, return_tensors="pt", padding=True).to(device)
-    with torch.no_grad():
-        image_features = model.get_image_features(**inputs)
+    with stage("clip_encode"):
+        image_features = encode_crops(np.stack([crop_frame(frame) for frame in frames]))
+    return music_features(image_features)
 
-    image_embedding = image_features.mean(dim=0, keepdim=True)
+# Classifier score and label features from the (N, 512) CLIP embeddings of the evenly sampled frames
+def music_features(image_features):
+    image_embedding = image_features.mean(dim=0, keepdim=True).to(device)
 
     # --- Predict Lofi-fiability using the trained classifier ---
     with torch.no_grad():
@@ -83,10 +133,11 @@ def predict_music_features(video_path):
     lofifiable:bool = lofi_score > 0.5  # threshold
 
     # Compute similarity-based features
-    valence_scores = rank_labels(image_embedding, valence_labels)
-    tempo_scores = rank_labels(image_embedding, tempo_labels)
-    energy_scores = rank_labels(image_embedding, energy_labels)
-    swing_scores = rank_labels(image_embedding, swing_labels)
+    scores = score_label_sets(image_embedding)
+    valence_scores = scores["valence"]
+    tempo_scores = scores["tempo"]
+    energy_scores = scores["energy"]
+    swing_scores = scores["swing"]
 
     # Normalize scores to [0, 1]
     valence = np.dot(valence_scores, [0.0, 0.5, 1.0]) / valence_scores.sum()
@@ -105,3 +156,39 @@ def predict_music_features(video_path):
         "is_lofifiable": lofifiable
     }
 
+# The SVM verdict on the distinct frames of the video, and the classifier score and label features on its evenly
+# sampled frames, from one decoding pass: the sampled crops are encoded in the CLIP batches of the distinct frames
+def analyze_video(video_path, svm_model, method='mean'):
+    samples = EvenSamples(NUM_CLASSIFIER_FRAMES)
+    deduper = EmbeddingDeduper()
+    aggregator = FrameScoreAggregator()
+    distinct, sampled, sample_features = [], [], []
+
+    def encode():
+        with stage("clip_encode"):
+            embeddings = encode_crops(np.stack(distinct + sampled))
+        with stage("embedding_dedup"):
+            kept = deduper.filter(embeddings[:len(distinct)])
+        if len(kept):
+            aggregator.update(score_frames(svm_model, kept))
+        sample_features.append(embeddings[len(distinct):])
+        distinct.clear()
+        sampled.clear()
+
+    for _, crop in read_crops(video_path, samples=samples):
+        distinct.append(crop)
+        sampled.extend(samples.take())
+        if len(distinct) + len(sampled) >= CLIP_BATCH_SIZE:
+            encode()
+    sampled.extend(samples.take())
+    if distinct or sampled:
+        encode()
+
+    image_features = torch.cat(sample_features) if sample_features else torch.empty(0, 512)
+    if not aggregator.count or not len(image_features):
+        raise ValueError("❌ No frames extracted from video. Please check the file path and format.")
+
+    return {
+        "svm": aggregator.result(method),
+        "music_features": music_features(image_features)
+    }
@@ -0,0 +1,157 @@
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lofi2lofi_generate import decode, continue_decode, write_output
+from model.constants import MAX_CHORD_LENGTH
+import metrics
+
+# Long-lived worker speaking line-delimited JSON, so callers pay for importing torch/CLIP and loading the
+# checkpoints once instead of per job.
+#
+# Request:  {"id": "1", "cmd": "decode", "video": "/path/in.mp4", "output": "/path/out.json", "num_chords": 4}
+#           (an output path ending in .wav gets the rendered audio instead of the JSON, an optional "seed"
+#           makes the song reproducible)
+#           {"id": "2", "cmd": "continue", "state": "<X-Lofi-State token>", "num_chords": 4}
+#           {"id": "3", "cmd": "ping"}
+# Response: {"id": "1", "ok": true, "result": "<Output JSON>", "state": "<token>",
+#            "timings": {"queue_ms": 0.1, "run_ms": 812.3, "total_ms": 812.4, "stages": {"clip_encode": 402.1, ...}}}
+#           {"id": "1", "ok": false, "error": "...", "timings": {...}}
+
+DEFAULT_CONCURRENCY = 2
+
+
+def run_job(model, job):
+    """Run a single job and return the response fields besides id and timings."""
+    cmd = job.get("cmd", "decode")
+    num_chords = job.get("num_chords", 4)
+
+    if cmd == "ping":
+        return {"ok": True}
+    if not isinstance(num_chords, int) or not 1 <= num_chords <= MAX_CHORD_LENGTH:
+        return {"ok": False, "error": f"num_chords must be an integer between 1 and {MAX_CHORD_LENGTH}"}
+    if cmd == "decode":
+        result = decode(model, job["video"], num_chords, job.get("seed"))
+        if result is None:
+            return {"ok": False, "error": "Input video is not lofifiable."}
+        if isinstance(result, str):
+            return {"ok": False, "error": "Lofifiable_tag not found."}
+    elif cmd == "continue":
+        result = continue_decode(model, job["state"], num_chords)
+    else:
+        return {"ok": False, "error": f"Unknown command: {cmd}"}
+
+    output, state = result
+    if job.get("output"):
+        write_output(output, job["output"])
+    return {"ok": True, "result": output, "state": state}
+
+
+class Worker:
+    """Runs jobs on a bounded thread pool and hands each response to a callback as soon as it finishes."""
+
+    def __init__(self, model, concurrency=DEFAULT_CONCURRENCY):
+        self.model = model
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # at most this many jobs are queued or running, further reads block until a slot frees up
+        self.slots = threading.BoundedSemaphore(concurrency * 2)
+
+    def submit(self, line, respond):
+        """Queue a request line (str or UTF-8 bytes), respond is called exactly once with its response."""
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            respond({"id": None, "ok": False, "error": f"Invalid JSON: {e}"})
+            return
+        if not isinstance(job, dict):
+            respond({"id": None, "ok": False, "error": "Expected a JSON object"})
+            return
+
+        self.slots.acquire()
+        received = time.perf_counter()
+        self.executor.submit(self._run, job, received, respond)
+
+    def _run(self, job, received, respond):
+        started = time.perf_counter()
+        job_trace = None
+        try:
+            with metrics.trace() as job_trace:
+                response = run_job(self.model, job)
+        except Exception as e:
+            response = {"ok": False, "error": f"Server error: {str(e)}"}
+        finally:
+            self.slots.release()
+        finished = time.perf_counter()
+        # nothing here may raise: the caller waits for exactly one response per job
+        response = {"id": job.get("id"), **response, "timings": {
+            "queue_ms": round((started - received) * 1000, 3),
+            "run_ms": round((finished - started) * 1000, 3),
+            "total_ms": round((finished - received) * 1000, 3),
+            "stages": {name: round(entry["seconds"] * 1000, 3) for name, entry in
+                       (job_trace.stages.items() if job_trace else ())},
+        }}
+        respond(response)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def serve_stdio(model, concurrency=DEFAULT_CONCURRENCY):
+    # stdout carries the protocol, so everything the pipeline prints goes to stderr instead
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr
+    write_lock = threading.Lock()
+
+    def respond(response):
+        with write_lock:
+            protocol_out.write(json.dumps(response) + "\n")
+            protocol_out.flush()
+
+    worker = Worker(model, concurrency)
+    print(f"Worker ready on stdin/stdout (concurrency {concurrency})", file=sys.stderr)
+    for line in sys.stdin:
+        if line.strip():
+            worker.submit(line, respond)
+    worker.shutdown()
+
+
+def serve_socket(model, socket_path, concurrency=DEFAULT_CONCURRENCY):
+    worker = Worker(model, concurrency)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            write_lock = threading.Lock()
+            pending = threading.Semaphore(0)
+            submitted = 0
+
+            def respond(response):
+                with write_lock:
+                    try:
+                        self.wfile.write((json.dumps(response) + "\n").encode())
+                        self.wfile.flush()
+                    except OSError:
+                        pass  # client went away
+                pending.release()
+
+            for line in self.rfile:
+                if line.strip():
+                    worker.submit(line, respond)
+                    submitted += 1
+            # keep the connection open until every job of this client has answered
+            for _ in range(submitted):
+                pending.acquire()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    print(f"Worker listening on {socket_path} (concurrency {concurrency})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        worker.shutdown()